@@ -43,6 +43,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so that it times the whole request (see PERFORMANCE_INSTRUMENTATION)
+    'shop.middleware.PerformanceMiddleware',
+    # Before any query, see DATABASE_REPLICAS
+    'shop.replicas.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -76,11 +80,49 @@ WSGI_APPLICATION = 'project.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
+# Connections are kept by each worker thread for CONN_MAX_AGE seconds rather than opened per request.
+# 'replica' stands in for a read replica kept up to date by the database server, it reads the primary
+# file until pointed at its own database and listed in DATABASE_REPLICAS['ALIASES']
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'CONN_MAX_AGE': 60,
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': 60,
+    },
+}
+
+DATABASE_ROUTERS = ['shop.replicas.ReplicaRouter']
+
+# Reads balanced over the healthy replicas, see shop/replicas.py
+DATABASE_REPLICAS = {
+    'PRIMARY': 'default',
+    'ALIASES': [],
+    'STICKY_SECONDS': 10,
+    'HEALTH_CHECK_INTERVAL': 10,
+    'CONNECTION_HEALTH_CHECKS': True,
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# 'catalog' holds the public catalog responses (shop/cache.py), use a shared backend
+# (django.core.cache.backends.db.DatabaseCache, FileBasedCache, Memcached...) with several workers
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalog',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
 }
 
 
@@ -130,5 +172,96 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     'PAGE_SIZE': 12,
-    'DEFAULT_AUTHENTICATION_CLASSES': ('rest_framework_simplejwt.authentication.JWTAuthentication',),
+    'DEFAULT_AUTHENTICATION_CLASSES': ('shop.authentication.CachedJWTAuthentication',),
+}
+
+# Tokens carrying the user flags read by shop/permissions.py
+SIMPLE_JWT = {
+    'TOKEN_OBTAIN_SERIALIZER': 'shop.authentication.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'shop.authentication.ClaimsTokenRefreshSerializer',
+}
+
+# How an access token is resolved to a user, see shop/authentication.py for the modes.
+# A deactivated user or a lost staff status applies within TTL seconds in cache mode,
+# within SIMPLE_JWT['ACCESS_TOKEN_LIFETIME'] in claims mode
+JWT_USER_RESOLUTION = {
+    'MODE': 'cache',
+    'TTL': 60,
+    'CACHE': 'default',
+}
+
+# Seconds the row count of a catalog list is reused while no signalled write reaches its tables,
+# the staleness bound of the writes sending no signal. 0 counts on every request
+CATALOG_COUNT_CACHE_TTL = 60
+
+# Opt-in: public list endpoints serialize values() rows instead of model instances, see shop/fastpath.py.
+# TestFastListPath diffs both outputs over every fieldset, run it after changing a list serializer
+CATALOG_FAST_LIST = False
+
+# Seconds /api/changes/ keeps its watermark behind the current time, longer transactions may be missed
+CATALOG_CHANGES_LAG = 2
+
+# Rows of each kind per /api/changes/ page, also the highest ?limit= accepted
+CATALOG_CHANGES_LIMIT = 1000
+
+# Shared ecoscore cache, see shop/ecoscore.py for the available keys
+ECOSCORE_CACHE = {
+    'TTL': 24 * 60 * 60,
+    'NEGATIVE_TTL': 10 * 60,
+    'MAX_ENTRIES': 10000,
+    # The hit/miss counters are per process in the default LocMemCache, name a shared cache to add up the workers
+    'STATS_CACHE': 'default',
+}
+
+# HTTP client used for external calls, see shop/clients.py for the available keys
+EXTERNAL_API = {
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 5,
+    'RETRIES': 2,
+    'FAILURE_THRESHOLD': 5,
+    'RECOVERY_TIMEOUT': 30,
+}
+
+# Public catalog response cache, see shop/cache.py for the available keys
+CATALOG_RESPONSE_CACHE = {
+    'ENABLED': True,
+    'ALIAS': 'catalog',
+    'TIMEOUT': 5 * 60,
+}
+
+# Pre-rendered category details, see shop/snapshots.py and the rebuild_snapshots command
+CATALOG_SNAPSHOTS = {
+    'ENABLED': True,
+    'MAX_AGE': 24 * 60 * 60,
+}
+
+# Per request timings in a Server-Timing header and the shop.performance logger, see shop/middleware.py.
+# The middleware removes itself when disabled.
+PERFORMANCE_INSTRUMENTATION = {
+    'ENABLED': False,
+    'SLOW_REQUEST_MS': 500,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'shop.performance': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
+# Staff only cProfile runs, triggered with the X-Profile header or ?profile=inline|store, see shop/profiling.py
+PROFILING = {
+    'DIRECTORY': BASE_DIR / 'profiles',
+    'STATS_LIMIT': 50,
+    'TREE_DEPTH': 12,
+    'TREE_THRESHOLD': 0.01,
 }
@@ -6,16 +6,23 @@ from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )
 
+from shop import async_views
 from shop.views import CategoryViewSet, ProductViewSet, ArticleViewSet,\
-    AdminCategoryViewSet, AdminArticleViewSet
+    AdminCategoryViewSet, AdminArticleViewSet, AdminEcoscoreCacheViewSet, AdminExternalAPIViewSet, CatalogExportViewSet, \
+    CatalogChangesViewSet, CatalogSearchViewSet
 
 # Creating a router
 router = routers.SimpleRouter()
 router.register('category', CategoryViewSet, basename='category')
 router.register('product', ProductViewSet, basename='product')
 router.register('article', ArticleViewSet, basename='article')
+router.register('export', CatalogExportViewSet, basename='export')
+router.register('changes', CatalogChangesViewSet, basename='changes')
+router.register('search', CatalogSearchViewSet, basename='search')
 router.register('admin/category', AdminCategoryViewSet, basename='admin-category')
 router.register('admin/article', AdminArticleViewSet, basename='admin-article')
+router.register('admin/ecoscore-cache', AdminEcoscoreCacheViewSet, basename='admin-ecoscore-cache')
+router.register('admin/external-api', AdminExternalAPIViewSet, basename='admin-external-api')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -23,4 +30,9 @@ urlpatterns = [
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/', include(router.urls)), # Using router registered routes
+    # Async reads, served without blocking by an ASGI worker, see shop/async_views.py
+    path('api/async/product/', async_views.product_list, name='async-product-list'),
+    path('api/async/product/<int:pk>/', async_views.product_detail, name='async-product-detail'),
+    path('api/async/category/', async_views.category_list, name='async-category-list'),
+    path('api/async/category/<int:pk>/', async_views.category_detail, name='async-category-detail'),
 ]
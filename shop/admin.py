@@ -1,5 +1,5 @@
 from django.contrib import admin
-from shop.models import Category, Product, Article
+from shop.models import Category, Product, Article, EcoscoreCacheEntry
 
 
 class CategoryAdmin(admin.ModelAdmin):
@@ -10,17 +10,25 @@ class CategoryAdmin(admin.ModelAdmin):
 class ProductAdmin(admin.ModelAdmin):
 
     list_display = ('name', 'category', 'active')
+    list_select_related = ('category',)
 
 
 class ArticleAdmin(admin.ModelAdmin):
 
     list_display = ('name', 'product', 'category', 'active')
+    list_select_related = ('product__category',)
 
     @admin.display(description='Category')
     def category(self, obj):
         return obj.product.category
 
 
+class EcoscoreCacheEntryAdmin(admin.ModelAdmin):
+
+    list_display = ('barcode', 'grade', 'expires_at', 'last_used')
+
+
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(Product, ProductAdmin)
 admin.site.register(Article, ArticleAdmin)
+admin.site.register(EcoscoreCacheEntry, EcoscoreCacheEntryAdmin)
@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+
+
+class ShopConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'shop'
+
+    def ready(self):
+        # Connecting the response cache, snapshot, table version, tombstone and cached user invalidation receivers
+        import shop.authentication  # noqa: F401
+        import shop.cache  # noqa: F401
+        import shop.changes  # noqa: F401
+        import shop.snapshots  # noqa: F401
+        import shop.versions  # noqa: F401
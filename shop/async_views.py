@@ -0,0 +1,77 @@
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from shop.ecoscore import aprefetch_ecoscores
+from shop.models import Category, Product
+from shop.pagination import CatalogPagination
+from shop.serializers import CategoryListSerializer, CategoryDetailSerializer, \
+    ProductListSerializer, ProductDetailSerializer
+from shop.views import prefetch_active_articles, prefetch_active_products
+
+# Async variants of the public product and category reads, for ASGI workers (see project/asgi.py).
+# The queries and the serialization run in the thread of sync_to_async, the ecoscores missing from the
+# cache are fetched on the event loop meanwhile, so a worker keeps serving while OpenFoodFacts is slow.
+# The output is the one of the viewsets for the same pagination and category_id parameters, without
+# their sparse fieldsets, conditional GETs, response cache, snapshots and profiling.
+
+NOT_FOUND = {'detail': 'Not found.'}
+
+
+def json_response(data, status=status.HTTP_200_OK):
+    return HttpResponse(JSONRenderer().render(data), status=status, content_type=JSONRenderer.media_type)
+
+
+@sync_to_async
+def load_page(request, queryset):
+    paginator = CatalogPagination()
+    # The paginators read the query parameters through a DRF request
+    page = paginator.paginate_queryset(queryset, Request(request))
+    return paginator, page
+
+
+@sync_to_async
+def paginated_data(paginator, serializer):
+    return paginator.get_paginated_response(serializer.data).data
+
+
+@sync_to_async
+def serializer_data(serializer):
+    return serializer.data
+
+
+async def product_list(request):
+    queryset = Product.objects.filter(active=True)
+    category_id = request.GET.get('category_id')
+    if category_id is not None:
+        if not category_id.isdigit():
+            return json_response({'detail': 'category_id must be an integer.'}, status.HTTP_400_BAD_REQUEST)
+        queryset = queryset.filter(category_id=category_id)
+    paginator, page = await load_page(request, queryset)
+    await aprefetch_ecoscores(page)
+    return json_response(await paginated_data(paginator, ProductListSerializer(page, many=True)))
+
+
+async def product_detail(request, pk):
+    product = await sync_to_async(
+        Product.objects.filter(pk=pk, active=True).prefetch_related(prefetch_active_articles()).first)()
+    if product is None:
+        return json_response(NOT_FOUND, status.HTTP_404_NOT_FOUND)
+    await aprefetch_ecoscores([product])
+    return json_response(await serializer_data(ProductDetailSerializer(product)))
+
+
+async def category_list(request):
+    paginator, page = await load_page(request, Category.objects.filter(active=True))
+    return json_response(await paginated_data(paginator, CategoryListSerializer(page, many=True)))
+
+
+async def category_detail(request, pk):
+    category = await sync_to_async(
+        Category.objects.filter(pk=pk, active=True).prefetch_related(prefetch_active_products()).first)()
+    if category is None:
+        return json_response(NOT_FOUND, status.HTTP_404_NOT_FOUND)
+    await aprefetch_ecoscores(category.active_products)
+    return json_response(await serializer_data(CategoryDetailSerializer(category)))
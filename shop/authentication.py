@@ -0,0 +1,130 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from shop.instrumentation import timed
+
+# Defaults, each key can be overridden through settings.JWT_USER_RESOLUTION
+DEFAULTS = {
+    # database: one user query per request, as simplejwt does
+    # cache: the user flags are cached, a deactivation or a lost staff status applies within TTL seconds
+    # claims: the user flags are read from the access token, they apply within SIMPLE_JWT['ACCESS_TOKEN_LIFETIME']
+    'MODE': 'cache',
+    'TTL': 60,
+    'CACHE': 'default',  # cache alias holding the user flags, the default locmem cache is per process
+}
+
+# What shop/permissions.py reads from request.user, with the username
+USER_FLAGS = ('is_active', 'is_staff', 'is_superuser')
+
+
+def setting(name):
+    return getattr(settings, 'JWT_USER_RESOLUTION', {}).get(name, DEFAULTS[name])
+
+
+def user_cache_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def set_user_claims(token, user):
+    token['username'] = user.get_username()
+    token['is_staff'] = user.is_staff
+    token['is_superuser'] = user.is_superuser
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """ Tokens carrying the user flags, copied into the access tokens refreshed from them """
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        set_user_claims(token, user)
+        return token
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """ Reads the user flags again, so an access token never carries them longer than its lifetime """
+
+    def validate(self, attrs):
+        data = super().validate(attrs)
+        access = AccessToken(data['access'])
+        user = get_user_model().objects.filter(**{api_settings.USER_ID_FIELD: access[api_settings.USER_ID_CLAIM]}).first()
+        if user is None or not user.is_active:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        set_user_claims(access, user)
+        data['access'] = str(access)
+        return data
+
+
+class CachedUser(TokenUser):
+    """ TokenUser whose flags come from the cached user row rather than from the token """
+
+    def __init__(self, token, fields):
+        super().__init__(token)
+        self.fields = fields
+
+    @property
+    def username(self):
+        return self.fields[get_user_model().USERNAME_FIELD]
+
+    @property
+    def is_staff(self):
+        return self.fields['is_staff']
+
+    @property
+    def is_superuser(self):
+        return self.fields['is_superuser']
+
+
+class TimedJWTAuthentication(JWTAuthentication):
+    """ simplejwt authentication reporting its time to the performance instrumentation """
+
+    def authenticate(self, request):
+        with timed('auth'):
+            return super().authenticate(request)
+
+
+class CachedJWTAuthentication(TimedJWTAuthentication):
+    """ Resolves the user of an access token without a database query, according to JWT_USER_RESOLUTION """
+
+    def get_user(self, validated_token):
+        mode = setting('MODE')
+        if mode == 'database':
+            return super().get_user(validated_token)
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Token contained no recognizable user identification')
+        # Tokens issued before the claims existed are resolved through the cache
+        if mode == 'claims' and 'is_staff' in validated_token:
+            return TokenUser(validated_token)
+
+        cache = caches[setting('CACHE')]
+        key = user_cache_key(user_id)
+        fields = cache.get(key)
+        if fields is None:
+            user_model = get_user_model()
+            fields = user_model.objects.filter(**{api_settings.USER_ID_FIELD: user_id}) \
+                .values(user_model.USERNAME_FIELD, *USER_FLAGS).first()
+            # Unknown users are cached too, as False
+            cache.set(key, fields or False, setting('TTL'))
+        if not fields:
+            raise AuthenticationFailed('User not found', code='user_not_found')
+        if not fields['is_active']:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        return CachedUser(validated_token, fields)
+
+
+# Changes made through the ORM apply at once, the others within the TTL
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def user_changed(sender, instance, **kwargs):
+    caches[setting('CACHE')].delete(user_cache_key(getattr(instance, api_settings.USER_ID_FIELD)))
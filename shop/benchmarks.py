@@ -0,0 +1,256 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from urllib.parse import urlencode
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import connection
+from django.test import AsyncClient, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from shop.ecoscore import ecoscore_cache
+from shop.export import format_datetime
+from shop.factories import clear_catalog, generate_catalog
+from shop.fastpath import CategoryRowSerializer, ProductRowSerializer, ArticleRowSerializer
+from shop.mocks import mock_openfoodfact_success, OpenFoodFactStubServer
+from shop.models import Category, Product, Article
+
+# Dataset sizes, as (categories, products per category, articles per product)
+SIZES = {
+    'small': (2, 5, 3),
+    'medium': (10, 20, 5),
+    'large': (30, 50, 10),
+}
+
+# Latency is noisy, a run only fails when p95 goes beyond baseline p95 x LATENCY_TOLERANCE
+LATENCY_TOLERANCE = 3
+
+
+def percentile(values, rank):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(rank / 100 * (len(values) - 1))))]
+
+
+# Query strings of the list endpoints which need one, matching part of the generated catalog
+LIST_QUERIES = {
+    'search': '?q=bio',
+}
+
+
+def router_endpoints(queries=LIST_QUERIES):
+    """ (name, list url, has detail) for every viewset registered on the API router """
+    from project.urls import router
+    for prefix, viewset, basename in router.registry:
+        yield basename, reverse(f'{basename}-list') + queries.get(basename, ''), hasattr(viewset, 'retrieve')
+
+
+def write_changes():
+    """ Writes a delta for /api/changes/ to report after the seeded catalog, the same for each size:
+        a deleted product, the price of one article in 10, and a new category. Returns its ?since= """
+    since = timezone.now()
+    Product.objects.order_by('pk').last().delete()
+    Article.objects.filter(pk__in=Article.objects.order_by('pk').values_list('pk', flat=True)[::10]) \
+        .update(price=1, date_updated=timezone.now())
+    category = Category.objects.create(name='Catégorie nouvelle', active=True)
+    Product.objects.create(name='Produit nouveau', active=True, category=category)
+    return '?' + urlencode({'since': format_datetime(since)})
+
+
+def first_id(response):
+    data = response.json() if response.get('Content-Type', '').startswith('application/json') else None
+    rows = data.get('results') if isinstance(data, dict) else data
+    if isinstance(rows, list) and rows and isinstance(rows[0], dict):
+        return rows[0].get('id')
+
+
+def measure(client, url, repeat):
+    """ Requests url `repeat` times, counting queries and ecoscore calls of the first (cold) request """
+    calls = []
+
+    def external_call(product, method, url):
+        calls.append(url)
+        return mock_openfoodfact_success(product, method, url)
+
+    latencies, queries, response = [], None, None
+    with mock.patch('shop.models.Product.call_external_api', autospec=True, side_effect=external_call):
+        for run in range(repeat):
+            for cache in caches.all():
+                cache.clear()
+            ecoscore_cache.clear()
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = client.get(url)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                latencies.append((time.perf_counter() - start) * 1000)
+            if queries is None:
+                # Transaction control isn't counted: savepoints inside a transaction, as in the tests,
+                # BEGIN outside of one, as from the benchmark_endpoints command
+                queries = len([query for query in context.captured_queries
+                               if 'SAVEPOINT' not in query['sql'] and query['sql'] != 'BEGIN'])
+                external_calls = len(calls)
+    return response, {
+        'status': response.status_code,
+        'queries': queries,
+        'external_calls': external_calls,
+        'p50_ms': round(statistics.median(latencies), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+    }
+
+
+# Measuring the uncached code paths, the response cache, the snapshots and the cached counts would hide them.
+# Without lag, /api/changes/ reports the rows written right before it's measured
+@override_settings(CATALOG_RESPONSE_CACHE={'ENABLED': False}, CATALOG_SNAPSHOTS={'ENABLED': False},
+                   CATALOG_COUNT_CACHE_TTL=0, CATALOG_CHANGES_LAG=0)
+def run_benchmarks(sizes, repeat=10):
+    """ Seeds each dataset size in the current database, which must be disposable,
+        and measures every list and detail endpoint of the router """
+    UserModel = get_user_model()
+    admin = UserModel.objects.filter(username='benchmark').first() \
+        or UserModel.objects.create_superuser('benchmark', 'benchmark@oc.drf', 'benchmark')
+    client = APIClient()
+    client.force_authenticate(admin)
+
+    results = {}
+    for size in sizes:
+        clear_catalog()
+        categories, products, articles = SIZES[size]
+        generate_catalog(categories, products, articles, seed=0)
+        queries = {**LIST_QUERIES, 'changes': write_changes()}
+        results[size] = {}
+        for name, url, has_detail in router_endpoints(queries):
+            response, results[size][f'{name}-list'] = measure(client, url, repeat)
+            pk = first_id(response) if has_detail else None
+            if pk is not None:
+                results[size][f'{name}-detail'] = measure(client, reverse(f'{name}-detail', kwargs={'pk': pk}), repeat)[1]
+    return results
+
+
+def compare(results, baseline, latency_tolerance=LATENCY_TOLERANCE):
+    """ Lists the budgets exceeded by results compared to baseline """
+    violations = []
+    for size, endpoints in results.items():
+        for endpoint, measures in endpoints.items():
+            budget = baseline.get(size, {}).get(endpoint)
+            if budget is None:
+                continue
+            for key in ('queries', 'external_calls'):
+                if measures[key] > budget[key]:
+                    violations.append(f'{size} {endpoint}: {measures[key]} {key}, budget {budget[key]}')
+            if measures['p95_ms'] > budget['p95_ms'] * latency_tolerance:
+                violations.append(f"{size} {endpoint}: p95 {measures['p95_ms']}ms, "
+                                  f"budget {budget['p95_ms']}ms x {latency_tolerance}")
+    return violations
+
+
+def rows_per_second(serialize, repeat):
+    best = None
+    for run in range(repeat):
+        start = time.perf_counter()
+        rows = serialize()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(rows) / best if best else float('inf'), rows
+
+
+def serialization_throughput(size, repeat=5):
+    """ Rows per second of the list serializers against their values() row serializers,
+        queries included, on a seeded dataset of the given size """
+    clear_catalog()
+    generate_catalog(*SIZES[size], seed=0)
+    results = {}
+    with mock.patch('shop.models.Product.call_external_api', autospec=True, side_effect=mock_openfoodfact_success):
+        for name, model, row_serializer_class in [('category', Category, CategoryRowSerializer),
+                                                  ('product', Product, ProductRowSerializer),
+                                                  ('article', Article, ArticleRowSerializer)]:
+            row_serializer = row_serializer_class()
+            queryset = model.objects.filter(active=True).order_by('id')
+            # Grades cached by the first run, both paths then read them from the ecoscore cache
+            row_serializer.serializer_class(queryset, many=True).data
+            serializer_rate, expected = rows_per_second(
+                lambda: row_serializer.serializer_class(queryset.all(), many=True).data, repeat)
+            row_rate, rows = rows_per_second(
+                lambda: row_serializer.to_representation(row_serializer.get_queryset(queryset)), repeat)
+            if [dict(item) for item in expected] != rows:
+                raise AssertionError(f'{name} rows differ from the {row_serializer.serializer_class.__name__} output')
+            results[name] = {
+                'rows': len(rows),
+                'serializer_rows_per_second': round(serializer_rate),
+                'values_rows_per_second': round(row_rate),
+                'speedup': round(row_rate / serializer_rate, 2),
+            }
+    return results
+
+
+def load_summary(results, elapsed, concurrency):
+    latencies = [latency for _, latency in results]
+    return {
+        'requests': len(results),
+        'concurrency': concurrency,
+        'errors': sum(1 for status_code, _ in results if status_code != 200),
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(results) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+    }
+
+
+def wsgi_load(urls, threads):
+    """ The urls requested through the WSGI handler by `threads` threads, as a threaded WSGI worker serves them """
+    def get(url):
+        start = time.perf_counter()
+        response = Client().get(url)
+        return response.status_code, (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(get, urls))
+    return load_summary(results, time.perf_counter() - start, threads)
+
+
+def asgi_load(urls):
+    """ The urls requested all at once through the ASGI handler, on a single event loop as an ASGI worker serves them """
+    async def get(client, url):
+        start = time.perf_counter()
+        response = await client.get(url)
+        return response.status_code, (time.perf_counter() - start) * 1000
+
+    async def run():
+        client = AsyncClient()
+        return await asyncio.gather(*(get(client, url) for url in urls))
+
+    start = time.perf_counter()
+    results = asyncio.run(run())
+    return load_summary(results, time.perf_counter() - start, len(urls))
+
+
+# Every request misses the ecoscore cache and waits for the upstream
+@override_settings(CATALOG_RESPONSE_CACHE={'ENABLED': False}, CATALOG_SNAPSHOTS={'ENABLED': False},
+                   ECOSCORE_CACHE={'TTL': 0, 'NEGATIVE_TTL': 0})
+def load_test(requests=100, latency=0.2, threads=8):
+    """ Throughput of the product details served by a threaded WSGI worker and by the async views on
+        an ASGI worker, while a local OpenFoodFacts stub answers after `latency` seconds.
+        Seeds the current database, which must be disposable and allow concurrent connections """
+    clear_catalog()
+    category = Category.objects.create(name='Load test', active=True)
+    Product.objects.bulk_create([
+        Product(name=f'Product {index}', category=category, barcode=f'{index:013d}', active=True)
+        for index in range(requests)
+    ])
+    pks = list(Product.objects.order_by('pk').values_list('pk', flat=True))
+
+    with OpenFoodFactStubServer(delay=latency) as stub, mock.patch('shop.models.ECOSCORE_URL', stub.url):
+        results = {
+            'wsgi': wsgi_load([reverse('product-detail', kwargs={'pk': pk}) for pk in pks], threads),
+            'asgi': asgi_load([reverse('async-product-detail', kwargs={'pk': pk}) for pk in pks]),
+        }
+        upstream_calls = stub.calls
+    results['upstream_calls'] = upstream_calls
+    return results
@@ -0,0 +1,165 @@
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+from shop.models import Category, Product, Article
+from shop.signals import catalog_updated, on_commit_batch
+
+# Defaults, each key can be overridden through settings.CATALOG_RESPONSE_CACHE
+DEFAULTS = {
+    'ENABLED': True,
+    'ALIAS': 'catalog',  # Django cache holding the responses and their versions
+    'TIMEOUT': 5 * 60,
+}
+
+# Headers replayed with a cached body
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+def setting(name):
+    return getattr(settings, 'CATALOG_RESPONSE_CACHE', {}).get(name, DEFAULTS[name])
+
+
+def get_cache():
+    return caches[setting('ALIAS')]
+
+
+# Every cached response depends on version keys: 'category', 'product' and 'article' for the lists,
+# 'category:<pk>' and 'product:<pk>' for the detail trees. A write replaces the versions it affects,
+# so the keys built from the previous ones are never read again and simply expire.
+def get_versions(dependencies):
+    cache = get_cache()
+    keys = [f'catalog:version:{dependency}' for dependency in dependencies]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Never starting from a known value, so a lost version can't resurrect old entries
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def replace_versions(dependencies):
+    get_cache().set_many({f'catalog:version:{dependency}': uuid.uuid4().hex for dependency in dependencies}, None)
+
+
+def invalidate(dependencies):
+    if not dependencies:
+        return
+    replace_versions(dependencies)
+    # Once more after commit, dropping what a concurrent request may have cached from the old rows meanwhile.
+    # Gathered over the transaction, so a batch of writes replaces each version once
+    on_commit_batch('cache', replace_versions, dependencies)
+
+
+def product_dependencies(products):
+    dependencies = {'product'}
+    for product_id, category_id in products:
+        dependencies.update([f'product:{product_id}', f'category:{category_id}'])
+    return dependencies
+
+
+@receiver(post_save, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    invalidate({'category', f'category:{instance.pk}'})
+
+
+# A row moved to another parent invalidates the trees of both, see LoadedParentMixin
+@receiver(post_save, sender=Product)
+def product_changed(sender, instance, **kwargs):
+    invalidate(product_dependencies([(instance.pk, category_id) for category_id in instance.parent_ids()]))
+
+
+# The category of a product is known when the article holds it, as the admin serializers leave it.
+# Otherwise, after a move for instance, the products are looked up once per transaction when it commits
+@receiver(post_save, sender=Article)
+def article_changed(sender, instance, **kwargs):
+    products = instance.loaded_product_categories()
+    invalidate({'article', 'product'} | product_dependencies(products.items()))
+    pending = instance.parent_ids() - set(products)
+    if pending:
+        invalidate({f'product:{product_id}' for product_id in pending})
+        on_commit_batch('cache:products', invalidate_products, pending)
+
+
+def invalidate_products(product_ids):
+    replace_versions(product_dependencies(Product.objects.filter(pk__in=product_ids).values_list('pk', 'category_id')))
+
+
+@receiver(catalog_updated)
+def catalog_bulk_updated(sender, products=(), categories=(), **kwargs):
+    dependencies = set()
+    if sender is Category:
+        dependencies.add('category')
+        dependencies.update(f'category:{category_id}' for category_id in categories)
+    if sender in (Product, Article):
+        # Cascades and upserts change the articles of the listed products. The product lists are
+        # replaced even without any listed product, as after the bulk inserts of shop/factories.py
+        dependencies.update(product_dependencies(products))
+        dependencies.add('article')
+    invalidate(dependencies)
+
+
+class CachedResponseMixin:
+    """ Serves the public catalog responses from the catalog cache, keyed by path, query parameters,
+        authentication class and the versions of the rows they depend on """
+
+    # The list depends on the whole table, a detail on its own tree
+    def get_cache_dependencies(self):
+        if self.action == 'retrieve':
+            return [f'{self.basename}:{self.kwargs[self.lookup_field]}']
+        return [self.basename]
+
+    def get_cache_key(self, request):
+        authenticator = request.successful_authenticator
+        parts = [
+            request.path,
+            sorted(request.query_params.lists()),
+            authenticator.__class__.__name__ if authenticator else 'anonymous',
+            request.accepted_renderer.format,
+            get_versions(self.get_cache_dependencies()),
+        ]
+        return 'catalog:response:' + hashlib.md5(repr(parts).encode()).hexdigest()
+
+    def cached(self, handler, request, *args, **kwargs):
+        # A profiled request has to do the actual work, see shop/profiling.py
+        if not setting('ENABLED') or getattr(self, 'profiler', None):
+            return handler(request, *args, **kwargs)
+        cache = get_cache()
+        key = self.get_cache_key(request)
+        entry = cache.get(key)
+        if entry is not None:
+            status, content, headers = entry
+            last_modified = parse_http_date_safe(headers.get('Last-Modified', ''))
+            response = get_conditional_response(request, etag=headers.get('ETag'), last_modified=last_modified)
+            if response is None:
+                response = HttpResponse(content, status=status)
+            for header, value in headers.items():
+                response[header] = value
+            return response
+
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            # Stored once rendered, like Django's cache middleware does
+            def store(rendered):
+                headers = {header: rendered[header] for header in CACHED_HEADERS if rendered.has_header(header)}
+                cache.set(key, (rendered.status_code, rendered.content, headers), setting('TIMEOUT'))
+            if hasattr(response, 'add_post_render_callback'):
+                response.add_post_render_callback(store)
+            else:
+                # Already rendered, as the snapshots are
+                store(response)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached(super().retrieve, request, *args, **kwargs)
@@ -0,0 +1,103 @@
+import base64
+import binascii
+import json
+
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from shop.export import category_rows, product_rows, article_rows, serialize_row, format_datetime
+from shop.models import Category, Product, Article, CatalogTombstone
+from shop.signals import catalog_updated
+
+# Pages of /api/changes/. Each kind of row is a stream read in (date_updated, id) order, the deletes
+# another one in (date_deleted, id) order, so a page holds at most `limit` rows of each. The cursor of
+# the next page keeps the since/watermark window of the first one and the position reached in each stream.
+
+KINDS = [
+    ('categories', Category, category_rows),
+    ('products', Product, product_rows),
+    ('articles', Article, article_rows),
+]
+DELETED = 'deleted'
+END = 'end'
+TOMBSTONE_BATCH_SIZE = 5000
+
+
+# Deletes are reported once per table, see shop/models.py, their tombstones written by one bulk_create
+@receiver(catalog_updated)
+def rows_deleted(sender, deleted=(), **kwargs):
+    if not deleted:
+        return
+    kind = next(kind for kind, model, _ in KINDS if model is sender)
+    now = timezone.now()
+    tombstones = [CatalogTombstone(kind=kind, object_id=pk, date_deleted=now) for pk in deleted]
+    CatalogTombstone.objects.bulk_create(tombstones, batch_size=TOMBSTONE_BATCH_SIZE)
+
+
+def encode_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def decode_cursor(value):
+    """ (since, watermark, positions) of a next link, None when it's malformed """
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(value.encode()))
+        since = parse_datetime(cursor['since']) if cursor['since'] is not None else None
+        watermark = parse_datetime(cursor['watermark'])
+        positions = cursor['positions']
+        for position in positions.values():
+            if position not in (None, END) and (parse_datetime(position[0]) is None or not isinstance(position[1], int)):
+                return None
+    except (ValueError, TypeError, KeyError, IndexError, AttributeError, binascii.Error):
+        return None
+    if watermark is None or (cursor['since'] is not None and since is None):
+        return None
+    return since, watermark, positions
+
+
+def read_stream(queryset, date_field, fields, position, limit):
+    """ The keys of the next `limit` rows of a stream after position, and the position reached, END once read """
+    if position == END:
+        return [], END
+    if position is not None:
+        date, pk = parse_datetime(position[0]), position[1]
+        queryset = queryset.filter(Q(**{f'{date_field}__gt': date}) | Q(**{date_field: date, 'pk__gt': pk}))
+    keys = list(queryset.order_by(date_field, 'pk').values('pk', date_field, *fields)[:limit + 1])
+    if len(keys) <= limit:
+        return keys, END
+    keys = keys[:limit]
+    return keys, [format_datetime(keys[-1][date_field]), keys[-1]['pk']]
+
+
+def changes_page(since, watermark, positions, limit):
+    """ (data, positions of the next page, None after the last one) """
+    data = {'since': format_datetime(since) if since else None, 'watermark': format_datetime(watermark)}
+    reached = {}
+    for name, model, rows in KINDS:
+        queryset = model.objects.filter(date_updated__lte=watermark)
+        if since is not None:
+            queryset = queryset.filter(date_updated__gt=since)
+        else:
+            # The initial full sync only holds the active rows
+            queryset = queryset.filter(active=True)
+        keys, reached[name] = read_stream(queryset, 'date_updated', ['date_created', 'active'], positions.get(name),
+                                          limit)
+        created = [key['pk'] for key in keys if key['active'] and (since is None or key['date_created'] > since)]
+        updated = [key['pk'] for key in keys if key['active'] and since is not None and key['date_created'] <= since]
+        data[name] = {
+            'created': [serialize_row(row) for row in rows(model.objects.filter(pk__in=created))] if created else [],
+            'updated': [serialize_row(row) for row in rows(model.objects.filter(pk__in=updated))] if updated else [],
+            'deactivated': sorted(key['pk'] for key in keys if not key['active']),
+            'deleted': [],
+        }
+    if since is not None:
+        tombstones = CatalogTombstone.objects.filter(date_deleted__gt=since, date_deleted__lte=watermark)
+        keys, reached[DELETED] = read_stream(tombstones, 'date_deleted', ['kind', 'object_id'], positions.get(DELETED),
+                                             limit)
+        for key in keys:
+            data[key['kind']]['deleted'].append(key['object_id'])
+    if all(position == END for position in reached.values()):
+        return data, None
+    return data, reached
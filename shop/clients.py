@@ -0,0 +1,257 @@
+import asyncio
+import threading
+import time
+import weakref
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Defaults, each key can be overridden through settings.EXTERNAL_API
+DEFAULTS = {
+    'CONNECT_TIMEOUT': 3.05,              # seconds to open the connection
+    'READ_TIMEOUT': 5,                    # seconds to wait for the response
+    'RETRIES': 2,                         # retries on connection errors and RETRY_STATUSES
+    'BACKOFF_FACTOR': 0.3,                # sleeps 0.3s, 0.6s, 1.2s... between retries
+    'RETRY_STATUSES': (502, 503, 504),
+    'POOL_CONNECTIONS': 10,               # hosts kept in the pool
+    'POOL_MAXSIZE': 20,                   # keep-alive connections kept per host
+    'FAILURE_THRESHOLD': 5,               # consecutive failures opening the circuit
+    'RECOVERY_TIMEOUT': 30,               # seconds before a trial call is let through
+}
+
+
+class CircuitOpenError(requests.RequestException):
+    """ Raised without calling the upstream while its circuit is open """
+
+
+class CircuitBreaker:
+    """ Fails fast once an upstream looks down, then lets one trial call through
+        every recovery_timeout seconds until it answers again """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, recovery_timeout):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.recovery_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow_request(self):
+        with self.lock:
+            state = self.state
+            if state == self.HALF_OPEN:
+                # Only one trial call, the others keep failing fast until it answers
+                self.opened_at = time.monotonic()
+                return True
+            return state == self.CLOSED
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class ClientMetrics:
+    """ Per host call counters and latencies """
+
+    def __init__(self):
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def record(self, host, latency=None, error=False, short_circuited=False):
+        with self.lock:
+            metrics = self.hosts.setdefault(host, {
+                'requests': 0, 'errors': 0, 'short_circuited': 0, 'latency_total': 0.0, 'latency_max': 0.0,
+            })
+            if short_circuited:
+                metrics['short_circuited'] += 1
+                return
+            metrics['requests'] += 1
+            metrics['errors'] += int(error)
+            metrics['latency_total'] += latency
+            metrics['latency_max'] = max(metrics['latency_max'], latency)
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {host: dict(metrics) for host, metrics in self.hosts.items()}
+        for metrics in snapshot.values():
+            metrics['latency_avg'] = metrics['latency_total'] / metrics['requests'] if metrics['requests'] else 0
+        return snapshot
+
+
+class ExternalAPIClient:
+    """ Shared keep-alive session with timeouts, retries and a circuit breaker per host """
+
+    def __init__(self, **options):
+        self.options = {**DEFAULTS, **options}
+        self.timeout = (self.options['CONNECT_TIMEOUT'], self.options['READ_TIMEOUT'])
+        self.session = self.build_session()
+        self.breakers = {}
+        self.breakers_lock = threading.Lock()
+        self.metrics = ClientMetrics()
+
+    def build_session(self):
+        retry = Retry(
+            total=self.options['RETRIES'],
+            backoff_factor=self.options['BACKOFF_FACTOR'],
+            status_forcelist=self.options['RETRY_STATUSES'],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.options['POOL_CONNECTIONS'],
+            pool_maxsize=self.options['POOL_MAXSIZE'],
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def breaker(self, host):
+        with self.breakers_lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(self.options['FAILURE_THRESHOLD'], self.options['RECOVERY_TIMEOUT'])
+            return self.breakers[host]
+
+    # The breaker of the host of url, raising CircuitOpenError while it's open
+    def open_call(self, url):
+        host = urlsplit(url).netloc
+        breaker = self.breaker(host)
+        if not breaker.allow_request():
+            self.metrics.record(host, short_circuited=True)
+            raise CircuitOpenError(f'Circuit open for {host}')
+        return host, breaker
+
+    def close_call(self, host, breaker, start, failed):
+        if failed:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        self.metrics.record(host, time.monotonic() - start, error=failed)
+
+    def request(self, method, url, timeout=None, **kwargs):
+        host, breaker = self.open_call(url)
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+        except requests.RequestException:
+            self.close_call(host, breaker, start, failed=True)
+            raise
+        self.close_call(host, breaker, start, failed=response.status_code >= 500)
+        return response
+
+    def stats(self):
+        stats = self.metrics.snapshot()
+        for host, breaker in self.breakers.items():
+            stats.setdefault(host, {})['circuit'] = breaker.state
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncExternalAPIClient(ExternalAPIClient):
+    """ httpx counterpart of ExternalAPIClient for the async views, with the same options, retries
+        and circuit breakers. Its connections belong to the event loop it is first used from """
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.timeout = httpx.Timeout(self.options['READ_TIMEOUT'], connect=self.options['CONNECT_TIMEOUT'])
+
+    def build_session(self):
+        # Like the requests pool, connections beyond POOL_MAXSIZE are opened but not kept alive
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=self.options['POOL_MAXSIZE'])
+        return httpx.AsyncClient(limits=limits)
+
+    async def request(self, method, url, timeout=None, **kwargs):
+        host, breaker = self.open_call(url)
+        start = time.monotonic()
+        try:
+            response = await self.send(method, url, timeout or self.timeout, **kwargs)
+        except requests.RequestException:
+            self.close_call(host, breaker, start, failed=True)
+            raise
+        self.close_call(host, breaker, start, failed=response.status_code >= 500)
+        return response
+
+    async def send(self, method, url, timeout, **kwargs):
+        # The urllib3 Retry policy of the sync client: connection errors and RETRY_STATUSES are retried,
+        # the last answer is returned whatever its status. httpx errors are raised as their requests
+        # equivalents, so the callers handle both clients the same way
+        retries = self.options['RETRIES']
+        for attempt in range(retries + 1):
+            if attempt:
+                await asyncio.sleep(self.options['BACKOFF_FACTOR'] * 2 ** (attempt - 1))
+            try:
+                response = await self.session.request(method, url, timeout=timeout, **kwargs)
+            except httpx.TimeoutException as error:
+                if attempt == retries:
+                    raise requests.Timeout(str(error)) from error
+                continue
+            except httpx.TransportError as error:
+                if attempt == retries:
+                    raise requests.ConnectionError(str(error)) from error
+                continue
+            if response.status_code not in self.options['RETRY_STATUSES'] or attempt == retries:
+                return response
+
+    async def close(self):
+        await self.session.aclose()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """ Process wide client, built from settings.EXTERNAL_API on first use """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = ExternalAPIClient(**getattr(settings, 'EXTERNAL_API', {}))
+    return _client
+
+
+# One async client per event loop, an ASGI worker runs a single one
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """ Client of the running event loop, built from settings.EXTERNAL_API on first use """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncExternalAPIClient(**getattr(settings, 'EXTERNAL_API', {}))
+    return client
+
+
+def reset_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        # Their connections can only be closed from their own loop, they're left to the garbage collector
+        _async_clients.clear()
@@ -0,0 +1,210 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from shop.models import EcoscoreCacheEntry
+
+# Defaults, each key can be overridden through settings.ECOSCORE_CACHE
+DEFAULTS = {
+    'TTL': 24 * 60 * 60,       # seconds a fetched grade stays valid
+    'NEGATIVE_TTL': 10 * 60,   # seconds an upstream failure stays cached
+    'MAX_ENTRIES': 10000,      # least recently used entries are evicted above this size
+    'TOUCH_INTERVAL': 60,      # seconds between two last_used writes for the same entry
+    'STATS_CACHE': 'default',  # cache alias holding the hit/miss counters, see stats_cache()
+    'PREFETCH_WORKERS': 8,     # concurrent upstream calls when prefetching a page
+}
+
+STATS = ('hits', 'misses', 'negative_hits', 'evictions')
+
+# Sentinel telling a cache miss apart from a cached failure (None)
+MISSING = object()
+
+
+class EcoscoreCache:
+    """ Database backed cache, shared by all the workers, with TTL and LRU eviction """
+
+    def setting(self, name):
+        return getattr(settings, 'ECOSCORE_CACHE', {}).get(name, DEFAULTS[name])
+
+    def get(self, barcode):
+        now = timezone.now()
+        entry = EcoscoreCacheEntry.objects.filter(barcode=barcode, expires_at__gt=now).first()
+        if entry is None:
+            self.incr('misses')
+            return MISSING
+        # Refreshing the LRU position without writing on every single read
+        if entry.last_used < now - timedelta(seconds=self.setting('TOUCH_INTERVAL')):
+            EcoscoreCacheEntry.objects.filter(pk=entry.pk).update(last_used=now)
+        self.incr('hits' if entry.grade is not None else 'negative_hits')
+        return entry.grade
+
+    def set(self, barcode, grade):
+        now = timezone.now()
+        ttl = self.setting('TTL') if grade is not None else self.setting('NEGATIVE_TTL')
+        values = {'grade': grade, 'expires_at': now + timedelta(seconds=ttl), 'last_used': now}
+        # Single statements rather than update_or_create, whose SELECT then write transaction
+        # fails at once on SQLite when concurrent workers store grades
+        if not EcoscoreCacheEntry.objects.filter(barcode=barcode).update(**values):
+            try:
+                with transaction.atomic():
+                    EcoscoreCacheEntry.objects.create(barcode=barcode, **values)
+            except IntegrityError:
+                # Stored meanwhile by another worker
+                EcoscoreCacheEntry.objects.filter(barcode=barcode).update(**values)
+        self.evict()
+
+    def get_many(self, barcodes):
+        """ Returns {barcode: grade} for every cached barcode, in a single query """
+        now = timezone.now()
+        entries = list(EcoscoreCacheEntry.objects.filter(barcode__in=barcodes, expires_at__gt=now))
+        touch_before = now - timedelta(seconds=self.setting('TOUCH_INTERVAL'))
+        stale = [entry.pk for entry in entries if entry.last_used < touch_before]
+        if stale:
+            EcoscoreCacheEntry.objects.filter(pk__in=stale).update(last_used=now)
+        grades = {entry.barcode: entry.grade for entry in entries}
+        negative = sum(1 for grade in grades.values() if grade is None)
+        self.incr('hits', len(grades) - negative)
+        self.incr('negative_hits', negative)
+        self.incr('misses', len(set(barcodes)) - len(grades))
+        return grades
+
+    @transaction.atomic
+    def set_many(self, grades):
+        if not grades:
+            return
+        now = timezone.now()
+        by_grade = {}
+        for barcode, grade in grades.items():
+            by_grade.setdefault(grade, []).append(barcode)
+        values = {
+            grade: {
+                'grade': grade,
+                'expires_at': now + timedelta(seconds=self.setting('TTL' if grade is not None else 'NEGATIVE_TTL')),
+                'last_used': now,
+            }
+            for grade in by_grade
+        }
+        # The barcodes already stored, expired or by a concurrent request prefetching the same page,
+        # are skipped by the insert rather than failing it, then take the new grades
+        EcoscoreCacheEntry.objects.bulk_create([
+            EcoscoreCacheEntry(barcode=barcode, **values[grade]) for barcode, grade in grades.items()
+        ], ignore_conflicts=True)
+        for grade, barcodes in by_grade.items():
+            EcoscoreCacheEntry.objects.filter(barcode__in=barcodes).update(**values[grade])
+        self.evict()
+
+    def get_or_fetch(self, barcode, fetch):
+        grade = self.get(barcode)
+        if grade is MISSING:
+            grade = fetch()
+            self.set(barcode, grade)
+        return grade
+
+    def evict(self):
+        excess = EcoscoreCacheEntry.objects.count() - self.setting('MAX_ENTRIES')
+        if excess <= 0:
+            return
+        oldest = EcoscoreCacheEntry.objects.order_by('last_used').values_list('pk', flat=True)[:excess]
+        EcoscoreCacheEntry.objects.filter(pk__in=list(oldest)).delete()
+        self.incr('evictions', excess)
+
+    def clear(self):
+        EcoscoreCacheEntry.objects.all().delete()
+
+    # Counters live in a Django cache. With the default LocMemCache they are per process, so the stats
+    # only cover the worker answering the request. STATS_CACHE has to name a cache shared by the workers
+    # (Memcached, Redis...) for them to cover every worker. The entries themselves are always shared
+    def stats_cache(self):
+        return caches[self.setting('STATS_CACHE')]
+
+    def incr(self, name, delta=1):
+        if not delta:
+            return
+        key = f'ecoscore:{name}'
+        cache = self.stats_cache()
+        cache.add(key, 0, timeout=None)
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # The key was evicted in between, starting over
+            cache.set(key, delta, timeout=None)
+
+    def stats(self):
+        cache = self.stats_cache()
+        stats = {name: cache.get(f'ecoscore:{name}', 0) for name in STATS}
+        lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['hits'] + stats['negative_hits']) / lookups if lookups else 0
+        stats['entries'] = EcoscoreCacheEntry.objects.count()
+        return stats
+
+    def reset_stats(self):
+        self.stats_cache().delete_many([f'ecoscore:{name}' for name in STATS])
+
+
+ecoscore_cache = EcoscoreCache()
+
+
+def pending_ecoscores(products):
+    """ The products whose ecoscore is neither stored nor prefetched, and one of them per barcode """
+    pending = [product for product in products
+               if product.ecoscore_fetched_at is None and '_prefetched_ecoscore' not in product.__dict__]
+    by_barcode = {}
+    for product in pending:
+        by_barcode.setdefault(product.ecoscore_barcode, product)
+    return pending, by_barcode
+
+
+def prefetch_ecoscores(products):
+    """ Resolves the ecoscore of every product at once before serialization:
+        one cache query, then the missing grades are fetched concurrently
+        so a cold page costs about one upstream round trip """
+    pending, by_barcode = pending_ecoscores(products)
+    if not pending:
+        return
+
+    grades = ecoscore_cache.get_many(list(by_barcode))
+    missing = [barcode for barcode in by_barcode if barcode not in grades]
+    if missing:
+        workers = min(len(missing), ecoscore_cache.setting('PREFETCH_WORKERS'))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Each call runs in a copy of the request context, so its time is reported to the instrumentation
+            futures = [executor.submit(copy_context().run, by_barcode[barcode].fetch_ecoscore) for barcode in missing]
+            fetched = {barcode: future.result() for barcode, future in zip(missing, futures)}
+        ecoscore_cache.set_many(fetched)
+        grades.update(fetched)
+
+    for product in pending:
+        product._prefetched_ecoscore = grades[product.ecoscore_barcode]
+
+
+async def aprefetch_ecoscores(products):
+    """ prefetch_ecoscores for the async views: the cache queries run in a thread,
+        the missing grades are fetched on the event loop without holding one """
+    pending, by_barcode = pending_ecoscores(products)
+    if not pending:
+        return
+
+    grades = await sync_to_async(ecoscore_cache.get_many)(list(by_barcode))
+    missing = [barcode for barcode in by_barcode if barcode not in grades]
+    if missing:
+        # Bounded like the thread pool of prefetch_ecoscores
+        semaphore = asyncio.Semaphore(ecoscore_cache.setting('PREFETCH_WORKERS'))
+
+        async def fetch(product):
+            async with semaphore:
+                return await product.afetch_ecoscore()
+
+        results = await asyncio.gather(*(fetch(by_barcode[barcode]) for barcode in missing))
+        fetched = dict(zip(missing, results))
+        await sync_to_async(ecoscore_cache.set_many)(fetched)
+        grades.update(fetched)
+
+    for product in pending:
+        product._prefetched_ecoscore = grades[product.ecoscore_barcode]
@@ -0,0 +1,93 @@
+import csv
+import json
+
+from shop.models import Category, Product, Article
+
+CHUNK_SIZE = 2000
+
+COLUMNS = ['type', 'id', 'parent_id', 'name', 'description', 'active', 'price', 'ecoscore',
+           'date_created', 'date_updated']
+
+
+# Same notations as the API serializers
+def format_datetime(value):
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def format_price(value):
+    return f'{value:.2f}'
+
+
+def catalog_querysets(active=True, category_id=None):
+    """ Categories, products and articles to export, active=None exporting both states """
+    categories = Category.objects.all()
+    products = Product.objects.all()
+    articles = Article.objects.all()
+    if active is not None:
+        categories = categories.filter(active=active)
+        products = products.filter(active=active)
+        articles = articles.filter(active=active)
+    if category_id is not None:
+        categories = categories.filter(pk=category_id)
+        products = products.filter(category_id=category_id)
+        articles = articles.filter(product__category_id=category_id)
+    return categories, products, articles
+
+
+FIELDS = ['id', 'name', 'description', 'active', 'date_created', 'date_updated']
+
+
+# One dict per row, reading the database chunk_size rows at a time so memory stays flat
+def category_rows(queryset, chunk_size=CHUNK_SIZE):
+    for row in queryset.order_by('pk').values(*FIELDS).iterator(chunk_size=chunk_size):
+        yield {'type': 'category', 'parent_id': None, **row}
+
+
+def product_rows(queryset, chunk_size=CHUNK_SIZE):
+    # Stored ecoscore only, an export never calls the external API
+    for row in queryset.order_by('pk').values(*FIELDS, 'category_id', 'ecoscore_grade').iterator(chunk_size=chunk_size):
+        row['parent_id'] = row.pop('category_id')
+        row['ecoscore'] = row.pop('ecoscore_grade')
+        yield {'type': 'product', **row}
+
+
+def article_rows(queryset, chunk_size=CHUNK_SIZE):
+    for row in queryset.order_by('pk').values(*FIELDS, 'product_id', 'price').iterator(chunk_size=chunk_size):
+        row['parent_id'] = row.pop('product_id')
+        row['price'] = format_price(row['price'])
+        yield {'type': 'article', **row}
+
+
+def iter_rows(active=True, category_id=None, chunk_size=CHUNK_SIZE):
+    categories, products, articles = catalog_querysets(active, category_id)
+    yield from category_rows(categories, chunk_size)
+    yield from product_rows(products, chunk_size)
+    yield from article_rows(articles, chunk_size)
+
+
+def serialize_row(row):
+    row['date_created'] = format_datetime(row['date_created'])
+    row['date_updated'] = format_datetime(row['date_updated'])
+    return row
+
+
+def iter_ndjson(rows):
+    for row in rows:
+        yield json.dumps(serialize_row(row), ensure_ascii=False) + '\n'
+
+
+class Echo:
+    """ File-like object handing back what csv.writer writes, instead of buffering it """
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows):
+    writer = csv.DictWriter(Echo(), fieldnames=COLUMNS)
+    yield writer.writerow(dict(zip(COLUMNS, COLUMNS)))
+    for row in rows:
+        yield writer.writerow(serialize_row(row))
@@ -0,0 +1,91 @@
+import random
+import re
+from decimal import Decimal
+
+from django.db import transaction
+
+from shop.models import Category, Product, Article, CategorySnapshot, send_deleted
+from shop.signals import catalog_updated
+
+WORDS = ['frais', 'bio', 'local', 'de saison', 'extra', 'sélection', 'terroir', 'doux', 'croquant', 'juteux']
+
+
+def bulk_insert(model, objects, batch_size):
+    """ bulk_create returning the new primary keys in insertion order, also on backends
+        which don't set them on the objects (SQLite with Django 3.2) """
+    last_pk = model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    model.objects.bulk_create(objects, batch_size=batch_size)
+    if objects and objects[0].pk is not None:
+        return [obj.pk for obj in objects]
+    return list(model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True))
+
+
+def first_category_index():
+    """ The index following those of the generated categories already stored, category names being unique """
+    names = Category.objects.filter(name__startswith='Catégorie ').values_list('name', flat=True)
+    indexes = [int(match.group(1)) for match in map(re.compile(r'Catégorie (\d+)$').match, names) if match]
+    return max(indexes, default=-1) + 1
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+@transaction.atomic
+def clear_catalog():
+    """ Empties the catalog for a reseed: its ids are read in a query per table, then each table
+        is emptied by one DELETE, and the deletes are reported per table as the queryset ones are """
+    notifications = Category.objects.all().deleted_rows()
+    # Parents first, the foreign keys are only checked at commit and the search triggers
+    # then find no product to index again for each deleted article
+    for model in [CategorySnapshot, Category, Product, Article]:
+        model.objects.all()._raw_delete(model.objects.db)
+    send_deleted(notifications)
+
+
+@transaction.atomic
+def generate_catalog(categories, products, articles, seed=0, active_ratio=0.9, batch_size=5000):
+    """ Creates categories x products x articles rows with bulk_create, the same seed giving the same catalog.
+        Each row is active with active_ratio probability, rows under an inactive parent are inactive too.
+        Usable as a fixture factory from the tests, returns the number of rows created per model.
+        Another call adds a catalog numbered after the existing one """
+    rng = random.Random(seed)
+
+    def description():
+        return ' '.join(rng.sample(WORDS, 3))
+
+    first = first_category_index()
+    category_states = [rng.random() < active_ratio for _ in range(categories)]
+    category_ids = bulk_insert(Category, [
+        Category(name=f'Catégorie {index}', description=f'Catégorie {index} {description()}', active=active)
+        for index, active in enumerate(category_states, first)
+    ], batch_size)
+
+    # Products are created batch by batch, each batch followed by its articles, so memory stays bounded
+    parents = [
+        (category_id, category_active, f'Produit {category_index}-{index}')
+        for category_index, (category_id, category_active) in enumerate(zip(category_ids, category_states), first)
+        for index in range(products)
+    ]
+    product_count = article_count = 0
+    for batch in chunks(parents, max(1, batch_size // max(1, articles))):
+        product_states = [category_active and rng.random() < active_ratio for _, category_active, _ in batch]
+        product_ids = bulk_insert(Product, [
+            Product(name=name, description=description(), active=active, category_id=category_id)
+            for (category_id, _, name), active in zip(batch, product_states)
+        ], batch_size)
+        Article.objects.bulk_create([
+            Article(name=f'Article {index}', description=description(),
+                    active=product_active and rng.random() < active_ratio,
+                    price=Decimal(rng.randint(100, 9999)) / 100, product_id=product_id)
+            for product_id, product_active in zip(product_ids, product_states)
+            for index in range(articles)
+        ], batch_size=batch_size)
+        product_count += len(product_ids)
+        article_count += len(product_ids) * articles
+
+    # bulk_create skips post_save, the response cache still has to drop its lists
+    catalog_updated.send(sender=Category, products=[], categories=[])
+    catalog_updated.send(sender=Product, products=[])
+    return {'categories': len(category_ids), 'products': product_count, 'articles': article_count}
@@ -0,0 +1,171 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import ISO_8601
+from rest_framework.fields import BooleanField, CharField, DateTimeField, DecimalField, IntegerField
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from shop.ecoscore import prefetch_ecoscores
+from shop.export import format_datetime
+from shop.instrumentation import timed
+from shop.models import Product
+from shop.prices import PRICE_FIELDS, price_stats_for
+from shop.serializers import ArticleSerializer, CategoryListSerializer, ProductListSerializer
+
+
+def compile_datetime(field):
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    # values() returns UTC datetimes, already in the output timezone
+    if output_format == ISO_8601 and settings.USE_TZ and settings.TIME_ZONE == 'UTC':
+        return format_datetime
+    return field.to_representation
+
+
+def compile_decimal(field):
+    coerce_to_string = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+    if coerce_to_string and field.decimal_places is not None and not field.localize:
+        template = f'{{:.{field.decimal_places}f}}'
+        return template.format
+    return field.to_representation
+
+
+class RowSerializer:
+    """ Maps values() rows to the output of serializer_class without building model instances.
+        The converters are compiled once from the serializer fields, so both stay in sync,
+        and a field the row serializer can't reproduce is a configuration error """
+    serializer_class = None
+    # Output keys which aren't columns, filled in by to_representation
+    computed = ()
+
+    def __init__(self):
+        self.fields = []
+        for name, field in self.serializer_class().fields.items():
+            if field.write_only:
+                continue
+            self.fields.append((name, *self.compile_field(name, field)))
+        self.names = {name for name, _, _ in self.fields}
+
+    def compile_field(self, name, field):
+        """ (column, converter) of a field, converter being None when the value is output as is """
+        # Computed values are put in the rows under their output name
+        column = name if name in self.computed else field.source
+        if isinstance(field, PrimaryKeyRelatedField):
+            return f'{field.source}_id', None
+        if isinstance(field, DateTimeField):
+            return column, compile_datetime(field)
+        if isinstance(field, DecimalField):
+            return column, compile_decimal(field)
+        if name in self.computed or isinstance(field, (CharField, IntegerField, BooleanField)):
+            return column, None
+        raise ImproperlyConfigured(f'{self.__class__.__name__} can not serialize the {name} field')
+
+    def can_serialize(self, fields):
+        return all(name in self.names for name in fields)
+
+    # Compiled fields of a sparse fieldset, all of them without one
+    def select(self, fields=None):
+        if not fields:
+            return self.fields
+        return [field for field in self.fields if field[0] in fields]
+
+    def get_columns(self, fields=None):
+        columns = [column for name, column, _ in self.select(fields) if name not in self.computed]
+        # The keyset pagination reads the position of the last row
+        if 'id' not in columns:
+            columns.append('id')
+        return columns
+
+    def get_queryset(self, queryset, fields=None):
+        return queryset.values(*self.get_columns(fields))
+
+    def to_representation(self, rows, fields=None):
+        selected = self.select(fields)
+        with timed('serialize'):
+            return [self.convert(row, selected) for row in rows]
+
+    def convert(self, row, fields):
+        item = {}
+        for name, column, converter in fields:
+            value = row[column]
+            # None is output as is, like the serializer fields do
+            item[name] = value if converter is None or value is None else converter(value)
+        return item
+
+
+class PriceStatsRowMixin:
+    """ Adds the price aggregates of the rows, in one query for the whole page """
+    computed = PRICE_FIELDS
+
+    def to_representation(self, rows, fields=None):
+        if fields and not any(name in fields for name in PRICE_FIELDS):
+            return super().to_representation(rows, fields)
+        rows = list(rows)
+        stats = price_stats_for(self.serializer_class.Meta.model, [row['id'] for row in rows])
+        for row in rows:
+            row.update(stats[row['id']])
+        return super().to_representation(rows, fields)
+
+
+class CategoryRowSerializer(PriceStatsRowMixin, RowSerializer):
+    serializer_class = CategoryListSerializer
+
+
+class ArticleRowSerializer(RowSerializer):
+    serializer_class = ArticleSerializer
+
+
+class ProductRowSerializer(PriceStatsRowMixin, RowSerializer):
+    serializer_class = ProductListSerializer
+    computed = ('ecoscore', *PRICE_FIELDS)
+
+    def get_columns(self, fields=None):
+        columns = super().get_columns(fields)
+        if fields and 'ecoscore' not in fields:
+            return columns
+        return columns + ['barcode', 'ecoscore_grade', 'ecoscore_fetched_at']
+
+    def to_representation(self, rows, fields=None):
+        if fields and 'ecoscore' not in fields:
+            return super().to_representation(rows, fields)
+        rows = list(rows)
+        # Stored grades are read from the row, the others go through the ecoscore cache like Product.ecoscore,
+        # with one unsaved product per barcode
+        products = {}
+        for row in rows:
+            if row['ecoscore_fetched_at'] is None and row['barcode'] not in products:
+                products[row['barcode']] = Product(pk=row['id'], barcode=row['barcode'])
+        prefetch_ecoscores(list(products.values()))
+        for row in rows:
+            if row['ecoscore_fetched_at'] is None:
+                row['ecoscore'] = products[row['barcode']].ecoscore
+            else:
+                row['ecoscore'] = row['ecoscore_grade']
+        return super().to_representation(rows, fields)
+
+
+class RowSerializerMixin:
+    """ Serves the list action from values() rows through row_serializer_class when
+        settings.CATALOG_FAST_LIST is set, with the same output as serializer_class """
+    row_serializer_class = None
+
+    # Compiled once per class
+    @classmethod
+    def get_row_serializer(cls):
+        if '_row_serializer' not in cls.__dict__:
+            cls._row_serializer = cls.row_serializer_class()
+        return cls._row_serializer
+
+    def list(self, request, *args, **kwargs):
+        if self.row_serializer_class is None or not getattr(settings, 'CATALOG_FAST_LIST', False):
+            return super().list(request, *args, **kwargs)
+        row_serializer = self.get_row_serializer()
+        # Sparse fieldsets of the row fields, expansions and unknown fields are left to the serializers
+        fields, expand, _ = self.get_fieldset() if hasattr(self, 'get_fieldset') else ({}, {}, {})
+        if expand or not row_serializer.can_serialize(fields):
+            return super().list(request, *args, **kwargs)
+        queryset = row_serializer.get_queryset(self.filter_queryset(self.get_queryset()), fields)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(row_serializer.to_representation(page, fields))
+        return Response(row_serializer.to_representation(queryset, fields))
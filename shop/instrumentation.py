@@ -0,0 +1,58 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Metrics of the request being served, None when the instrumentation is disabled
+current_metrics = ContextVar('current_metrics', default=None)
+
+# Names of the timed blocks running in the current context. The threads and tasks started with a copy
+# of the context see the blocks around them, but not the ones running in their siblings
+running_timers = ContextVar('running_timers', default=frozenset())
+
+
+class RequestMetrics:
+    """ Time spent per component during one request, in seconds """
+
+    def __init__(self, keep_sql=False):
+        self.durations = {}
+        self.counts = {}
+        self.keep_sql = keep_sql
+        self.queries = []
+        # Ecoscores are prefetched from worker threads
+        self.lock = threading.Lock()
+
+    def add(self, name, duration, count=1):
+        with self.lock:
+            self.durations[name] = self.durations.get(name, 0) + duration
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    # Hooked with connection.execute_wrapper on every database connection
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.add('db', duration)
+            if self.keep_sql:
+                with self.lock:
+                    self.queries.append({'sql': sql, 'ms': round(duration * 1000, 3)})
+
+
+@contextmanager
+def timed(name):
+    """ Adds the time spent in the block to the current request metrics, if any.
+        Nested blocks of the same name are only counted once, concurrent ones each count """
+    metrics = current_metrics.get()
+    running = running_timers.get()
+    if metrics is None or name in running:
+        yield
+        return
+    token = running_timers.set(running | {name})
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        running_timers.reset(token)
+        metrics.add(name, time.perf_counter() - start)
@@ -0,0 +1,68 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from shop.benchmarks import SIZES, LATENCY_TOLERANCE, run_benchmarks, compare, serialization_throughput
+
+BASELINE = Path(__file__).resolve().parent.parent.parent / 'benchmark_baseline.json'
+
+
+class Command(BaseCommand):
+
+    help = 'Benchmark every API endpoint against seeded datasets and check the budgets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='small,medium',
+                            help=f"Comma separated dataset sizes among {', '.join(SIZES)}")
+        parser.add_argument('--repeat', type=int, default=10, help='Requests per endpoint')
+        parser.add_argument('--output', default='benchmark_results.json', help='Results written as JSON')
+        parser.add_argument('--baseline', default=str(BASELINE))
+        parser.add_argument('--latency-tolerance', type=float, default=LATENCY_TOLERANCE)
+        parser.add_argument('--update-baseline', action='store_true',
+                            help='Write the results as the new baseline instead of checking them')
+        parser.add_argument('--throughput', action='store_true',
+                            help='Also compare the rows per second of the serializers and of the values() read path')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.MIGRATE_HEADING(self.help))
+
+        sizes = options['sizes'].split(',')
+        unknown = set(sizes) - set(SIZES)
+        if unknown:
+            raise CommandError(f"Unknown sizes: {', '.join(sorted(unknown))}")
+
+        # Seeding a throwaway database, like the test runner does
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = run_benchmarks(sizes, options['repeat'])
+            throughput = {size: serialization_throughput(size) for size in sizes} if options['throughput'] else {}
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        Path(options['output']).write_text(json.dumps(results, indent=2))
+        for size, endpoints in results.items():
+            for endpoint, measures in endpoints.items():
+                self.stdout.write(f"{size:8} {endpoint:28} {measures['queries']:4} queries "
+                                  f"{measures['external_calls']:3} calls  p50 {measures['p50_ms']:8.2f}ms  "
+                                  f"p95 {measures['p95_ms']:8.2f}ms")
+        for size, serializers in throughput.items():
+            for name, measures in serializers.items():
+                self.stdout.write(f"{size:8} {name + ' rows':28} {measures['rows']:6} rows  "
+                                  f"serializer {measures['serializer_rows_per_second']:8}/s  "
+                                  f"values() {measures['values_rows_per_second']:8}/s  x{measures['speedup']}")
+
+        if options['update_baseline']:
+            Path(options['baseline']).write_text(json.dumps(results, indent=2) + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Baseline written to {options['baseline']}"))
+            return
+
+        baseline = json.loads(Path(options['baseline']).read_text())
+        violations = compare(results, baseline, options['latency_tolerance'])
+        if violations:
+            raise CommandError('Budgets exceeded:\n' + '\n'.join(violations))
+        self.stdout.write(self.style.SUCCESS("All Done !"))
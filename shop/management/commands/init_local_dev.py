@@ -2,6 +2,7 @@ from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
 
 from shop.models import Category
+from shop.factories import clear_catalog, generate_catalog
 
 UserModel = get_user_model()
 
@@ -109,22 +110,39 @@ class Command(BaseCommand):
 
     help = 'Initialize project for local development'
 
+    def add_arguments(self, parser):
+        # Synthetic catalog for load testing, instead of the CATEGORIES tree
+        parser.add_argument('--categories', type=int, help='Number of synthetic categories')
+        parser.add_argument('--products', type=int, default=10, help='Products per synthetic category')
+        parser.add_argument('--articles', type=int, default=5, help='Articles per synthetic product')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--active-ratio', type=float, default=0.9)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
     def handle(self, *args, **options):
         self.stdout.write(self.style.MIGRATE_HEADING(self.help))
 
-        Category.objects.all().delete()
+        clear_catalog()
 
-        for data_category in CATEGORIES:
-            category = Category.objects.create(name=data_category['name'],
-                                               active=data_category['active'])
-            for data_product in data_category['products']:
-                product = category.products.create(name=data_product['name'],
-                                                   active=data_product['active'])
-                for data_article in data_product['articles']:
-                    product.articles.create(name=data_article['name'],
-                                            active=data_article['active'],
-                                            price=data_article['price'])
+        if options['categories'] is not None:
+            counts = generate_catalog(options['categories'], options['products'], options['articles'],
+                                      seed=options['seed'], active_ratio=options['active_ratio'],
+                                      batch_size=options['batch_size'])
+            self.stdout.write(f"Generated {counts['categories']} categories, {counts['products']} products "
+                              f"and {counts['articles']} articles")
+        else:
+            for data_category in CATEGORIES:
+                category = Category.objects.create(name=data_category['name'],
+                                                   active=data_category['active'])
+                for data_product in data_category['products']:
+                    product = category.products.create(name=data_product['name'],
+                                                       active=data_product['active'])
+                    for data_article in data_product['articles']:
+                        product.articles.create(name=data_article['name'],
+                                                active=data_article['active'],
+                                                price=data_article['price'])
 
-        UserModel.objects.create_superuser(ADMIN_ID, 'admin@oc.drf', ADMIN_PASSWORD)
+        if not UserModel.objects.filter(username=ADMIN_ID).exists():
+            UserModel.objects.create_superuser(ADMIN_ID, 'admin@oc.drf', ADMIN_PASSWORD)
 
         self.stdout.write(self.style.SUCCESS("All Done !"))
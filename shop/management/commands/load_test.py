@@ -0,0 +1,51 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from shop.benchmarks import load_test
+
+
+class Command(BaseCommand):
+
+    help = 'Compare the WSGI and ASGI throughput of the product details under a slow ecoscore upstream'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100, help='Requests per server, one product each')
+        parser.add_argument('--latency', type=float, default=0.2, help='Seconds the stub upstream waits before answering')
+        parser.add_argument('--threads', type=int, default=8, help='Threads of the WSGI worker')
+        parser.add_argument('--output', help='Results written as JSON')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.MIGRATE_HEADING(self.help))
+
+        # A throwaway database, on disk so the threads of both servers share it
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        old_test_name = test_settings.get('NAME')
+        if connection.vendor == 'sqlite':
+            directory = tempfile.mkdtemp()
+            test_settings['NAME'] = os.path.join(directory, 'load_test.sqlite3')
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = load_test(options['requests'], options['latency'], options['threads'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            test_settings['NAME'] = old_test_name
+
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(results, indent=2))
+        for server in ('wsgi', 'asgi'):
+            measures = results[server]
+            self.stdout.write(f"{server}  {measures['requests']} requests, {measures['concurrency']:3} concurrent  "
+                              f"{measures['requests_per_second']:8.1f} req/s  p50 {measures['p50_ms']:8.2f}ms  "
+                              f"p95 {measures['p95_ms']:8.2f}ms  {measures['errors']} errors")
+        self.stdout.write(f"{results['upstream_calls']} upstream calls, "
+                          f"x{results['asgi']['requests_per_second'] / results['wsgi']['requests_per_second']:.1f} "
+                          f"throughput on ASGI")
+        self.stdout.write(self.style.SUCCESS("All Done !"))
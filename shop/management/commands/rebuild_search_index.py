@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from shop.search import INDEX_TABLE, install_index
+
+
+class Command(BaseCommand):
+
+    help = 'Rebuild the product search index and its triggers, after a migration remaking the catalog tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.MIGRATE_HEADING(self.help))
+
+        connection = connections[options['database']]
+        if connection.vendor != 'sqlite':
+            self.stdout.write(f'No search index on {connection.vendor}, the search goes without it')
+            return
+        with transaction.atomic(using=options['database']):
+            install_index(connection)
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {INDEX_TABLE}')
+            self.stdout.write(f'{cursor.fetchone()[0]} products indexed')
+        self.stdout.write(self.style.SUCCESS("All Done !"))
@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from shop.models import Category, CategorySnapshot
+from shop.snapshots import render_snapshot, store_snapshot
+
+
+class Command(BaseCommand):
+
+    help = 'Rebuild the category snapshots, after a bulk import for instance'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Categories built concurrently, each worker using its own database connection')
+        parser.add_argument('--category', type=int, action='append', dest='categories',
+                            help='Only rebuild this category, can be repeated')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.MIGRATE_HEADING(self.help))
+
+        queryset = Category.objects.filter(active=True)
+        if options['categories']:
+            queryset = queryset.filter(pk__in=options['categories'])
+        category_ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+        # Inactive categories are not served, their snapshots can go
+        removed, _ = CategorySnapshot.objects.exclude(category__active=True).delete()
+
+        # Rendered in parallel, then stored from here in one transaction, so the writes don't contend
+        def render(pk):
+            try:
+                return render_snapshot(pk)
+            finally:
+                connections.close_all()
+
+        if options['workers'] > 1:
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                renders = list(executor.map(render, category_ids))
+        else:
+            renders = [render_snapshot(pk) for pk in category_ids]
+        with transaction.atomic():
+            built = sum(store_snapshot(pk, rendered) is not None for pk, rendered in zip(category_ids, renders))
+
+        self.stdout.write(f'Built {built} snapshots, removed {removed} inactive ones')
+        self.stdout.write(self.style.SUCCESS("All Done !"))
@@ -0,0 +1,99 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+from requests import RequestException
+
+from shop.models import Product
+from shop.signals import catalog_updated
+
+
+class RateLimiter:
+    """ Spaces out upstream calls so that at most `rate` of them start every second """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Command(BaseCommand):
+
+    help = 'Refresh the stored ecoscore of stale products'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=float, default=24,
+                            help='Hours after which a stored ecoscore is considered stale')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Concurrent calls to OpenFoodFacts')
+        parser.add_argument('--rate', type=float, default=10,
+                            help='Maximum calls per second, 0 disables the limit')
+        parser.add_argument('--start-after', type=int, default=0,
+                            help='Resume after this product id, as printed by a previous run')
+        parser.add_argument('--include-inactive', action='store_true')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.MIGRATE_HEADING(self.help))
+
+        limiter = RateLimiter(options['rate'])
+        stale_before = timezone.now() - timedelta(hours=options['max_age'])
+        queryset = Product.objects.filter(Q(ecoscore_fetched_at__isnull=True) | Q(ecoscore_fetched_at__lt=stale_before))
+        if not options['include_inactive']:
+            queryset = queryset.filter(active=True)
+        queryset = queryset.order_by('id').only('id', 'category_id', 'barcode', 'ecoscore_grade', 'ecoscore_fetched_at')
+
+        last_id = options['start_after']
+        refreshed = failed = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                batch = list(queryset.filter(id__gt=last_id)[:options['batch_size']])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                # Products sharing a barcode only cost one call
+                by_barcode = {}
+                for product in batch:
+                    by_barcode.setdefault(product.ecoscore_barcode, product)
+
+                def fetch(barcode):
+                    limiter.wait()
+                    try:
+                        return barcode, by_barcode[barcode].request_ecoscore(), True
+                    except RequestException:
+                        return barcode, None, False
+
+                results = {barcode: (grade, ok) for barcode, grade, ok in executor.map(fetch, list(by_barcode))}
+
+                now = timezone.now()
+                updated = []
+                for product in batch:
+                    grade, ok = results[product.ecoscore_barcode]
+                    if not ok:
+                        # Left stale, a later run will try again
+                        failed += 1
+                        continue
+                    product.ecoscore_grade = grade
+                    product.ecoscore_fetched_at = now
+                    product.date_updated = now
+                    updated.append(product)
+                Product.objects.bulk_update(updated, ['ecoscore_grade', 'ecoscore_fetched_at', 'date_updated'])
+                catalog_updated.send(sender=Product, products=[(product.pk, product.category_id) for product in updated])
+                refreshed += len(updated)
+
+                self.stdout.write(f'Refreshed {refreshed} products, {failed} failures, last id {last_id}')
+
+        self.stdout.write(self.style.SUCCESS("All Done !"))
@@ -0,0 +1,83 @@
+import json
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from shop.instrumentation import RequestMetrics, current_metrics
+
+logger = logging.getLogger('shop.performance')
+slow_logger = logging.getLogger('shop.performance.slow')
+
+# Defaults, each key can be overridden through settings.PERFORMANCE_INSTRUMENTATION
+DEFAULTS = {
+    'ENABLED': False,
+    'SLOW_REQUEST_MS': 500,  # requests slower than this are logged with their SQL
+}
+
+# Server-Timing entries, in this order
+COMPONENTS = [
+    ('auth', 'Authentication'),
+    ('db', 'Database'),
+    ('external', 'External API'),
+    ('serialize', 'Serialization'),
+]
+
+
+class PerformanceMiddleware:
+    """ Times the database, external calls, serialization and authentication of each request,
+        reported in a Server-Timing header and a structured log line. Removed from the
+        middleware chain when PERFORMANCE_INSTRUMENTATION['ENABLED'] is false """
+
+    def __init__(self, get_response):
+        self.options = {**DEFAULTS, **getattr(settings, 'PERFORMANCE_INSTRUMENTATION', {})}
+        if not self.options['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics(keep_sql=self.options['SLOW_REQUEST_MS'] is not None)
+        token = current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics.record_query))
+                response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        total = time.perf_counter() - start
+
+        response['Server-Timing'] = self.server_timing(metrics, total)
+        line = self.log_line(request, response, metrics, total)
+        logger.info(json.dumps(line))
+        slow = self.options['SLOW_REQUEST_MS']
+        if slow is not None and line['total_ms'] >= slow:
+            slow_logger.warning(json.dumps({**line, 'sql': metrics.queries}))
+        return response
+
+    def server_timing(self, metrics, total):
+        entries = []
+        for name, description in COMPONENTS:
+            if name in metrics.durations:
+                count = metrics.counts[name]
+                if name in ('db', 'external'):
+                    description = f'{description} ({count})'
+                entries.append(f'{name};dur={metrics.durations[name] * 1000:.2f};desc="{description}"')
+        entries.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(entries)
+
+    def log_line(self, request, response, metrics, total):
+        line = {
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 3),
+        }
+        for name, _ in COMPONENTS:
+            line[f'{name}_ms'] = round(metrics.durations.get(name, 0) * 1000, 3)
+            line[f'{name}_count'] = metrics.counts.get(name, 0)
+        return line
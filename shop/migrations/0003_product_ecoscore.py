@@ -0,0 +1,28 @@
+# Generated by Django 3.2.5 on 2026-10-18 07:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0002_ecoscorecacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='barcode',
+            field=models.CharField(blank=True, default='3229820787015', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='ecoscore_fetched_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='ecoscore_grade',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+    ]
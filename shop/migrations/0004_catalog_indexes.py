@@ -0,0 +1,66 @@
+# Generated by Django 3.2.5 on 2026-10-18 07:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count
+
+
+# Categories sharing a name keep their rows, all but the first get their id appended to the name
+def rename_duplicates(apps, schema_editor):
+    Category = apps.get_model('shop', 'Category')
+    names = Category.objects.order_by().values('name').annotate(count=Count('pk')).filter(count__gt=1)
+    taken = set(Category.objects.values_list('name', flat=True))
+    for key in names:
+        name = key['name']
+        for category in Category.objects.filter(name=name).order_by('pk')[1:]:
+            suffix = f' ({category.pk})'
+            while name[:255 - len(suffix)] + suffix in taken:
+                suffix = f' ({category.pk}){suffix}'
+            category.name = name[:255 - len(suffix)] + suffix
+            taken.add(category.name)
+            category.save(update_fields=['name', 'date_updated'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0003_product_ecoscore'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='article',
+            name='product',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='articles', to='shop.product'),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='category',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='products', to='shop.category'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['product', 'active'], name='shop_article_product_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(condition=models.Q(('active', True)), fields=['id'], name='shop_article_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(condition=models.Q(('active', True)), fields=['id'], name='shop_category_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'active'], name='shop_product_category_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('active', True)), fields=['id'], name='shop_product_active_idx'),
+        ),
+        migrations.RunPython(rename_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='category',
+            constraint=models.UniqueConstraint(fields=('name',), name='shop_category_name_unique'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0004_catalog_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategorySnapshot',
+            fields=[
+                ('category', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='shop.category')),
+                ('content', models.BinaryField()),
+                ('fingerprint', models.CharField(max_length=32)),
+                ('built_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+from shop.search import install_index, uninstall_index
+
+
+def install(apps, schema_editor):
+    install_index(schema_editor.connection)
+
+
+def uninstall(apps, schema_editor):
+    uninstall_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_category_snapshot'),
+    ]
+
+    operations = [
+        # SQLite FTS5 index and the triggers keeping it in sync, see shop/search.py
+        migrations.RunPython(install, uninstall),
+    ]
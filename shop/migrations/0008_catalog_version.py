@@ -0,0 +1,31 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:45
+
+from django.db import migrations, models
+from django.utils import timezone
+
+TABLES = ('shop_category', 'shop_product', 'shop_article')
+
+
+# The rows written so far are covered from now on
+def create_versions(apps, schema_editor):
+    CatalogVersion = apps.get_model('shop', 'CatalogVersion')
+    CatalogVersion.objects.bulk_create([CatalogVersion(table=table, date_updated=timezone.now()) for table in TABLES],
+                                      ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_article_price_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogVersion',
+            fields=[
+                ('table', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('date_updated', models.DateTimeField()),
+            ],
+        ),
+        migrations.RunPython(create_versions, migrations.RunPython.noop),
+    ]
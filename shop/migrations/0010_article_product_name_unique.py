@@ -0,0 +1,52 @@
+# Generated by Django 3.2.5 on 2026-10-18 14:20
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.utils import timezone
+
+from shop.search import install_index, uninstall_index
+
+
+# Only the latest article of each (product, name) key is kept, the others are reported by /api/changes/
+def remove_duplicates(apps, schema_editor):
+    Article = apps.get_model('shop', 'Article')
+    CatalogVersion = apps.get_model('shop', 'CatalogVersion')
+    CatalogTombstone = apps.get_model('shop', 'CatalogTombstone')
+    keys = Article.objects.order_by().values('product_id', 'name').annotate(count=Count('pk')).filter(count__gt=1)
+    removed = []
+    for key in keys:
+        pks = list(Article.objects.filter(product_id=key['product_id'], name=key['name'])
+                   .order_by('-date_updated', '-pk').values_list('pk', flat=True))
+        removed += pks[1:]
+    if removed:
+        Article.objects.filter(pk__in=removed).delete()
+        now = timezone.now()
+        CatalogTombstone.objects.bulk_create([CatalogTombstone(kind='articles', object_id=pk, date_deleted=now)
+                                              for pk in removed])
+        CatalogVersion.objects.filter(table='shop_article').update(date_updated=now)
+
+
+def install_search(apps, schema_editor):
+    install_index(schema_editor.connection)
+
+
+def uninstall_search(apps, schema_editor):
+    uninstall_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_catalog_tombstone'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        # SQLite remakes shop_article to add the constraint, the search triggers reading it are set aside meanwhile
+        migrations.RunPython(uninstall_search, install_search),
+        migrations.AddConstraint(
+            model_name='article',
+            constraint=models.UniqueConstraint(fields=('product', 'name'), name='shop_article_product_name_unique'),
+        ),
+        migrations.RunPython(install_search, uninstall_search),
+    ]
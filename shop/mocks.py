@@ -1,3 +1,8 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import requests
 from rest_framework import status
 
@@ -14,4 +19,72 @@ def mock_openfoodfact_success(self, method, url):
     response = requests.Response()
     response.status_code = status.HTTP_200_OK
     response.json = monkey_json
-    return response
\ No newline at end of file
+    return response
+
+
+def mock_openfoodfact_failure(self, method, url):
+    response = requests.Response()
+    response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return response
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Load tests open many connections at once
+    request_queue_size = 128
+
+
+class OpenFoodFactStubServer:
+    """ Local OpenFoodFacts stand-in, to use as a context manager.
+        `statuses` are answered in order (the last one repeats) after `delay` seconds """
+
+    def __init__(self, statuses=(status.HTTP_200_OK,), delay=0, grade=ECOSCORE_GRADE):
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.grade = grade
+        self.calls = 0
+        self.client_ports = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/api/v0/product/3229820787015.json'
+
+    def next_status(self):
+        with self.lock:
+            self.calls += 1
+            return self.statuses[min(self.calls, len(self.statuses)) - 1]
+
+    def __enter__(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.client_ports.add(self.client_address[1])
+                response_status = stub.next_status()
+                time.sleep(stub.delay)
+                body = json.dumps({'product': {'ecoscore_grade': stub.grade}}).encode()
+                self.send_response(response_status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except OSError:
+                    # The client gave up (timeout)
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = StubHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
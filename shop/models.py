@@ -1,13 +1,225 @@
 from django.db import models
-from django.db import transaction
-from requests import request
+from django.db import IntegrityError, transaction
+from django.db.models import Avg, Count, Max, Min
+from django.utils import timezone
+from requests import RequestException, HTTPError
 from rest_framework import status
 
+from shop.clients import get_client, get_async_client
+from shop.instrumentation import timed
+from shop.signals import catalog_updated
+
+ECOSCORE_URL = 'https://world.openfoodfacts.org/api/v0/product/{barcode}.json'
+ECOSCORE_BARCODE = '3229820787015'
+
 class fetchMixin:
+    # Pooled session with timeouts, retries and circuit breaker, see shop/clients.py
     def call_external_api(self, method, url):
-        return request(method, url)
+        with timed('external'):
+            return get_client().request(method, url)
+
+    # The same call from an async view, the wait doesn't hold a thread
+    async def acall_external_api(self, method, url):
+        with timed('external'):
+            return await get_async_client().request(method, url)
+
+class PriceStatsMixin:
+    # Prices of the active articles below the row, grouped by price_stats_parent. Prefetched for
+    # whole pages by shop.prices.prefetch_price_stats, otherwise queried
+    price_stats_parent = None
+
+    @property
+    def price_stats(self):
+        if '_price_stats' not in self.__dict__:
+            stats = Article.objects.price_stats(self.price_stats_parent, [self.pk])
+            self._price_stats = stats.get(self.pk, NO_PRICES)
+        return self._price_stats
+
+class LoadedParentMixin:
+    # Keeps the parent id a row was read with, so that a write moving it to another parent
+    # also invalidates what was cached for the parent it leaves
+    parent_attname = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.loaded_parent_id = instance.__dict__.get(cls.parent_attname)
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.loaded_parent_id = getattr(self, self.parent_attname)
+
+    def parent_ids(self):
+        """ The current parent id, along with the one the row was read with when it moved """
+        ids = {getattr(self, self.parent_attname)}
+        if getattr(self, 'loaded_parent_id', None) is not None:
+            ids.add(self.loaded_parent_id)
+        return ids
+
+# Deletes are reported by one catalog_updated per table they remove rows from, carrying the ids in deleted,
+# rather than by post_delete: without delete receivers, Django deletes the cascades set-based too.
+# deleted_rows() lists the (sender, arguments) of these signals, read before the rows are gone.
+def send_deleted(notifications):
+    for sender, kwargs in notifications:
+        if kwargs['deleted']:
+            catalog_updated.send(sender=sender, **kwargs)
+
+class NotifiedDeleteQuerySetMixin:
+
+    @transaction.atomic
+    def delete(self):
+        notifications = self.deleted_rows()
+        deleted = super().delete()
+        send_deleted(notifications)
+        return deleted
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+class NotifiedDeleteMixin:
+
+    def delete(self, using=None, keep_parents=False):
+        with transaction.atomic(using=using):
+            notifications = type(self).objects.filter(pk=self.pk).deleted_rows()
+            deleted = super().delete(using, keep_parents)
+            send_deleted(notifications)
+        return deleted
+
+# Set-based cascades: a few UPDATE ... WHERE ... IN (subquery) statements whatever the number of rows.
+# update() skips auto_now, so date_updated is set explicitly for the clients tracking changes,
+# and skips post_save, so catalog_updated is sent for the caches instead.
+class CategoryQuerySet(NotifiedDeleteQuerySetMixin, models.QuerySet):
+
+    def deleted_rows(self):
+        categories = list(self.values_list('pk', flat=True))
+        return [(Category, {'products': [], 'categories': categories, 'deleted': categories}),
+                *Product.objects.filter(category__in=self.values('pk')).deleted_rows()]
+
+    @transaction.atomic
+    def disable(self):
+        categories = list(self.values_list('pk', flat=True))
+        # Children first, so the subqueries still select the same categories
+        counts = Product.objects.filter(category__in=self.values('pk')).disable()
+        counts['categories'] = self.filter(active=True).update(active=False, date_updated=timezone.now())
+        catalog_updated.send(sender=Category, products=[], categories=categories)
+        return counts
+
+    @transaction.atomic
+    def enable(self, cascade=False):
+        categories = list(self.values_list('pk', flat=True))
+        counts = {'products': 0, 'articles': 0}
+        if cascade:
+            counts = Product.objects.filter(category__in=self.values('pk')).enable(cascade=True)
+        counts['categories'] = self.filter(active=False).update(active=True, date_updated=timezone.now())
+        catalog_updated.send(sender=Category, products=[], categories=categories)
+        return counts
+
+class ProductQuerySet(NotifiedDeleteQuerySetMixin, models.QuerySet):
+
+    def deleted_rows(self):
+        products = list(self.values_list('pk', 'category_id'))
+        return [(Product, {'products': products, 'deleted': [pk for pk, _ in products]}),
+                *Article.objects.filter(product__in=self.values('pk')).deleted_rows()]
+
+    @transaction.atomic
+    def disable(self):
+        products = list(self.values_list('pk', 'category_id'))
+        articles = Article.objects.filter(product__in=self.values('pk'), active=True)
+        counts = {
+            'articles': articles.update(active=False, date_updated=timezone.now()),
+            'products': self.filter(active=True).update(active=False, date_updated=timezone.now()),
+        }
+        catalog_updated.send(sender=Product, products=products)
+        return counts
+
+    @transaction.atomic
+    def enable(self, cascade=False):
+        products = list(self.values_list('pk', 'category_id'))
+        articles = 0
+        if cascade:
+            articles = Article.objects.filter(product__in=self.values('pk'), active=False) \
+                .update(active=True, date_updated=timezone.now())
+        counts = {
+            'articles': articles,
+            'products': self.filter(active=False).update(active=True, date_updated=timezone.now()),
+        }
+        catalog_updated.send(sender=Product, products=products)
+        return counts
+
+# Price aggregates of the active articles, what a row without any gets
+NO_PRICES = {'min_price': None, 'max_price': None, 'avg_price': None, 'article_count': 0}
+
+class ArticleQuerySet(NotifiedDeleteQuerySetMixin, models.QuerySet):
+
+    def deleted_rows(self):
+        articles = list(self.values_list('pk', 'product_id', 'product__category_id'))
+        return [(Article, {'products': {(product_id, category_id) for _, product_id, category_id in articles},
+                           'deleted': [pk for pk, _, _ in articles]})]
+
+    def price_stats(self, parent, ids):
+        """ {parent id: aggregates} of the active articles, in one GROUP BY query.
+            parent is 'product', or 'product__category' counting the active products only """
+        queryset = self.filter(active=True, **{f'{parent}__in': ids})
+        if parent != 'product':
+            queryset = queryset.filter(product__active=True)
+        rows = queryset.order_by().values(parent).annotate(
+            min_price=Min('price'), max_price=Max('price'), avg_price=Avg('price'), article_count=Count('pk'))
+        return {row.pop(parent): row for row in rows}
+
+    def price_range(self, min_price=None, max_price=None):
+        """ Active articles priced within the range, read from the (price, product) partial index """
+        queryset = self.filter(active=True)
+        if min_price is not None:
+            queryset = queryset.filter(price__gte=min_price)
+        if max_price is not None:
+            queryset = queryset.filter(price__lte=max_price)
+        return queryset
+
+    def upsert(self, rows, batch_size=500):
+        """ Creates or updates articles on their (product, name) natural key, batch_size rows per transaction.
+            Each row is a dict of field values holding at least product and name """
+        # The last row wins when a key is repeated
+        rows = list({(row['product'].pk, row['name']): row for row in rows}.values())
+        counts = {'created': 0, 'updated': 0}
+        for start in range(0, len(rows), batch_size):
+            chunk = rows[start:start + batch_size]
+            try:
+                created, updated = self._upsert_chunk(chunk)
+            except IntegrityError:
+                # A concurrent upsert created some of these keys in between, they are read again and updated
+                created, updated = self._upsert_chunk(chunk)
+            counts['created'] += len(created)
+            counts['updated'] += len(updated)
+        return counts
+
+    @transaction.atomic
+    def _upsert_chunk(self, chunk):
+        """ The articles created and updated for one chunk of upserted rows """
+        existing = {
+            (article.product_id, article.name): article
+            for article in Article.objects.filter(product__in={row['product'] for row in chunk},
+                                                  name__in={row['name'] for row in chunk})
+        }
+        now = timezone.now()
+        created, updated, fields = [], [], {'date_updated'}
+        for row in chunk:
+            article = existing.get((row['product'].pk, row['name']))
+            if article is None:
+                created.append(Article(**row))
+                continue
+            for field, value in row.items():
+                setattr(article, field, value)
+            fields.update(row)
+            article.date_updated = now
+            updated.append(article)
+        Article.objects.bulk_create(created)
+        Article.objects.bulk_update(updated, fields - {'product', 'name'})
+        catalog_updated.send(sender=Article, products={(row['product'].pk, row['product'].category_id)
+                                                       for row in chunk})
+        return created, updated
 
-class Category(models.Model):
+class Category(PriceStatsMixin, NotifiedDeleteMixin, models.Model):
 
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
@@ -16,6 +228,19 @@ class Category(models.Model):
     description = models.TextField(blank=True)
     active = models.BooleanField(default=False)
 
+    objects = CategoryQuerySet.as_manager()
+
+    price_stats_parent = 'product__category'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['name'], name='shop_category_name_unique'),
+        ]
+        indexes = [
+            # Partial index only holding the active rows served by the public endpoints
+            models.Index(fields=['id'], condition=models.Q(active=True), name='shop_category_active_idx'),
+        ]
+
     def __str__(self):
         return self.name
     
@@ -26,9 +251,9 @@ class Category(models.Model):
             return
         self.active = False
         self.save()
-        self.products.update(active=False)
+        Product.objects.filter(category=self).disable()
 
-class Product(fetchMixin, models.Model):
+class Product(fetchMixin, PriceStatsMixin, LoadedParentMixin, NotifiedDeleteMixin, models.Model):
 
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
@@ -37,7 +262,24 @@ class Product(fetchMixin, models.Model):
     description = models.TextField(blank=True)
     active = models.BooleanField(default=False)
 
-    category = models.ForeignKey('shop.Category', on_delete=models.CASCADE, related_name='products')
+    # Indexed by the (category, active) composite index below
+    category = models.ForeignKey('shop.Category', on_delete=models.CASCADE, related_name='products', db_index=False)
+
+    objects = ProductQuerySet.as_manager()
+
+    price_stats_parent = 'product'
+    parent_attname = 'category_id'
+
+    # Ecoscore stored by the refresh_ecoscores command, so reads don't depend on OpenFoodFacts
+    barcode = models.CharField(max_length=32, blank=True, default=ECOSCORE_BARCODE)
+    ecoscore_grade = models.CharField(max_length=16, null=True, blank=True)
+    ecoscore_fetched_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['category', 'active'], name='shop_product_category_idx'),
+            models.Index(fields=['id'], condition=models.Q(active=True), name='shop_product_active_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -48,17 +290,54 @@ class Product(fetchMixin, models.Model):
             return
         self.active = False
         self.save()
-        self.articles.update(active=False)
+        self.articles.filter(active=True).update(active=False, date_updated=timezone.now())
+        catalog_updated.send(sender=Article, products=[(self.pk, self.category_id)])
     
-    # Declaring an additionnal property to
+    # Declaring an additionnal property: the stored grade once it has been fetched,
+    # otherwise the value prefetched for the whole page by shop.ecoscore.prefetch_ecoscores,
+    # otherwise the shared ecoscore cache which only calls the external API on a miss
     @property
     def ecoscore(self):
-        response = self.call_external_api('GET', 'https://world.openfoodfacts.org/api/v0/product/3229820787015.json')
-        if response.status_code == status.HTTP_200_OK:
-            return response.json()['product']['ecoscore_grade']
+        if self.ecoscore_fetched_at is not None:
+            return self.ecoscore_grade
+        if '_prefetched_ecoscore' in self.__dict__:
+            return self._prefetched_ecoscore
+        from shop.ecoscore import ecoscore_cache
+        return ecoscore_cache.get_or_fetch(self.ecoscore_barcode, self.fetch_ecoscore)
+
+    @property
+    def ecoscore_barcode(self):
+        return self.barcode or ECOSCORE_BARCODE
+
+    def request_ecoscore(self):
+        # Raises a RequestException when OpenFoodFacts can't give an answer
+        response = self.call_external_api('GET', ECOSCORE_URL.format(barcode=self.ecoscore_barcode))
+        return self.parse_ecoscore(response)
 
+    async def arequest_ecoscore(self):
+        response = await self.acall_external_api('GET', ECOSCORE_URL.format(barcode=self.ecoscore_barcode))
+        return self.parse_ecoscore(response)
 
-class Article(models.Model):
+    def parse_ecoscore(self, response):
+        if response.status_code != status.HTTP_200_OK:
+            raise HTTPError(f'OpenFoodFacts answered {response.status_code}', response=response)
+        return response.json().get('product', {}).get('ecoscore_grade')
+
+    def fetch_ecoscore(self):
+        # Returns None on any upstream failure, the cache stores it as a negative entry
+        try:
+            return self.request_ecoscore()
+        except RequestException:
+            return None
+
+    async def afetch_ecoscore(self):
+        try:
+            return await self.arequest_ecoscore()
+        except RequestException:
+            return None
+
+
+class Article(LoadedParentMixin, NotifiedDeleteMixin, models.Model):
 
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
@@ -68,7 +347,76 @@ class Article(models.Model):
     active = models.BooleanField(default=False)
     price = models.DecimalField(max_digits=4, decimal_places=2)
 
-    product = models.ForeignKey('shop.Product', on_delete=models.CASCADE, related_name='articles')
+    # Indexed by the (product, active) composite index below
+    product = models.ForeignKey('shop.Product', on_delete=models.CASCADE, related_name='articles', db_index=False)
+
+    objects = ArticleQuerySet.as_manager()
+
+    parent_attname = 'product_id'
+
+    class Meta:
+        constraints = [
+            # Natural key of the bulk upserts
+            models.UniqueConstraint(fields=['product', 'name'], name='shop_article_product_name_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['product', 'active'], name='shop_article_product_idx'),
+            models.Index(fields=['id'], condition=models.Q(active=True), name='shop_article_active_idx'),
+            # Price range filters of the product and category lists
+            models.Index(fields=['price', 'product'], condition=models.Q(active=True), name='shop_article_price_idx'),
+        ]
+
+    def loaded_product_categories(self):
+        """ {product id: category id} of the product the article holds, without query when it's loaded """
+        if not Article.product.is_cached(self) or self.product.pk != self.product_id:
+            return {}
+        return {self.product.pk: self.product.category_id}
 
     def __str__(self):
         return self.name
+
+
+class EcoscoreCacheEntry(models.Model):
+    """ Ecoscore grades shared by every worker process, a null grade is a cached failure """
+
+    barcode = models.CharField(max_length=32, unique=True)
+    grade = models.CharField(max_length=16, null=True, blank=True)
+    expires_at = models.DateTimeField()
+    last_used = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.barcode
+
+
+class CategorySnapshot(models.Model):
+    """ Pre-rendered JSON of a category detail, see shop/snapshots.py """
+
+    category = models.OneToOneField(Category, on_delete=models.CASCADE, primary_key=True, related_name='snapshot')
+    content = models.BinaryField()
+    # Hash of the validator aggregates of the tree it was built from
+    fingerprint = models.CharField(max_length=32)
+    built_at = models.DateTimeField()
+
+    def __str__(self):
+        return f'Snapshot of category {self.category_id}'
+
+
+class CatalogVersion(models.Model):
+    """ Time of the last write to a catalog table, removals included, see shop/versions.py """
+
+    table = models.CharField(max_length=64, primary_key=True)
+    date_updated = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.table} at {self.date_updated}'
+
+
+class CatalogTombstone(models.Model):
+    """ Id of a deleted catalog row, so that /api/changes/ reports the deletes, see shop/changes.py """
+
+    kind = models.CharField(max_length=16)  # categories, products or articles
+    object_id = models.BigIntegerField()
+    date_deleted = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f'{self.kind} {self.object_id} deleted at {self.date_deleted}'
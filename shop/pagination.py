@@ -0,0 +1,44 @@
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+
+
+class KnownCountLimitOffsetPagination(LimitOffsetPagination):
+    """ Limit/offset pagination reusing the count already known by the view (view.queryset_count),
+        which the conditional GET validators get in the same query as the latest date_updated """
+
+    known_count = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.known_count = getattr(view, 'queryset_count', None)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_count(self, queryset):
+        if self.known_count is not None:
+            return self.known_count
+        return super().get_count(queryset)
+
+
+class KeysetPagination(CursorPagination):
+    """ Seeks on the primary key, deep pages cost the same as the first one """
+
+    ordering = 'id'
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+
+class CatalogPagination(KnownCountLimitOffsetPagination):
+    """ Limit/offset by default, keyset pagination on ?pagination=cursor or when following a cursor """
+
+    mode_query_param = 'pagination'
+    keyset_paginator = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.query_params.get(self.mode_query_param) == 'cursor' \
+                or KeysetPagination.cursor_query_param in request.query_params:
+            self.keyset_paginator = KeysetPagination()
+            return self.keyset_paginator.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset_paginator is not None:
+            return self.keyset_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
@@ -0,0 +1,21 @@
+from shop.models import Article, NO_PRICES
+
+# Output fields of the price aggregates, on the product and category serializers
+PRICE_FIELDS = tuple(NO_PRICES)
+
+
+def price_stats_for(model, ids):
+    """ {id: aggregates} of the given products or categories, every id included """
+    stats = Article.objects.price_stats(model.price_stats_parent, ids)
+    return {pk: stats.get(pk, NO_PRICES) for pk in ids}
+
+
+def prefetch_price_stats(instances):
+    """ Resolves the price aggregates of a whole page of products or categories in one query,
+        rather than one per row through their price_stats property """
+    pending = [instance for instance in instances if '_price_stats' not in instance.__dict__]
+    if not pending:
+        return
+    stats = price_stats_for(type(pending[0]), [instance.pk for instance in pending])
+    for instance in pending:
+        instance._price_stats = stats[instance.pk]
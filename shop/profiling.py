@@ -0,0 +1,166 @@
+import cProfile
+import json
+import os
+import pstats
+import time
+import uuid
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.response import Response
+
+from shop.instrumentation import RequestMetrics
+from shop.permissions import isAdminAuthenticated, isStaffAuthenticated
+
+# Defaults, each key can be overridden through settings.PROFILING
+DEFAULTS = {
+    'DIRECTORY': 'profiles',  # where ?profile=store writes its .prof and .json files
+    'STATS_LIMIT': 50,  # functions listed, by cumulative time
+    'TREE_DEPTH': 12,
+    'TREE_THRESHOLD': 0.01,  # call tree branches under this share of the total time are pruned
+}
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_PARAM = 'profile'
+# inline: the response body is replaced by the report, store: the report is written on disk
+PROFILE_MODES = ('inline', 'store')
+
+
+def setting(name):
+    return getattr(settings, 'PROFILING', {}).get(name, DEFAULTS[name])
+
+
+def function_name(function):
+    filename, line, name = function
+    if filename == '~':
+        # Builtins
+        return name
+    return f'{filename}:{line}({name})'
+
+
+def sorted_stats(stats, limit):
+    rows = []
+    for function, (primitive_calls, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            'function': function_name(function),
+            'calls': calls,
+            'primitive_calls': primitive_calls,
+            'tottime_ms': round(tottime * 1000, 3),
+            'cumtime_ms': round(cumtime * 1000, 3),
+        })
+    rows.sort(key=lambda row: row['cumtime_ms'], reverse=True)
+    return rows[:limit]
+
+
+def call_tree(stats, depth, threshold):
+    """ Nested callees by cumulative time, from the functions called by the profiled code """
+    children = {}
+    roots = []
+    for function, (_, _, _, cumtime, callers) in stats.stats.items():
+        if not callers:
+            roots.append((function, stats.stats[function][1], cumtime))
+        for caller, (_, calls, _, edge_cumtime) in callers.items():
+            children.setdefault(caller, []).append((function, calls, edge_cumtime))
+    total = sum(cumtime for _, _, cumtime in roots) or 1
+
+    def build(function, calls, cumtime, path, level):
+        node = {'function': function_name(function), 'calls': calls, 'cumtime_ms': round(cumtime * 1000, 3)}
+        if level < depth:
+            callees = sorted(children.get(function, []), key=lambda child: child[2], reverse=True)
+            node['children'] = [
+                build(callee, callee_calls, callee_cumtime, path | {callee}, level + 1)
+                for callee, callee_calls, callee_cumtime in callees
+                # Recursion shows up once
+                if callee not in path and callee_cumtime / total >= threshold
+            ]
+        return node
+
+    roots.sort(key=lambda root: root[2], reverse=True)
+    return [build(function, calls, cumtime, {function}, 1) for function, calls, cumtime in roots
+            if cumtime / total >= threshold]
+
+
+class ProfilingMixin:
+    """ Runs the view under cProfile when a staff or admin user asks for it,
+        with the X-Profile header or the profile query parameter set to inline or store.
+        Other requests only pay for the lookup of that header and parameter """
+
+    profiler = None
+
+    def get_profile_mode(self, request):
+        mode = request.META.get(PROFILE_HEADER) or request.query_params.get(PROFILE_PARAM)
+        if mode not in PROFILE_MODES:
+            return None
+        # Silently ignored for everybody else, the response is the usual one
+        if not (isAdminAuthenticated().has_permission(request, self)
+                or isStaffAuthenticated().has_permission(request, self)):
+            return None
+        return mode
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.profile_mode = self.get_profile_mode(request)
+        if self.profile_mode is None:
+            return
+        self.profile_metrics = RequestMetrics(keep_sql=True)
+        self.profile_stack = ExitStack()
+        for connection in connections.all():
+            self.profile_stack.enter_context(connection.execute_wrapper(self.profile_metrics.record_query))
+        self.profile_start = time.perf_counter()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.profiler is None:
+            return response
+        try:
+            # Rendering is part of the profile, streamed content is not
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+        finally:
+            self.stop_profiling()
+        report = self.profile_report(request, response)
+        if self.profile_mode == 'inline':
+            response = super().finalize_response(request, Response(report), *args, **kwargs)
+        else:
+            response['X-Profile-Id'] = self.store_profile(report)
+        self.profiler = None
+        return response
+
+    def stop_profiling(self):
+        self.profiler.disable()
+        self.profile_stack.close()
+
+    # Unhandled errors skip finalize_response
+    def handle_exception(self, exc):
+        try:
+            return super().handle_exception(exc)
+        except Exception:
+            if self.profiler is not None:
+                self.stop_profiling()
+                self.profiler = None
+            raise
+
+    def profile_report(self, request, response):
+        stats = pstats.Stats(self.profiler)
+        return {
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'total_ms': round((time.perf_counter() - self.profile_start) * 1000, 3),
+            'stats': sorted_stats(stats, setting('STATS_LIMIT')),
+            'sql': self.profile_metrics.queries,
+            'call_tree': call_tree(stats, setting('TREE_DEPTH'), setting('TREE_THRESHOLD')),
+        }
+
+    # <id>.prof loads with pstats or snakeviz, <id>.json holds the report
+    def store_profile(self, report):
+        directory = setting('DIRECTORY')
+        os.makedirs(directory, exist_ok=True)
+        profile_id = f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}'
+        self.profiler.dump_stats(os.path.join(directory, f'{profile_id}.prof'))
+        with open(os.path.join(directory, f'{profile_id}.json'), 'w') as file:
+            json.dump(report, file, indent=2)
+        return profile_id
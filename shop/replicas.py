@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger('shop.replicas')
+
+# Defaults, each key can be overridden through settings.DATABASE_REPLICAS
+DEFAULTS = {
+    'PRIMARY': 'default',
+    'ALIASES': [],                 # replicas the reads are balanced over, none sends everything to PRIMARY
+    'STICKY_SECONDS': 10,          # a client reads from PRIMARY this long after a write, above the replication lag
+    'COOKIE': 'primary_pinned',
+    'HEALTH_CHECK_INTERVAL': 10,   # seconds between two checks of a replica, a failing one is left out meanwhile
+    'CONNECTION_HEALTH_CHECKS': True,  # persistent connections are checked before being reused by a request
+}
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def setting(name):
+    return getattr(settings, 'DATABASE_REPLICAS', {}).get(name, DEFAULTS[name])
+
+
+class RoutingState:
+    """ Where the reads of the current request go: PRIMARY once it is pinned or has written """
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+# Routing of the request being served, None outside requests (commands, shell...)
+current_routing = ContextVar('current_routing', default=None)
+
+
+class ReplicaHealth:
+    """ Last check of each replica, per process """
+
+    def __init__(self):
+        self.checks = {}
+        self.lock = threading.Lock()
+
+    def is_healthy(self, alias):
+        checked_at, healthy = self.checks.get(alias, (None, True))
+        if checked_at is not None and time.monotonic() - checked_at < setting('HEALTH_CHECK_INTERVAL'):
+            return healthy
+        healthy = self.check(alias)
+        with self.lock:
+            self.checks[alias] = (time.monotonic(), healthy)
+        return healthy
+
+    def check(self, alias):
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except DatabaseError:
+            logger.warning('Replica %s failed its health check, reading from the primary', alias, exc_info=True)
+            connections[alias].close()
+            return False
+
+    def reset(self):
+        with self.lock:
+            self.checks.clear()
+
+
+replica_health = ReplicaHealth()
+
+
+class ReplicaRouter:
+    """ Reads from a healthy replica picked at random, writes to the primary.
+        A request reads from the primary once it has written, inside transactions,
+        and during STICKY_SECONDS after a write request of the same client (see ReplicaMiddleware) """
+
+    def db_for_read(self, model, **hints):
+        primary = setting('PRIMARY')
+        replicas = setting('ALIASES')
+        if not replicas:
+            return primary
+        state = current_routing.get()
+        if state is not None and (state.pinned or state.wrote):
+            return primary
+        if connections[primary].in_atomic_block:
+            return primary
+        healthy = [alias for alias in replicas if replica_health.is_healthy(alias)]
+        return random.choice(healthy) if healthy else primary
+
+    def db_for_write(self, model, **hints):
+        state = current_routing.get()
+        if state is not None:
+            state.wrote = True
+        return setting('PRIMARY')
+
+    # The databases of the project are the primary and its replicas, they all hold the same rows
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+
+class ReplicaMiddleware:
+    """ Tracks the writes of each request for ReplicaRouter. Unsafe methods read from the primary from
+        the start, and their client gets a cookie pinning its next requests to it for STICKY_SECONDS,
+        so it reads its own writes whatever the replication lag """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # A sync middleware would hold a thread for the whole request under ASGI
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if setting('CONNECTION_HEALTH_CHECKS'):
+            self.check_connections()
+        state = self.routing_state(request)
+        token = current_routing.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        return self.process_response(request, response, state)
+
+    async def __acall__(self, request):
+        if setting('CONNECTION_HEALTH_CHECKS'):
+            # From the thread running the queries, the connections are per thread
+            await sync_to_async(self.check_connections)()
+        state = self.routing_state(request)
+        token = current_routing.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        return self.process_response(request, response, state)
+
+    def routing_state(self, request):
+        return RoutingState(pinned=request.method not in SAFE_METHODS or setting('COOKIE') in request.COOKIES)
+
+    def process_response(self, request, response, state):
+        if state.wrote and request.method not in SAFE_METHODS and setting('ALIASES'):
+            response.set_cookie(setting('COOKIE'), '1', max_age=setting('STICKY_SECONDS'), httponly=True, samesite='Lax')
+        return response
+
+    # Persistent connections (CONN_MAX_AGE) may have been dropped by the server meanwhile
+    def check_connections(self):
+        for connection in connections.all():
+            if connection.connection is not None and not connection.in_atomic_block and not connection.is_usable():
+                connection.close()
@@ -0,0 +1,134 @@
+import re
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Q
+
+from shop.models import Product
+
+# Defaults, each key can be overridden through settings.CATALOG_SEARCH
+DEFAULTS = {
+    # bm25 weight of each indexed column, a match in a product name ranks above one in a description
+    'WEIGHTS': {'name': 10.0, 'description': 1.0, 'category': 3.0, 'articles': 5.0},
+    'MAX_TERMS': 8,  # terms of a query beyond this are ignored
+}
+
+# SQLite FTS5 index holding one row per active product of an active category, whose rowid is the product id.
+# Triggers keep it in sync with every write, set-based updates and the disable() cascades included
+INDEX_TABLE = 'shop_product_search'
+COLUMNS = ('name', 'description', 'category', 'articles')
+
+
+def setting(name):
+    return getattr(settings, 'CATALOG_SEARCH', {}).get(name, DEFAULTS[name])
+
+
+def index_products(products):
+    """ Statements indexing again the products whose ids the SQL expression `products` returns """
+    return [
+        f'DELETE FROM {INDEX_TABLE} WHERE rowid IN ({products})',
+        f'''INSERT INTO {INDEX_TABLE} (rowid, name, description, category, articles)
+            SELECT product.id, product.name, product.description, category.name,
+                   (SELECT group_concat(article.name, ' ') FROM shop_article AS article
+                    WHERE article.product_id = product.id AND article.active)
+            FROM shop_product AS product JOIN shop_category AS category ON category.id = product.category_id
+            WHERE product.id IN ({products}) AND product.active AND category.active''',
+    ]
+
+
+# (name, event, statements), the products of a category are indexed again when it is renamed or disabled
+TRIGGERS = [
+    ('product_insert', 'AFTER INSERT ON shop_product', index_products('NEW.id')),
+    ('product_update', 'AFTER UPDATE OF name, description, active, category_id ON shop_product',
+     index_products('OLD.id, NEW.id')),
+    ('product_delete', 'AFTER DELETE ON shop_product', [f'DELETE FROM {INDEX_TABLE} WHERE rowid = OLD.id']),
+    ('article_insert', 'AFTER INSERT ON shop_article', index_products('NEW.product_id')),
+    ('article_update', 'AFTER UPDATE OF name, active, product_id ON shop_article',
+     index_products('OLD.product_id, NEW.product_id')),
+    ('article_delete', 'AFTER DELETE ON shop_article', index_products('OLD.product_id')),
+    ('category_update', 'AFTER UPDATE OF name, active ON shop_category',
+     index_products('SELECT id FROM shop_product WHERE category_id = NEW.id')),
+]
+
+
+def install_index(connection):
+    """ Creates the index and its triggers when missing, then fills it. Also rebuilds it, after a migration
+        remaking shop_product, shop_article or shop_category on SQLite for instance, which drops their triggers.
+        Other backends go without index """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        # Accents are ignored, and prefixes of 2 and 3 characters indexed for the as-you-type queries
+        cursor.execute(f'''CREATE VIRTUAL TABLE IF NOT EXISTS {INDEX_TABLE} USING fts5(
+            {', '.join(COLUMNS)}, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')''')
+        for name, event, statements in TRIGGERS:
+            body = ''.join(f'{statement};\n' for statement in statements)
+            cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {INDEX_TABLE}_{name} {event} BEGIN\n{body}END')
+        cursor.execute(f'DELETE FROM {INDEX_TABLE}')
+        for statement in index_products('SELECT id FROM shop_product'):
+            cursor.execute(statement)
+
+
+def uninstall_index(connection):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, _, _ in TRIGGERS:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {INDEX_TABLE}_{name}')
+        cursor.execute(f'DROP TABLE IF EXISTS {INDEX_TABLE}')
+
+
+def parse_terms(query):
+    return re.findall(r'\w+', query)[:setting('MAX_TERMS')]
+
+
+class ProductSearch:
+    """ Active products matching every term of a query, as prefixes, best ranked first.
+        Sliced by the paginators: each page is a ranked query on the index, then one for its products,
+        so the cost follows the number of matches rather than the size of the catalog """
+
+    def __init__(self, terms, using):
+        # Quoted, the terms can't be taken for FTS5 operators
+        self.match = ' '.join(f'"{term}"*' for term in terms)
+        self.using = using
+
+    def execute(self, sql, params):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def count(self):
+        return self.execute(f'SELECT count(*) FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH %s', [self.match])[0][0]
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step is not None:
+            raise TypeError('ProductSearch only supports slicing')
+        weights = setting('WEIGHTS')
+        rank = f"bm25({INDEX_TABLE}, {', '.join(str(float(weights[column])) for column in COLUMNS)})"
+        limit = -1 if item.stop is None else item.stop - (item.start or 0)
+        rows = self.execute(f'SELECT rowid FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH %s '
+                            f'ORDER BY {rank}, rowid LIMIT %s OFFSET %s', [self.match, limit, item.start or 0])
+        ids = [pk for pk, in rows]
+        products = Product.objects.using(self.using).in_bulk(ids)
+        # A product written since the ranked query may be gone
+        return [products[pk] for pk in ids if pk in products]
+
+
+def search_products(query):
+    """ What the paginators slice for a query, None when it has no term """
+    terms = parse_terms(query)
+    if not terms:
+        return None
+    using = router.db_for_read(Product)
+    if connections[using].vendor == 'sqlite':
+        return ProductSearch(terms, using)
+    # Unranked and unindexed, without FTS5
+    queryset = Product.objects.filter(active=True, category__active=True).order_by('pk')
+    for term in terms:
+        queryset = queryset.filter(Q(name__icontains=term) | Q(description__icontains=term)
+                                   | Q(category__name__icontains=term)
+                                   | Q(articles__name__icontains=term, articles__active=True)).distinct()
+    return queryset
@@ -1,11 +1,69 @@
-from rest_framework.serializers import ModelSerializer, SerializerMethodField, ValidationError
+from django.db import models
+from rest_framework.exceptions import ParseError
+from rest_framework.serializers import ListSerializer, ModelSerializer, Serializer, SerializerMethodField, \
+    ValidationError, ListField, IntegerField, BooleanField, DecimalField, CharField
+from rest_framework.validators import UniqueTogetherValidator
 from shop.models import Category, Product, Article
+from shop.ecoscore import prefetch_ecoscores
+from shop.prices import PRICE_FIELDS, prefetch_price_stats
+from shop.instrumentation import timed
 
 
-class ArticleSerializer(ModelSerializer):
+class TimedSerializerMixin:
+    """ Reports the serialization time to the performance instrumentation, see shop/middleware.py """
+    def to_representation(self, instance):
+        with timed('serialize'):
+            return super().to_representation(instance)
+
+
+def parse_fieldset(value):
+    """ 'id,name,products.name' -> {'id': {}, 'name': {}, 'products': {'name': {}}} """
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for name in path.strip().split('.'):
+            if name:
+                node = node.setdefault(name, {})
+    return tree
+
+
+class SparseFieldsMixin:
+    """ Sparse fieldsets. The fields kwarg keeps only the listed fields, the expand kwarg adds the optional
+        ones of expandable_fields. Both are trees from parse_fieldset, whose subtrees are handed down with
+        the limits to the serializers of nested_serializers, so fields nobody asked for are never computed """
+    expandable_fields = ()
+    nested_serializers = {}
+
+    def __init__(self, *args, fields=None, expand=None, limits=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requested_fields = fields or {}
+        self.expand = expand or {}
+        self.limits = limits or {}
+        unknown = (set(self.requested_fields) | set(self.expand)) - set(self.fields)
+        if unknown:
+            raise ParseError(f"Unknown fields: {', '.join(sorted(unknown))}.")
+        for name in list(self.fields):
+            if not self.includes(name, self.requested_fields, self.expand):
+                self.fields.pop(name)
+
+    @classmethod
+    def includes(cls, name, fields=None, expand=None):
+        if expand and name in expand:
+            return True
+        if fields:
+            return name in fields
+        return name not in cls.expandable_fields
+
+    def nested_kwargs(self, name):
+        return {'fields': self.requested_fields.get(name), 'expand': self.expand.get(name), 'limits': self.limits}
+
+
+class ArticleSerializer(TimedSerializerMixin, SparseFieldsMixin, ModelSerializer):
     class Meta:
         model = Article
         fields = ['id', 'name', 'product', 'description', 'price', 'date_created', 'date_updated']
+        # DRF doesn't derive it from the shop_article_product_name_unique constraint
+        validators = [UniqueTogetherValidator(Article.objects.all(), fields=['product', 'name'])]
     
     def validate_price(self, value):
         if value < 1:
@@ -13,33 +71,119 @@ class ArticleSerializer(ModelSerializer):
         return value
 
     def validate_product(self, value):
-        print('ceci est le produit passé', value)
         if value.active is False:
             raise ValidationError("The associated product must be active")
         return value
 
-class ProductListSerializer(ModelSerializer):
+class ArticleBulkSerializer(ArticleSerializer):
+    """ One row of a bulk upsert. Products and existing (product, name) keys are looked up
+        once for the whole batch and passed in the context """
+    product = IntegerField()
+
+    class Meta(ArticleSerializer.Meta):
+        fields = ['product', 'name', 'description', 'price', 'active']
+        # Existing keys are updated
+        validators = []
+        extra_kwargs = {
+            'description': {'required': False},
+            'price': {'required': False},
+            'active': {'required': False},
+        }
+
+    def validate_product(self, value):
+        product = self.context['products'].get(value)
+        if product is None:
+            raise ValidationError(f'Invalid pk "{value}" - object does not exist.')
+        return super().validate_product(product)
+
+    def validate(self, data):
+        if (data['product'].pk, data['name']) not in self.context['existing'] and 'price' not in data:
+            raise ValidationError({'price': 'This field is required to create an article.'})
+        return data
+
+class PriceStatsListSerializer(ListSerializer):
+    """ Batches the price aggregates of every row in one query before serializing them one by one """
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        rows = list(iterable)
+        if any(name in self.child.fields for name in PRICE_FIELDS):
+            prefetch_price_stats(rows)
+        return super().to_representation(rows)
+
+class EcoscoreListSerializer(PriceStatsListSerializer):
+    """ Batches the ecoscore lookups of every product before serializing them one by one """
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        products = list(iterable)
+        if 'ecoscore' in self.child.fields:
+            prefetch_ecoscores(products)
+        return super().to_representation(products)
+
+class PriceStatsSerializer(Serializer):
+    """ Price aggregates of the active articles below a product or a category, read from its price_stats """
+    min_price = DecimalField(max_digits=4, decimal_places=2, source='price_stats.min_price', read_only=True)
+    max_price = DecimalField(max_digits=4, decimal_places=2, source='price_stats.max_price', read_only=True)
+    avg_price = DecimalField(max_digits=4, decimal_places=2, source='price_stats.avg_price', read_only=True)
+    article_count = IntegerField(source='price_stats.article_count', read_only=True)
+
+# Active children of a row, prefetched by the viewsets into to_attr lists, falling back to a query otherwise
+def active_children(serializer, instance, name):
+    children = getattr(instance, f'active_{name}', None)
+    if children is None:
+        children = getattr(instance, name).filter(active=True)
+        limit = serializer.limits.get(name)
+        if limit is not None:
+            children = children.order_by('pk')[:limit]
+    return children
+
+class ProductArticlesMixin:
+    def get_articles(self, instance):
+        articles = active_children(self, instance, 'articles')
+        return ArticleSerializer(articles, many=True, **self.nested_kwargs('articles')).data
+
+class ProductListSerializer(TimedSerializerMixin, SparseFieldsMixin, ProductArticlesMixin, PriceStatsSerializer,
+                            ModelSerializer):
+    articles = SerializerMethodField()
+    expandable_fields = ('articles',)
+    nested_serializers = {'articles': ArticleSerializer}
+
     class Meta:
         model = Product
-        fields = ['id', 'name', 'ecoscore', 'date_created', 'date_updated']
+        fields = ['id', 'name', 'ecoscore', 'min_price', 'max_price', 'avg_price', 'article_count', 'articles',
+                  'date_created', 'date_updated']
+        list_serializer_class = EcoscoreListSerializer
 
-class ProductDetailSerializer(ModelSerializer):
+class ProductDetailSerializer(TimedSerializerMixin, SparseFieldsMixin, ProductArticlesMixin, PriceStatsSerializer,
+                              ModelSerializer):
     articles = SerializerMethodField()
-    def get_articles(self, instance):
-        queryset = instance.articles.filter(active=True)
-        return ArticleSerializer(queryset, many=True).data
+    nested_serializers = {'articles': ArticleSerializer}
 
     class Meta:
         model = Product
-        fields = ['id', 'name', 'description', 'ecoscore', 'category_id', 'articles', 'date_created', 'date_updated']
+        fields = ['id', 'name', 'description', 'ecoscore', 'category_id', 'min_price', 'max_price', 'avg_price',
+                  'article_count', 'articles', 'date_created', 'date_updated']
+        list_serializer_class = EcoscoreListSerializer
+
+class CategoryProductsMixin:
+    def get_products(self, instance):
+        # instance refers to the current category, involving recursivity for each available category
+        products = active_children(self, instance, 'products')
+        return ProductDetailSerializer(products, many=True, **self.nested_kwargs('products')).data
+
+class CategoryListSerializer(TimedSerializerMixin, SparseFieldsMixin, CategoryProductsMixin, PriceStatsSerializer,
+                             ModelSerializer):
+    products = SerializerMethodField()
+    expandable_fields = ('products',)
+    nested_serializers = {'products': ProductDetailSerializer}
 
-class CategoryListSerializer(ModelSerializer):
     class Meta:
         model = Category
-        fields = ['id', 'name', 'description', 'date_created', 'date_updated']
+        fields = ['id', 'name', 'description', 'min_price', 'max_price', 'avg_price', 'article_count', 'products',
+                  'date_created', 'date_updated']
+        list_serializer_class = PriceStatsListSerializer
 
     def validate_name(self, value):
-        if Category.objects.filter(name=value):
+        if Category.objects.filter(name=value).exists():
             raise ValidationError('This Category already exists.')
         return value
     
@@ -49,15 +193,49 @@ class CategoryListSerializer(ModelSerializer):
             raise ValidationError('The category name must be repeated somehow in the description.')
         return data
 
-class CategoryDetailSerializer(ModelSerializer):
+class CategoryDetailSerializer(TimedSerializerMixin, SparseFieldsMixin, CategoryProductsMixin, PriceStatsSerializer,
+                               ModelSerializer):
     """ Defining product attribute by coupling with its own serializer
         Using SerializerMethodField allow to perform extra modifications (sorting, filtering...)
         But needs a specific get_object method addition"""
     products = SerializerMethodField()
-    def get_products(self, instance):
-        # instance refers to the current category, involving recursivity for each available category
-        queryset = instance.products.filter(active=True)
-        return ProductDetailSerializer(queryset, many=True).data
+    nested_serializers = {'products': ProductDetailSerializer}
+
     class Meta:
         model = Category
-        fields = ['id', 'name', 'description', 'products', 'date_created', 'date_updated']
+        fields = ['id', 'name', 'description', 'min_price', 'max_price', 'avg_price', 'article_count', 'products',
+                  'date_created', 'date_updated']
+
+class CategoryFilterSerializer(Serializer):
+    """ Lookups on the category names selecting the rows of a bulk disable/enable """
+    name = CharField(required=False)
+    name__in = ListField(child=CharField(), required=False, allow_empty=False)
+    name__icontains = CharField(required=False)
+
+    def to_internal_value(self, data):
+        if isinstance(data, dict):
+            unknown = set(data) - set(self.fields)
+            if unknown:
+                raise ValidationError(f"Unsupported filters: {', '.join(sorted(unknown))}.")
+            if not data:
+                raise ValidationError('At least one filter is required.')
+        return super().to_internal_value(data)
+
+class CategoryBulkStatusSerializer(Serializer):
+    """ Selects the categories of a bulk disable/enable, either by ids or by a filter """
+    ids = ListField(child=IntegerField(), required=False, allow_empty=False)
+    filter = CategoryFilterSerializer(required=False)
+    cascade = BooleanField(default=False)
+
+    def validate(self, data):
+        if 'ids' not in data and 'filter' not in data:
+            raise ValidationError('Either ids or filter is required.')
+        return data
+
+    def get_queryset(self):
+        queryset = Category.objects.all()
+        if 'ids' in self.validated_data:
+            queryset = queryset.filter(pk__in=self.validated_data['ids'])
+        if 'filter' in self.validated_data:
+            queryset = queryset.filter(**self.validated_data['filter'])
+        return queryset
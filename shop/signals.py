@@ -0,0 +1,29 @@
+from django.db import transaction
+from django.dispatch import Signal
+
+# Sent by the set-based writes (queryset update, bulk_create, bulk_update) which skip post_save,
+# and by the deletes, once per table they remove rows from (see shop/models.py).
+# Arguments: sender, the model class written, and products, a list of (product_id, category_id)
+# pairs for the products written or whose articles were written. Deletes also pass deleted,
+# the ids of the removed sender rows.
+catalog_updated = Signal()
+
+
+def on_commit_batch(key, callback, items):
+    """ Gathers items over the current transaction, handed at once to callback when it commits,
+        right away outside of one. Dropped along with the transaction on rollback """
+    connection = transaction.get_connection()
+    # Tied to the list of on_commit callbacks, which Django replaces on commit and on rollback
+    callbacks, batches = getattr(connection, 'commit_batches', (None, None))
+    if callbacks is not connection.run_on_commit:
+        batches = {}
+        connection.commit_batches = (connection.run_on_commit, batches)
+    batches.setdefault(key, set()).update(items)
+
+    # The first callback run takes the items of every write of the transaction, the others find none
+    def run():
+        batch = batches.pop(key, None)
+        if batch:
+            callback(batch)
+
+    transaction.on_commit(run)
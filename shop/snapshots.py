@@ -0,0 +1,139 @@
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max, Count
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from shop.models import Category, Product, Article, CategorySnapshot
+from shop.signals import catalog_updated, on_commit_batch
+
+# Defaults, each key can be overridden through settings.CATALOG_SNAPSHOTS
+DEFAULTS = {
+    'ENABLED': True,
+    # Ecoscores which aren't stored on the products are frozen in the snapshots, rebuilt after this many seconds
+    'MAX_AGE': 24 * 60 * 60,
+}
+
+
+def setting(name):
+    return getattr(settings, 'CATALOG_SNAPSHOTS', {}).get(name, DEFAULTS[name])
+
+
+# The rows a category detail is made of, also its conditional GET validators
+def tree_querysets(pk):
+    return [
+        Category.objects.filter(pk=pk, active=True),
+        Product.objects.filter(category_id=pk, active=True),
+        Article.objects.filter(product__category_id=pk, product__active=True, active=True),
+    ]
+
+
+def aggregate(queryset):
+    return queryset.order_by().aggregate(last_modified=Max('date_updated'), count=Count('pk'))
+
+
+def fingerprint(aggregates):
+    parts = [f"{values['last_modified']}|{values['count']}" for values in aggregates]
+    return hashlib.md5('|'.join(parts).encode()).hexdigest()
+
+
+def render_snapshot(pk, aggregates=None):
+    """ (content, fingerprint) of the detail of category pk, None once it's gone or inactive.
+        The aggregates are read before the tree, so a write landing in between leaves an outdated
+        fingerprint and the snapshot is built again on the next read """
+    from shop.serializers import CategoryDetailSerializer
+    from shop.views import prefetch_active_products
+
+    if aggregates is None:
+        aggregates = [aggregate(queryset) for queryset in tree_querysets(pk)]
+    category = Category.objects.filter(pk=pk, active=True).prefetch_related(prefetch_active_products()).first()
+    if category is None:
+        return None
+    return JSONRenderer().render(CategoryDetailSerializer(category).data), fingerprint(aggregates)
+
+
+def store_snapshot(pk, rendered):
+    if rendered is None:
+        CategorySnapshot.objects.filter(category_id=pk).delete()
+        return None
+    content, fingerprint = rendered
+    snapshot, _ = CategorySnapshot.objects.update_or_create(category_id=pk, defaults={
+        'content': content,
+        'fingerprint': fingerprint,
+        'built_at': timezone.now(),
+    })
+    return snapshot
+
+
+def build_snapshot(pk, aggregates=None):
+    return store_snapshot(pk, render_snapshot(pk, aggregates))
+
+
+def delete_snapshots(category_ids):
+    CategorySnapshot.objects.filter(category_id__in=category_ids).delete()
+
+
+def delete_product_snapshots(product_ids):
+    CategorySnapshot.objects.filter(category__products__in=product_ids).delete()
+
+
+# The snapshots of the categories a write touches are dropped when it commits, to be built again on their
+# next read, gathered over the transaction so a batch of writes deletes them at once. A read in between
+# may still find one built from the old rows, which its fingerprint then leaves out
+def invalidate(category_ids):
+    category_ids = set(category_ids)
+    if category_ids:
+        on_commit_batch('snapshots', delete_snapshots, category_ids)
+
+
+@receiver(post_save, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    invalidate([instance.pk])
+
+
+@receiver(post_save, sender=Product)
+def product_changed(sender, instance, **kwargs):
+    invalidate(instance.parent_ids())
+
+
+# Without the product loaded, its category is read by the DELETE run at commit
+@receiver(post_save, sender=Article)
+def article_changed(sender, instance, **kwargs):
+    categories = instance.loaded_product_categories()
+    invalidate(categories.values())
+    pending = instance.parent_ids() - set(categories)
+    if pending:
+        on_commit_batch('snapshots:products', delete_product_snapshots, pending)
+
+
+@receiver(catalog_updated)
+def catalog_bulk_updated(sender, products=(), categories=(), **kwargs):
+    invalidate([*categories, *(category_id for _, category_id in products)])
+
+
+class SnapshotMixin:
+    """ Serves the plain JSON category detail from its snapshot, built on the first read.
+        Relies on the aggregates of ConditionalGetMixin, whose fingerprint has to match the stored one """
+
+    def get_snapshot(self, request):
+        if not setting('ENABLED') or request.query_params or request.accepted_media_type != JSONRenderer.media_type:
+            return None
+        aggregates = getattr(self, 'validator_aggregates', None)
+        if aggregates is None:
+            return None
+        snapshot = CategorySnapshot.objects.filter(category_id=self.kwargs['pk']).first()
+        if (snapshot is None or snapshot.fingerprint != fingerprint(aggregates)
+                or snapshot.built_at < timezone.now() - timedelta(seconds=setting('MAX_AGE'))):
+            snapshot = build_snapshot(self.kwargs['pk'], aggregates)
+        return snapshot
+
+    def retrieve(self, request, *args, **kwargs):
+        snapshot = self.get_snapshot(request)
+        if snapshot is None:
+            return super().retrieve(request, *args, **kwargs)
+        return HttpResponse(bytes(snapshot.content), content_type=JSONRenderer.media_type)
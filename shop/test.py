@@ -1,12 +1,46 @@
-from rest_framework.test import APITestCase
+from rest_framework.test import APITestCase, APITransactionTestCase
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.test import SimpleTestCase, override_settings
 from django.urls import reverse, reverse_lazy
+from django.utils import timezone
 from rest_framework import status
+from io import StringIO
+from datetime import timedelta
+import itertools
+import json
+import os
+import tempfile
+from requests import RequestException
 from unittest import mock
+import time
 
-from shop.models import Category, Product, Article
-from shop.mocks import ECOSCORE_GRADE, mock_openfoodfact_success
+from shop.models import Category, Product, Article, EcoscoreCacheEntry, CategorySnapshot, CatalogVersion, \
+    CatalogTombstone
+from shop.mocks import ECOSCORE_GRADE, mock_openfoodfact_success, mock_openfoodfact_failure, \
+    OpenFoodFactStubServer
+from shop.clients import ExternalAPIClient, AsyncExternalAPIClient, CircuitOpenError
+from shop.factories import clear_catalog, generate_catalog
+from shop.benchmarks import SIZES, run_benchmarks, compare, write_changes
+from shop.management.commands.benchmark_endpoints import BASELINE
+from shop.ecoscore import ecoscore_cache
+from shop.fastpath import CategoryRowSerializer, ProductRowSerializer, ArticleRowSerializer
+from shop.signals import catalog_updated
+from shop.prices import PRICE_FIELDS
+from shop.replicas import ReplicaRouter, RoutingState, current_routing, replica_health
+from rest_framework_simplejwt.tokens import AccessToken
+from asgiref.sync import async_to_sync
+import asyncio
 
 class ShopAPITestCase(APITestCase):
+    def setUp(self):
+        # Counters, cached counts and responses are kept in caches, which outlive the test transactions
+        for cache in caches.all():
+            cache.clear()
+
     # Helper function to harmonize time notation accordingly to API
     def format_datetime(self, value):
         return value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
@@ -31,6 +65,10 @@ class TestCategory(ShopAPITestCase):
                         'id': category.pk,
                         'name': category.name,
                         'description': category.description,
+                        'min_price': None,
+                        'max_price': None,
+                        'avg_price': None,
+                        'article_count': 0,
                         'date_created': self.format_datetime(category.date_created),
                         'date_updated': self.format_datetime(category.date_updated),
                     }
@@ -45,12 +83,16 @@ class TestCategory(ShopAPITestCase):
             'id': category.pk,
             'name': category.name,
             'description': category.description,
+            'min_price': None,
+            'max_price': None,
+            'avg_price': None,
+            'article_count': 0,
             'products': [],
             'date_created': self.format_datetime(category.date_created),
             'date_updated': self.format_datetime(category.date_updated),
         }
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data, expected)
+        self.assertEqual(response.json(), expected)
         
 
     def test_create(self):
@@ -79,6 +121,10 @@ class TestProduct(ShopAPITestCase):
                         'description': product.description,
                         'ecoscore': ECOSCORE_GRADE,
                         'category_id': product.category_id,
+                        'min_price': None,
+                        'max_price': None,
+                        'avg_price': None,
+                        'article_count': 0,
                         'articles': [],
                         'date_created': self.format_datetime(product.date_created),
                         'date_updated': self.format_datetime(product.date_updated),
@@ -123,3 +169,1359 @@ class TestProduct(ShopAPITestCase):
         self.assertEqual(delete_response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
         self.assertEquals(self.client.get(self.url  + f'{product.id}/').status_code, status.HTTP_200_OK)
 
+    def test_parent_ids_must_be_integers(self):
+        for url, parameter in [(self.url, 'category_id'), (reverse('async-product-list'), 'category_id'),
+                               (reverse('article-list'), 'product_id')]:
+            response = self.client.get(url, {parameter: 'abc'})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.json(), {'detail': f'{parameter} must be an integer.'})
+
+
+
+# Responses aren't cached, so each request reads the ecoscores again
+@override_settings(CATALOG_RESPONSE_CACHE={'ENABLED': False})
+class TestEcoscoreCache(ShopAPITestCase):
+    url = reverse_lazy('product-list')
+
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name='Fruits', active=True)
+        for name in ['Abricot', 'Banane', 'Cerise']:
+            Product.objects.create(name=name, active=True, category=category)
+
+    def test_list_page_calls_external_api_once(self):
+        with mock.patch('shop.models.Product.call_external_api', autospec=True,
+                        side_effect=mock_openfoodfact_success) as call:
+            self.client.get(self.url)
+            self.client.get(self.url)
+        self.assertEqual(call.call_count, 1)
+        stats = ecoscore_cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_failures_are_negatively_cached(self):
+        with mock.patch('shop.models.Product.call_external_api', autospec=True,
+                        side_effect=mock_openfoodfact_failure) as call:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(response.json()['results'][0]['ecoscore'])
+        self.client.get(self.url)
+        self.assertEqual(call.call_count, 1)
+        self.assertEqual(ecoscore_cache.stats()['negative_hits'], 1)
+
+    @override_settings(ECOSCORE_CACHE={'TTL': -1})
+    def test_expired_entries_are_fetched_again(self):
+        with mock.patch('shop.models.Product.call_external_api', autospec=True,
+                        side_effect=mock_openfoodfact_success) as call:
+            self.client.get(self.url)
+            self.client.get(self.url)
+        self.assertEqual(call.call_count, 2)
+
+    def test_page_is_prefetched_concurrently(self):
+        for product in Product.objects.all():
+            product.barcode = str(product.pk)
+            product.save()
+        Product.objects.create(name='Datte', active=True, category=Category.objects.get(), barcode='datte')
+        ecoscore_cache.set('datte', 'a')
+        with mock.patch('shop.models.Product.call_external_api', autospec=True,
+                        side_effect=mock_openfoodfact_success) as call:
+            response = self.client.get(self.url)
+        self.assertEqual(call.call_count, 3)
+        self.assertEqual(sorted(product['ecoscore'] for product in response.json()['results']),
+                         ['a', ECOSCORE_GRADE, ECOSCORE_GRADE, ECOSCORE_GRADE])
+
+    def test_set_many_updates_stored_barcodes(self):
+        # Expired, or stored meanwhile by a concurrent request
+        ecoscore_cache.set('1', None)
+        EcoscoreCacheEntry.objects.update(expires_at=timezone.now())
+        ecoscore_cache.set_many({'1': 'a', '2': 'b'})
+        self.assertEqual(ecoscore_cache.get_many(['1', '2']), {'1': 'a', '2': 'b'})
+        self.assertEqual(EcoscoreCacheEntry.objects.count(), 2)
+
+    @override_settings(ECOSCORE_CACHE={'MAX_ENTRIES': 2})
+    def test_least_recently_used_entries_are_evicted(self):
+        for barcode in ['1', '2', '3']:
+            ecoscore_cache.set(barcode, 'a')
+        self.assertEqual(set(EcoscoreCacheEntry.objects.values_list('barcode', flat=True)), {'2', '3'})
+        self.assertEqual(ecoscore_cache.stats()['evictions'], 1)
+
+    def test_stats_are_restricted_to_staff(self):
+        url = reverse('admin-ecoscore-cache-list')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_401_UNAUTHORIZED)
+        admin = get_user_model().objects.create_superuser('admin', 'admin@oc.drf', 'password')
+        self.client.force_authenticate(admin)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['entries'], 0)
+
+
+class TestRefreshEcoscores(ShopAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name='Fruits', active=True)
+        self.product = Product.objects.create(name='Abricot', active=True, category=self.category)
+        Product.objects.create(name='Banane', active=True, category=self.category, barcode='123')
+
+    def refresh(self, side_effect, **options):
+        with mock.patch('shop.models.Product.call_external_api', autospec=True, side_effect=side_effect) as call:
+            call_command('refresh_ecoscores', rate=0, stdout=StringIO(), **options)
+        return call
+
+    def test_refresh_stores_grades_then_reads_make_no_external_call(self):
+        call = self.refresh(mock_openfoodfact_success)
+        self.assertEqual(call.call_count, 2)
+        self.assertEqual(set(Product.objects.values_list('ecoscore_grade', flat=True)), {ECOSCORE_GRADE})
+
+        with mock.patch('shop.models.Product.call_external_api') as call:
+            response = self.client.get(reverse('category-detail', kwargs={'pk': self.category.pk}))
+            self.client.get(reverse('product-list'))
+        call.assert_not_called()
+        self.assertEqual(response.json()['products'][0]['ecoscore'], ECOSCORE_GRADE)
+
+    def test_fresh_rows_are_skipped_and_failures_retried(self):
+        self.refresh(mock_openfoodfact_failure)
+        self.assertFalse(Product.objects.filter(ecoscore_fetched_at__isnull=False).exists())
+
+        self.refresh(mock_openfoodfact_success, start_after=self.product.pk)
+        self.assertEqual(Product.objects.filter(ecoscore_fetched_at__isnull=True).get(), self.product)
+
+        call = self.refresh(mock_openfoodfact_success)
+        self.assertEqual(call.call_count, 1)
+        self.assertFalse(Product.objects.filter(ecoscore_fetched_at__isnull=True).exists())
+
+
+class TestExternalAPIClient(SimpleTestCase):
+
+    def test_connections_are_kept_alive(self):
+        client = ExternalAPIClient()
+        with OpenFoodFactStubServer() as stub:
+            for _ in range(3):
+                self.assertEqual(client.request('GET', stub.url).json()['product']['ecoscore_grade'], ECOSCORE_GRADE)
+        self.assertEqual(stub.calls, 3)
+        self.assertEqual(len(stub.client_ports), 1)
+
+    def test_slow_upstream_times_out(self):
+        client = ExternalAPIClient(READ_TIMEOUT=0.1, RETRIES=0)
+        with OpenFoodFactStubServer(delay=0.5) as stub:
+            with self.assertRaises(RequestException):
+                client.request('GET', stub.url)
+        self.assertEqual(list(client.stats().values())[0]['errors'], 1)
+
+    def test_unavailable_upstream_is_retried(self):
+        client = ExternalAPIClient(BACKOFF_FACTOR=0)
+        with OpenFoodFactStubServer(statuses=[status.HTTP_503_SERVICE_UNAVAILABLE, status.HTTP_200_OK]) as stub:
+            self.assertEqual(client.request('GET', stub.url).status_code, status.HTTP_200_OK)
+        self.assertEqual(stub.calls, 2)
+
+    def test_circuit_opens_then_recovers(self):
+        client = ExternalAPIClient(RETRIES=0, FAILURE_THRESHOLD=2, RECOVERY_TIMEOUT=0.2)
+        with OpenFoodFactStubServer(statuses=[status.HTTP_500_INTERNAL_SERVER_ERROR] * 2 + [status.HTTP_200_OK]) as stub:
+            client.request('GET', stub.url)
+            client.request('GET', stub.url)
+            with self.assertRaises(CircuitOpenError):
+                client.request('GET', stub.url)
+            self.assertEqual(stub.calls, 2)
+            time.sleep(0.2)
+            self.assertEqual(client.request('GET', stub.url).status_code, status.HTTP_200_OK)
+        stats = list(client.stats().values())[0]
+        self.assertEqual(stats['circuit'], 'closed')
+        self.assertEqual(stats['short_circuited'], 1)
+
+    async def test_async_client_retries_then_raises_request_exceptions(self):
+        client = AsyncExternalAPIClient(BACKOFF_FACTOR=0)
+        with OpenFoodFactStubServer(statuses=[status.HTTP_503_SERVICE_UNAVAILABLE, status.HTTP_200_OK]) as stub:
+            response = await client.request('GET', stub.url)
+        self.assertEqual(response.json()['product']['ecoscore_grade'], ECOSCORE_GRADE)
+        self.assertEqual(stub.calls, 2)
+        with OpenFoodFactStubServer(delay=0.5) as stub:
+            with self.assertRaises(RequestException):
+                await client.request('GET', stub.url, timeout=0.1)
+        self.assertEqual(stub.calls, 3)
+        await client.close()
+
+# The tree itself, the snapshots serving it are covered by TestSnapshots
+@override_settings(CATALOG_SNAPSHOTS={'ENABLED': False})
+class TestQueryCount(ShopAPITestCase):
+
+    def create_tree(self, products, articles):
+        category = Category.objects.create(name=f'Fruits {Category.objects.count()}', active=True)
+        for index in range(products):
+            # Stored ecoscore, so only the tree itself is queried
+            product = Product.objects.create(name=f'Produit {index}', active=True, category=category,
+                                             ecoscore_grade='a', ecoscore_fetched_at=timezone.now())
+            Product.objects.create(name=f'Inactif {index}', active=False, category=category)
+            for article_index in range(articles):
+                Article.objects.create(name=f'Article {article_index}', price=2, active=True, product=product)
+                Article.objects.create(name=f'Inactif {article_index}', price=2, active=False, product=product)
+        return category
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries), response.json()
+
+    def test_category_detail_query_count_is_constant(self):
+        small = self.create_tree(products=1, articles=1)
+        large = self.create_tree(products=5, articles=4)
+        small_count, _ = self.count_queries(reverse('category-detail', kwargs={'pk': small.pk}))
+        large_count, data = self.count_queries(reverse('category-detail', kwargs={'pk': large.pk}))
+        # The table versions, then one conditional GET validator, one select and one price aggregate per level
+        self.assertEqual(small_count, 9)
+        self.assertEqual(large_count, small_count)
+        self.assertEqual(len(data['products']), 5)
+        self.assertEqual({len(product['articles']) for product in data['products']}, {4})
+
+    def test_product_detail_query_count_is_constant(self):
+        category = self.create_tree(products=1, articles=6)
+        product = category.products.get(active=True)
+        count, data = self.count_queries(reverse('product-detail', kwargs={'pk': product.pk}))
+        self.assertEqual(count, 6)
+        self.assertEqual(len(data['articles']), 6)
+
+
+class TestPagination(ShopAPITestCase):
+    url = reverse_lazy('category-list')
+
+    def setUp(self):
+        super().setUp()
+        self.categories = [Category.objects.create(name=f'Catégorie {index}', active=True) for index in range(3)]
+
+    def test_keyset_pagination_follows_cursors(self):
+        response = self.client.get(self.url, {'pagination': 'cursor', 'limit': 2})
+        first_page = response.json()
+        self.assertNotIn('count', first_page)
+        self.assertIsNone(first_page['previous'])
+        self.assertEqual([row['id'] for row in first_page['results']], [category.pk for category in self.categories[:2]])
+
+        second_page = self.client.get(first_page['next']).json()
+        self.assertEqual([row['id'] for row in second_page['results']], [self.categories[2].pk])
+        self.assertIsNone(second_page['next'])
+
+    def test_limit_offset_count_is_not_repeated(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, {'limit': 1, 'offset': 2})
+        self.assertEqual(response.json()['count'], 3)
+        # The conditional GET validators already counted the rows
+        self.assertEqual(len([query for query in context.captured_queries
+                              if 'COUNT("shop_category"' in query['sql']]), 1)
+
+    def counts(self):
+        with CaptureQueriesContext(connection) as context:
+            count = self.client.get(self.url).json()['count']
+        return count, len([query for query in context.captured_queries if 'COUNT("shop_category"' in query['sql']])
+
+    @override_settings(CATALOG_RESPONSE_CACHE={'ENABLED': False})
+    def test_count_is_cached_until_a_write(self):
+        self.assertEqual(self.counts(), (3, 1))
+        self.assertEqual(self.counts(), (3, 0))
+        self.categories[0].disable()
+        self.assertEqual(self.counts(), (2, 1))
+        # Writes sending no signal wait for CATALOG_COUNT_CACHE_TTL
+        Category.objects.filter(pk=self.categories[1].pk).update(active=False)
+        self.assertEqual(self.counts(), (2, 0))
+        with override_settings(CATALOG_COUNT_CACHE_TTL=0):
+            self.assertEqual(self.counts(), (1, 1))
+
+    def test_count_follows_writes(self):
+        # The async views have no validators, their paginator counts every time
+        url = reverse('async-category-list')
+        self.assertEqual(self.client.get(url).json()['count'], 3)
+        self.categories[0].disable()
+        self.assertEqual(self.client.get(url).json()['count'], 2)
+
+
+class TestQueryPlans(ShopAPITestCase):
+    """ Each hot query of the public endpoints must be served by an index, never by a table scan """
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    # index is the name expected in the plan, or a tuple of the names the planner may pick from
+    def assertUsesIndex(self, queryset, index=''):
+        plan = self.query_plan(queryset)
+        table = queryset.model._meta.db_table
+        indexes = index if isinstance(index, tuple) else (index,)
+        self.assertTrue(any(f'{table} USING' in step and any(name in step for name in indexes) for step in plan), plan)
+        self.assertFalse([step for step in plan if step == f'SCAN {table}'], plan)
+
+    def test_active_filters_use_partial_indexes(self):
+        self.assertUsesIndex(Category.objects.filter(active=True), 'shop_category_active_idx')
+        self.assertUsesIndex(Product.objects.filter(active=True), 'shop_product_active_idx')
+        # Both are partial indexes over the active rows, the (price, product) one may be smaller to scan
+        self.assertUsesIndex(Article.objects.filter(active=True), ('shop_article_active_idx', 'shop_article_price_idx'))
+
+    def test_foreign_key_filters_use_composite_indexes(self):
+        self.assertUsesIndex(Product.objects.filter(active=True, category_id=1), 'shop_product_category_idx')
+        self.assertUsesIndex(Article.objects.filter(active=True, product_id=1), 'shop_article_product_idx')
+        self.assertUsesIndex(Product.objects.filter(active=True, category_id__in=[1, 2]), 'shop_product_category_idx')
+        self.assertUsesIndex(Article.objects.filter(active=True, product_id__in=[1, 2]), 'shop_article_product_idx')
+
+    def test_price_range_uses_the_price_index(self):
+        self.assertUsesIndex(Article.objects.price_range(1, 5), 'shop_article_price_idx')
+        self.assertUsesIndex(Article.objects.price_range(min_price=1), 'shop_article_price_idx')
+        # Subquery of the ?min_price= / ?max_price= filters of the lists
+        self.assertUsesIndex(Article.objects.price_range(1, 5).values('product_id'), 'shop_article_price_idx')
+
+    def test_category_name_lookup_uses_unique_index(self):
+        # SQLite backs the unique constraint with its own automatic index
+        self.assertUsesIndex(Category.objects.filter(name='Fruits'), '(name=?)')
+
+
+class TestBulkStatus(ShopAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(get_user_model().objects.create_superuser('admin', 'admin@oc.drf', 'password'))
+        self.categories = []
+        for name in ['Fruits', 'Légumes', 'Épicerie']:
+            category = Category.objects.create(name=name, active=True)
+            product = Product.objects.create(name=f'{name} produit', active=True, category=category)
+            Article.objects.create(name='Unité', price=2, active=True, product=product)
+            self.categories.append(category)
+
+    def test_category_disable_cascades_to_articles(self):
+        self.categories[0].disable()
+        self.assertFalse(Article.objects.filter(product__category=self.categories[0], active=True).exists())
+        self.assertEqual(Article.objects.filter(active=True).count(), 2)
+
+    def test_bulk_disable_by_ids(self):
+        ids = [category.pk for category in self.categories[:2]]
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(reverse('admin-category-bulk-disable'), {'ids': ids}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # One UPDATE per table, besides the table versions
+        self.assertEqual(len([query for query in context.captured_queries if query['sql'].startswith('UPDATE')
+                              and 'shop_catalogversion' not in query['sql']]), 3)
+        self.assertEqual(response.json(), {'categories': 2, 'products': 2, 'articles': 2})
+        self.assertEqual(list(Category.objects.filter(active=True)), [self.categories[2]])
+        self.assertEqual(Article.objects.filter(active=True).count(), 1)
+
+    def test_bulk_enable_by_filter_with_cascade(self):
+        Category.objects.all().disable()
+        response = self.client.post(reverse('admin-category-bulk-enable'),
+                                    {'filter': {'name__in': ['Fruits']}, 'cascade': True}, format='json')
+        self.assertEqual(response.json(), {'categories': 1, 'products': 1, 'articles': 1})
+        self.assertEqual(list(Category.objects.filter(active=True)), [self.categories[0]])
+
+    def test_bulk_selection_is_validated(self):
+        url = reverse('admin-category-bulk-disable')
+        self.assertEqual(self.client.post(url, {}, format='json').status_code, status.HTTP_400_BAD_REQUEST)
+        for selection in [{'description': 'x'}, {}, {'name': ['Fruits']}, {'name__in': 'Fruits'},
+                          {'name__in': []}, {'name__in': [{'a': 1}]}, {'name__icontains': {'a': 1}}, 'Fruits']:
+            response = self.client.post(url, {'filter': selection}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, selection)
+        self.assertEqual(Category.objects.filter(active=True).count(), 3)
+        response = self.client.post(url, {'filter': {'description': 'x'}}, format='json')
+        self.assertEqual(response.json(), {'filter': ['Unsupported filters: description.']})
+
+
+class TestArticleBulk(ShopAPITestCase):
+    url = reverse_lazy('admin-article-bulk')
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(get_user_model().objects.create_superuser('admin', 'admin@oc.drf', 'password'))
+        category = Category.objects.create(name='Fruits', active=True)
+        self.product = Product.objects.create(name='Banane', active=True, category=category)
+        self.inactive = Product.objects.create(name='Ananas', active=False, category=category)
+        self.article = Article.objects.create(name='Unité', price=2, active=True, product=self.product)
+
+    def test_json_upsert_reports_row_errors(self):
+        rows = [
+            {'product': self.product.pk, 'name': 'Unité', 'price': '2.20'},
+            {'product': self.product.pk, 'name': 'Lot de 2', 'price': '4.00', 'active': True},
+            {'product': self.inactive.pk, 'name': 'Unité', 'price': '3.00'},
+            {'product': self.product.pk, 'name': 'Lot de 3'},
+            {'product': 0, 'name': 'Unité', 'price': '3.00'},
+        ]
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(self.url + '?batch_size=1', rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual((data['created'], data['updated']), (1, 1))
+        self.assertEqual([error['index'] for error in data['errors']], [2, 3, 4])
+        # One product lookup for the whole batch
+        self.assertEqual(len([query for query in context.captured_queries if 'FROM "shop_product"' in query['sql']]), 1)
+
+        self.article.refresh_from_db()
+        self.assertEqual(str(self.article.price), '2.20')
+        self.assertGreater(self.article.date_updated, self.article.date_created)
+        self.assertTrue(Article.objects.get(name='Lot de 2').active)
+
+    def test_string_product_ids_are_coerced(self):
+        rows = [
+            {'product': str(self.product.pk), 'name': 'Unité', 'price': '2.50'},
+            {'product': str(self.product.pk), 'name': 'Lot de 4', 'price': '7.00'},
+            {'product': 'banane', 'name': 'Unité', 'price': '3.00'},
+        ]
+        response = self.client.post(self.url, rows, format='json')
+        data = response.json()
+        self.assertEqual((data['created'], data['updated']), (1, 1))
+        self.assertEqual([error['index'] for error in data['errors']], [2])
+        self.article.refresh_from_db()
+        self.assertEqual(str(self.article.price), '2.50')
+
+    def test_natural_key_is_unique(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Article.objects.create(name='Unité', price=3, active=True, product=self.product)
+        response = self.client.post(reverse('admin-article-list'),
+                                    {'name': 'Unité', 'price': 3, 'product': self.product.pk}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_ndjson_stream(self):
+        body = '\n'.join([
+            json.dumps({'product': self.product.pk, 'name': 'Unité', 'price': '1.50'}),
+            json.dumps({'product': self.product.pk, 'name': 'Lot de 5', 'price': '6.00'}),
+            '',
+        ])
+        response = self.client.post(self.url, body, content_type='application/x-ndjson')
+        self.assertEqual(response.json(), {'created': 1, 'updated': 1, 'errors': []})
+
+        response = self.client.post(self.url, '{"product": 1,\n', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestConditionalGet(ShopAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name='Fruits', active=True)
+        self.product = Product.objects.create(name='Banane', active=True, category=self.category)
+        self.article = Article.objects.create(name='Unité', price=2, active=True, product=self.product)
+        self.url = reverse('category-detail', kwargs={'pk': self.category.pk})
+
+    @mock.patch('shop.models.Product.call_external_api', mock_openfoodfact_success)
+    def test_unchanged_resource_answers_not_modified(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        with mock.patch('shop.models.Product.call_external_api') as call:
+            not_modified = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+            self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(not_modified['ETag'], etag)
+        call.assert_not_called()
+
+    @mock.patch('shop.models.Product.call_external_api', mock_openfoodfact_success)
+    def test_nested_change_invalidates_validators(self):
+        etag = self.client.get(self.url)['ETag']
+        self.article.price = 3
+        self.article.save()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+        etag = self.client.get(self.url)['ETag']
+        self.product.disable()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['products'], [])
+
+    @override_settings(CATALOG_RESPONSE_CACHE={'ENABLED': False})
+    @mock.patch('shop.models.Product.call_external_api', mock_openfoodfact_success)
+    def test_disabled_rows_move_last_modified(self):
+        url = reverse('product-list')
+        Product.objects.create(name='Pomme', active=True, category=self.category)
+        # Written seconds ago, If-Modified-Since having a one second resolution
+        past = timezone.now() - timedelta(seconds=5)
+        for model in [CatalogVersion, Product, Article]:
+            model.objects.update(date_updated=past)
+        last_modified = self.client.get(url)['Last-Modified']
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+
+        # The table versions move when the write commits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.disable()
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['count'], 1)
+
+    def test_versions_move_once_per_transaction(self):
+        with CaptureQueriesContext(connection) as context, self.captureOnCommitCallbacks(execute=True):
+            for price in [3, 4, 5]:
+                self.article.price = price
+                self.article.save()
+            self.product.disable()
+        updates = [query for query in context.captured_queries if query['sql'].startswith('UPDATE "shop_catalogversion"')]
+        self.assertEqual(len(updates), 1)
+
+    def test_list_validators_depend_on_filters(self):
+        url = reverse('article-list')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(url, {'product_id': self.product.pk}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class TestResponseCache(ShopAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.categories = []
+        # Committed, as the writes the tests make later
+        with self.captureOnCommitCallbacks(execute=True):
+            for name in ['Fruits', 'Légumes']:
+                category = Category.objects.create(name=name, active=True)
+                product = Product.objects.create(name=f'{name} produit', active=True, category=category,
+                                                 ecoscore_grade='b', ecoscore_fetched_at=timezone.now())
+                Article.objects.create(name='Unité', price=2, active=True, product=product)
+                self.categories.append(category)
+
+    def detail_url(self, category):
+        return reverse('category-detail', kwargs={'pk': category.pk})
+
+    def test_second_request_is_served_from_cache(self):
+        first = self.client.get(self.detail_url(self.categories[0]))
+        with self.assertNumQueries(0):
+            second = self.client.get(self.detail_url(self.categories[0]))
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+        with self.assertNumQueries(0):
+            not_modified = self.client.get(self.detail_url(self.categories[0]), HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_query_parameters_are_part_of_the_key(self):
+        url = reverse('product-list')
+        self.client.get(url)
+        response = self.client.get(url, {'category_id': self.categories[1].pk})
+        self.assertEqual([row['name'] for row in response.json()['results']], ['Légumes produit'])
+
+    def test_article_change_only_invalidates_its_own_tree(self):
+        for category in self.categories:
+            self.client.get(self.detail_url(category))
+        article = Article.objects.get(product__category=self.categories[0])
+        article.price = 3
+        # Loaded without its product, whose category is looked up at commit
+        with self.captureOnCommitCallbacks(execute=True):
+            article.save()
+        with self.assertNumQueries(0):
+            self.client.get(self.detail_url(self.categories[1]))
+        response = self.client.get(self.detail_url(self.categories[0]))
+        self.assertEqual(response.json()['products'][0]['articles'][0]['price'], '3.00')
+
+    def test_article_saves_look_their_products_up_once(self):
+        articles = list(Article.objects.all())
+        with CaptureQueriesContext(connection) as context, self.captureOnCommitCallbacks(execute=True):
+            for article in articles:
+                article.price = 4
+                article.save()
+        self.assertEqual(len([query for query in context.captured_queries if 'FROM "shop_product"' in query['sql']]), 1)
+
+    def test_set_based_disable_invalidates_lists_and_trees(self):
+        product_list = reverse('product-list')
+        self.assertEqual(self.client.get(product_list).json()['count'], 2)
+        self.client.get(self.detail_url(self.categories[0]))
+        Category.objects.filter(pk=self.categories[0].pk).disable()
+        self.assertEqual(self.client.get(product_list).json()['count'], 1)
+        self.assertEqual(self.client.get(self.detail_url(self.categories[0])).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_moved_rows_invalidate_their_previous_parents(self):
+        admin = get_user_model().objects.create_superuser('admin', 'admin@oc.drf', 'password')
+        fruits, legumes = [category.products.get() for category in self.categories]
+        article = fruits.articles.get()
+        product_url = reverse('product-detail', kwargs={'pk': fruits.pk})
+        self.assertEqual(len(self.client.get(product_url).json()['articles']), 1)
+        self.client.get(self.detail_url(self.categories[0]))
+
+        self.client.force_authenticate(admin)
+        # The category of the previous product is looked up at commit
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(reverse('admin-article-detail', kwargs={'pk': article.pk}),
+                                       {'name': 'Lot de 2', 'price': 2, 'product': legumes.pk}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(product_url).json()['articles'], [])
+        self.assertEqual(self.client.get(self.detail_url(self.categories[0])).json()['products'][0]['articles'], [])
+
+        self.client.get(self.detail_url(self.categories[0]))
+        legumes = Product.objects.get(pk=legumes.pk)
+        legumes.category = self.categories[0]
+        legumes.save()
+        self.assertEqual(self.client.get(self.detail_url(self.categories[1])).json()['products'], [])
+
+    def test_bulk_inserts_invalidate_the_product_lists(self):
+        url = reverse('product-list')
+        self.assertEqual(self.client.get(url).json()['count'], 2)
+        Product.objects.bulk_create([Product(name='Pomme', active=True, category=self.categories[0])])
+        catalog_updated.send(sender=Product, products=[])
+        self.assertEqual(self.client.get(url).json()['count'], 3)
+
+    def test_file_based_backend(self):
+        with tempfile.TemporaryDirectory() as location:
+            backend = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+            with override_settings(CACHES={'default': backend, 'catalog': backend}):
+                first = self.client.get(reverse('article-list'))
+                with self.assertNumQueries(0):
+                    self.assertEqual(self.client.get(reverse('article-list')).content, first.content)
+                Article.objects.update(price=4)
+                Product.objects.filter(pk=Article.objects.get(product__category=self.categories[0]).product_id).disable()
+                self.assertEqual(self.client.get(reverse('article-list')).json()['count'], 1)
+
+
+class TestCatalogExport(ShopAPITestCase):
+    url = reverse_lazy('export-list')
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name='Fruits', active=True)
+        self.product = Product.objects.create(name='Banane', active=True, category=self.category, ecoscore_grade='b')
+        self.article = Article.objects.create(name='Unité', price=2.5, active=True, product=self.product)
+        Article.objects.create(name='Lot de 2', price=4.5, active=False, product=self.product)
+        other = Category.objects.create(name='Légumes', active=True)
+        Product.objects.create(name='Courgette', active=True, category=other)
+
+    def export(self, **params):
+        with mock.patch('shop.models.Product.call_external_api') as call:
+            response = self.client.get(self.url, params)
+        call.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content).decode()
+
+    def test_ndjson_export(self):
+        rows = [json.loads(line) for line in self.export(category_id=self.category.pk).splitlines()]
+        self.assertEqual([(row['type'], row['name']) for row in rows],
+                         [('category', 'Fruits'), ('product', 'Banane'), ('article', 'Unité')])
+        article = rows[2]
+        self.assertEqual(article['parent_id'], self.product.pk)
+        self.assertEqual(article['price'], '2.50')
+        self.assertEqual(article['date_created'], self.format_datetime(self.article.date_created))
+        self.assertEqual(rows[1]['ecoscore'], 'b')
+
+    def test_csv_export(self):
+        lines = self.export(output='csv').splitlines()
+        self.assertEqual(lines[0], 'type,id,parent_id,name,description,active,price,ecoscore,date_created,date_updated')
+        self.assertEqual(len(lines), 1 + 2 + 2 + 1)
+
+    def test_inactive_rows_are_restricted_to_staff(self):
+        self.assertEqual(self.client.get(self.url, {'active': 'all'}).status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(get_user_model().objects.create_superuser('admin', 'admin@oc.drf', 'password'))
+        self.assertEqual(len(self.export(active='all').splitlines()), 6)
+        self.assertEqual(self.client.get(self.url, {'output': 'xml'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(CATALOG_CHANGES_LAG=0)
+class TestCatalogChanges(ShopAPITestCase):
+    url = reverse_lazy('changes-list')
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name='Fruits', active=True)
+        self.product = Product.objects.create(name='Banane', active=True, category=self.category)
+        self.article = Article.objects.create(name='Unité', price=2, active=True, product=self.product)
+
+    def changes(self, since=None):
+        response = self.client.get(self.url, {'since': since} if since else {})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()
+
+    def ids(self, changes, kind, state):
+        return [row['id'] if isinstance(row, dict) else row for row in changes[kind][state]]
+
+    def test_full_then_delta_sync(self):
+        full = self.changes()
+        self.assertEqual(self.ids(full, 'articles', 'created'), [self.article.pk])
+
+        self.article.price = 3
+        self.article.save()
+        other = Article.objects.create(name='Lot de 2', price=4, active=True, product=self.product)
+        delta = self.changes(full['watermark'])
+        self.assertEqual(self.ids(delta, 'articles', 'updated'), [self.article.pk])
+        self.assertEqual(self.ids(delta, 'articles', 'created'), [other.pk])
+        self.assertEqual(delta['articles']['updated'][0]['price'], '3.00')
+        self.assertEqual(self.ids(delta, 'categories', 'updated'), [])
+
+        self.assertEqual(self.changes(delta['watermark'])['articles'],
+                         {'created': [], 'updated': [], 'deactivated': [], 'deleted': []})
+
+    def test_set_based_deactivations_are_reported(self):
+        watermark = self.changes()['watermark']
+        Category.objects.filter(pk=self.category.pk).disable()
+        delta = self.changes(watermark)
+        self.assertEqual(self.ids(delta, 'categories', 'deactivated'), [self.category.pk])
+        self.assertEqual(self.ids(delta, 'products', 'deactivated'), [self.product.pk])
+        self.assertEqual(self.ids(delta, 'articles', 'deactivated'), [self.article.pk])
+
+    def test_deletes_are_reported(self):
+        watermark = self.changes()['watermark']
+        ids = [self.category.pk, self.product.pk, self.article.pk]
+        # Cascading to the products and articles
+        self.category.delete()
+        delta = self.changes(watermark)
+        self.assertEqual([self.ids(delta, kind, 'deleted') for kind in ['categories', 'products', 'articles']],
+                         [[pk] for pk in ids])
+        self.assertEqual(self.changes(delta['watermark'])['categories']['deleted'], [])
+
+    def test_cascading_deletes_are_set_based(self):
+        generate_catalog(3, 10, 5, seed=0)
+        with CaptureQueriesContext(connection) as context:
+            deleted, _ = Category.objects.filter(name__startswith='Catégorie').delete()
+        self.assertEqual(deleted, 3 + 30 + 150)
+        # One tombstone INSERT per table, the cascades don't go row by row
+        queries = [query['sql'] for query in context.captured_queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len([sql for sql in queries if sql.startswith('INSERT INTO "shop_catalogtombstone"')]), 3)
+        self.assertLess(len(queries), 20)
+        self.assertEqual(CatalogTombstone.objects.filter(kind='articles').count(), 150)
+
+    def test_pages_follow_the_cursor(self):
+        for index in range(4):
+            Article.objects.create(name=f'Lot de {index + 2}', price=4, active=True, product=self.product)
+        watermark = self.changes()['watermark']
+        Article.objects.update(price=5, date_updated=timezone.now())
+        Article.objects.filter(name='Lot de 2').delete()
+
+        pages = [self.client.get(self.url, {'since': watermark, 'limit': 2}).json()]
+        while pages[-1]['next']:
+            pages.append(self.client.get(pages[-1]['next']).json())
+        # 4 updated articles, 2 per page
+        self.assertEqual(len(pages), 2)
+        self.assertEqual({page['watermark'] for page in pages}, {pages[0]['watermark']})
+        self.assertTrue(all(len(page['articles']['updated']) <= 2 for page in pages))
+        updated = [row['id'] for page in pages for row in page['articles']['updated']]
+        self.assertEqual(sorted(updated), sorted(Article.objects.values_list('pk', flat=True)))
+        self.assertEqual(len([pk for page in pages for pk in page['articles']['deleted']]), 1)
+        self.assertEqual([len(page['categories']['updated']) for page in pages], [0, 0])
+
+    def test_invalid_watermark(self):
+        self.assertEqual(self.client.get(self.url, {'since': 'hier'}).status_code, status.HTTP_400_BAD_REQUEST)
+        for query in [{'cursor': 'abc'}, {'limit': 0}, {'limit': 100000}]:
+            self.assertEqual(self.client.get(self.url, query).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestSyntheticCatalog(ShopAPITestCase):
+
+    def snapshot(self):
+        return list(Article.objects.order_by('pk').values_list(
+            'product__category__name', 'product__category__active', 'product__name', 'product__active',
+            'name', 'active', 'price'))
+
+    def test_generation_is_deterministic_and_batched(self):
+        with CaptureQueriesContext(connection) as context:
+            counts = generate_catalog(4, 5, 6, seed=42, active_ratio=0.7, batch_size=50)
+        self.assertEqual(counts, {'categories': 4, 'products': 20, 'articles': 120})
+        self.assertEqual(Article.objects.count(), 120)
+        self.assertLess(len(context.captured_queries), 30)
+
+        first = self.snapshot()
+        Category.objects.all().delete()
+        generate_catalog(4, 5, 6, seed=42, active_ratio=0.7, batch_size=50)
+        self.assertEqual(self.snapshot(), first)
+
+    def test_second_catalog_is_numbered_after_the_first(self):
+        generate_catalog(3, 1, 1, seed=0)
+        Category.objects.create(name='Catégorie spéciale')
+        self.assertEqual(generate_catalog(2, 1, 1, seed=0)['categories'], 2)
+        self.assertEqual(sorted(Category.objects.filter(products__isnull=False).values_list('name', flat=True)),
+                         [f'Catégorie {index}' for index in range(5)])
+        self.assertEqual(Product.objects.filter(name='Produit 4-0').count(), 1)
+
+    def test_inactive_parents_have_inactive_children(self):
+        generate_catalog(10, 5, 3, seed=1, active_ratio=0.5)
+        self.assertTrue(Category.objects.filter(active=False).exists())
+        self.assertFalse(Product.objects.filter(active=True, category__active=False).exists())
+        self.assertFalse(Article.objects.filter(active=True, product__active=False).exists())
+
+    def test_reseed_clears_the_catalog_set_based(self):
+        call_command('init_local_dev', categories=3, products=5, articles=4, stdout=StringIO())
+        with CaptureQueriesContext(connection) as context:
+            clear_catalog()
+        queries = [query['sql'] for query in context.captured_queries if 'SAVEPOINT' not in query['sql']]
+        self.assertLess(len(queries), 20)
+        self.assertFalse(Product.objects.exists() or Article.objects.exists())
+        self.assertEqual(CatalogTombstone.objects.filter(kind='articles').count(), 60)
+        call_command('init_local_dev', categories=3, products=5, articles=4, stdout=StringIO())
+        self.assertEqual(Article.objects.count(), 60)
+
+    def test_init_local_dev_options(self):
+        call_command('init_local_dev', categories=2, products=3, articles=4, stdout=StringIO())
+        self.assertEqual(Article.objects.count(), 24)
+
+
+class TestBenchmarkBudgets(ShopAPITestCase):
+
+    # Query and external call budgets of the stored baseline, latency is left to the benchmark command
+    def test_small_dataset_stays_within_budgets(self):
+        results = run_benchmarks(['small'], repeat=1)
+        self.assertEqual({measures['status'] for measures in results['small'].values()}, {status.HTTP_200_OK})
+        baseline = json.loads(BASELINE.read_text())
+        self.assertEqual(compare(results, baseline, latency_tolerance=float('inf')), [])
+
+
+    @override_settings(CATALOG_CHANGES_LAG=0)
+    def test_changes_feed_reports_a_delta(self):
+        generate_catalog(*SIZES['small'], seed=0)
+        data = self.client.get(reverse('changes-list') + write_changes()).json()
+        self.assertEqual(len(data['categories']['created']), 1)
+        self.assertEqual(len(data['products']['created']), 1)
+        self.assertEqual(len(data['products']['deleted']), 1)
+        self.assertEqual(len(data['articles']['deleted']), SIZES['small'][2])
+        self.assertTrue(data['articles']['updated'])
+
+
+@override_settings(PERFORMANCE_INSTRUMENTATION={'ENABLED': True, 'SLOW_REQUEST_MS': 0},
+                   CATALOG_RESPONSE_CACHE={'ENABLED': False})
+class TestPerformanceInstrumentation(ShopAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name='Fruits', active=True)
+        self.product = Product.objects.create(name='Pomme', active=True, category=category)
+        Article.objects.create(name='Pomme Golden', price=2, active=True, product=self.product)
+
+    def timings(self, response):
+        return {entry.split(';')[0]: entry for entry in response['Server-Timing'].split(', ')}
+
+    def test_server_timing_and_log_line(self):
+        # A real HTTP call, through the external API client
+        with OpenFoodFactStubServer() as stub, mock.patch('shop.models.ECOSCORE_URL', stub.url):
+            with self.assertLogs('shop.performance', level='INFO') as logs:
+                response = self.client.get(reverse('product-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        timings = self.timings(response)
+        self.assertEqual(set(timings), {'auth', 'db', 'external', 'serialize', 'total'})
+        self.assertIn('desc="External API (1)"', timings['external'])
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['path'], reverse('product-list'))
+        self.assertEqual(line['external_count'], 1)
+        self.assertGreater(line['db_count'], 0)
+        # SLOW_REQUEST_MS is 0, every request comes with its SQL
+        slow = json.loads(logs.records[1].getMessage())
+        self.assertEqual(len(slow['sql']), line['db_count'])
+
+    def test_concurrent_upstream_calls_are_all_counted(self):
+        category = self.product.category
+        for index in range(5):
+            Product.objects.create(name=f'Poire {index}', active=True, category=category, barcode=f'poire-{index}')
+        # Slow enough for the prefetch threads to overlap
+        with OpenFoodFactStubServer(delay=0.1) as stub, mock.patch('shop.models.ECOSCORE_URL', stub.url):
+            with self.assertLogs('shop.performance', level='INFO') as logs:
+                response = self.client.get(reverse('product-list'))
+        self.assertIn('desc="External API (6)"', self.timings(response)['external'])
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['external_count'], 6)
+        # The time of each call, so about six times the delay
+        self.assertGreater(line['external_ms'], 500)
+
+    def test_authentication_is_timed(self):
+        get_user_model().objects.create_user('timing', 'timing@oc.drf', 'timing')
+        with self.assertLogs('shop.performance', level='INFO') as logs:
+            token = self.client.post(reverse('token_obtain_pair'), {'username': 'timing', 'password': 'timing'}).json()
+            self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token['access']}")
+            response = self.client.get(reverse('category-list'))
+        self.assertIn('auth', self.timings(response))
+        line = json.loads(logs.records[-2].getMessage())
+        self.assertEqual(line['auth_count'], 1)
+
+    @override_settings(PERFORMANCE_INSTRUMENTATION={'ENABLED': False})
+    def test_disabled_by_default(self):
+        response = self.client.get(reverse('category-list'))
+        self.assertFalse(response.has_header('Server-Timing'))
+
+
+class TestProfiling(ShopAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name='Fruits', active=True)
+        product = Product.objects.create(name='Pomme', active=True, category=category,
+                                         ecoscore_grade='a', ecoscore_fetched_at=timezone.now())
+        Article.objects.create(name='Pomme Golden', price=2, active=True, product=product)
+        self.url = reverse('category-detail', kwargs={'pk': category.pk})
+
+    def test_staff_inline_profile(self):
+        staff = get_user_model().objects.create_user('staff', 'staff@oc.drf', 'password', is_staff=True)
+        self.client.force_authenticate(staff)
+        response = self.client.get(self.url, HTTP_X_PROFILE='inline')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        report = response.json()
+        self.assertEqual(report['status'], status.HTTP_200_OK)
+        self.assertTrue(any('to_representation' in row['function'] for row in report['stats']))
+        self.assertTrue(any('shop_product' in query['sql'] for query in report['sql']))
+        self.assertTrue(report['call_tree'])
+
+    def test_admin_stored_profile(self):
+        self.client.force_authenticate(get_user_model().objects.create_superuser('admin', 'admin@oc.drf', 'password'))
+        with tempfile.TemporaryDirectory() as directory, override_settings(PROFILING={'DIRECTORY': directory}):
+            response = self.client.get(self.url + '?profile=store')
+            self.assertEqual(response.json()['name'], 'Fruits')
+            profile_id = response['X-Profile-Id']
+            with open(f'{directory}/{profile_id}.json') as file:
+                self.assertEqual(json.load(file)['path'], self.url + '?profile=store')
+            self.assertTrue(os.path.exists(f'{directory}/{profile_id}.prof'))
+
+    def test_ordinary_users_cannot_profile(self):
+        self.client.force_authenticate(get_user_model().objects.create_user('user', 'user@oc.drf', 'password'))
+        for client_kwargs in ({'HTTP_X_PROFILE': 'inline'}, {'data': {'profile': 'inline'}}):
+            response = self.client.get(self.url, **client_kwargs)
+            self.assertEqual(response.json()['name'], 'Fruits')
+            self.assertFalse(response.has_header('X-Profile-Id'))
+
+
+@override_settings(CATALOG_RESPONSE_CACHE={'ENABLED': False}, CATALOG_FAST_LIST=True)
+class TestFastListPath(ShopAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name='Fruits', description='Fruits de saison', active=True)
+        Product.objects.create(name='Pomme', active=True, category=category,
+                               ecoscore_grade='b', ecoscore_fetched_at=timezone.now())
+        product = Product.objects.create(name='Poire', active=True, category=category)
+        Product.objects.create(name='Kiwi', active=True, category=category, barcode='')
+        Article.objects.create(name='Poire Williams', price='2.5', active=True, product=product)
+        Article.objects.create(name='Poire Conférence', price=10, active=True, product=product)
+
+    @mock.patch('shop.models.Product.call_external_api', mock_openfoodfact_success)
+    def test_same_output_as_the_serializers(self):
+        for url in ['category-list', 'product-list', 'article-list']:
+            for query in ['', '?limit=2&offset=1', '?pagination=cursor&limit=2']:
+                with override_settings(CATALOG_FAST_LIST=False):
+                    expected = self.client.get(reverse(url) + query)
+                response = self.client.get(reverse(url) + query)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.content, expected.content)
+
+    @mock.patch('shop.models.Product.call_external_api', mock_openfoodfact_success)
+    def test_same_output_for_every_fieldset(self):
+        for url, row_serializer_class, expansions in [
+                ('category-list', CategoryRowSerializer, ['products', 'products.articles']),
+                ('product-list', ProductRowSerializer, ['articles']),
+                ('article-list', ArticleRowSerializer, [])]:
+            names = [name for name, _, _ in row_serializer_class().fields]
+            # Every fieldset the row serializer serves, and the expansions, which fall back to the serializers
+            queries = [f"?fields={','.join(fields)}" for size in range(len(names) + 1)
+                       for fields in itertools.combinations(names, size)]
+            queries += [f'?fields={name}&expand={expand}' for expand in expansions for name in ['', *names]]
+            for query in queries:
+                with override_settings(CATALOG_FAST_LIST=False):
+                    expected = self.client.get(reverse(url) + query)
+                response = self.client.get(reverse(url) + query)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.content, expected.content, url + query)
+
+    def test_values_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(reverse('article-list'))
+        select = context.captured_queries[-1]['sql']
+        self.assertIn('"shop_article"."price"', select)
+        self.assertNotIn('"shop_article"."active"', select.split('FROM')[0])
+
+
+class TestSparseFieldsets(ShopAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name='Fruits', active=True)
+        for name in ['Pomme', 'Poire']:
+            product = Product.objects.create(name=name, active=True, category=self.category)
+            for variety in ['Bio', 'Locale']:
+                Article.objects.create(name=f'{name} {variety}', price=2, active=True, product=product)
+        self.detail_url = reverse('category-detail', kwargs={'pk': self.category.pk})
+
+    def test_unrequested_ecoscore_is_not_fetched(self):
+        for fast in [True, False]:
+            with override_settings(CATALOG_FAST_LIST=fast), \
+                    mock.patch('shop.models.Product.call_external_api') as call:
+                # Distinct urls, so the second one isn't read from the response cache
+                response = self.client.get(reverse('product-list') + f'?fields=id,name&fast={fast}')
+            self.assertEqual(call.call_count, 0)
+            self.assertEqual([set(product) for product in response.json()['results']], [{'id', 'name'}] * 2)
+
+    def test_unrequested_products_are_not_queried(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.detail_url + '?fields=id,name')
+        self.assertEqual(response.json(), {'id': self.category.pk, 'name': 'Fruits'})
+        # The table versions, the conditional GET validator and the category
+        self.assertEqual(len(context.captured_queries), 3)
+
+    @mock.patch('shop.models.Product.call_external_api', mock_openfoodfact_success)
+    def test_nested_fields_and_limits(self):
+        response = self.client.get(self.detail_url + '?fields=name,products.name,products.articles.name'
+                                                     '&products_limit=1&articles_limit=1')
+        self.assertEqual(response.json(), {'name': 'Fruits', 'products': [
+            {'name': 'Pomme', 'articles': [{'name': 'Pomme Bio'}]}]})
+
+    @mock.patch('shop.models.Product.call_external_api', mock_openfoodfact_success)
+    def test_expanded_lists(self):
+        response = self.client.get(reverse('category-list') + '?fields=id&expand=products.articles'
+                                                              '&articles_limit=1')
+        products = response.json()['results'][0]['products']
+        self.assertEqual([[article['name'] for article in product['articles']] for product in products],
+                         [['Pomme Bio'], ['Poire Bio']])
+
+        url = reverse('product-list') + '?expand=articles'
+        self.assertEqual(len(self.client.get(url).json()['results'][0]['articles']), 2)
+        # Cached lists with expanded articles follow the article writes
+        Article.objects.filter(name='Pomme Bio').update(active=False)
+        Article.objects.get(name='Pomme Locale').save()
+        self.assertEqual(len(self.client.get(url).json()['results'][0]['articles']), 1)
+
+    def test_unknown_fields_are_rejected(self):
+        for query in ['?fields=id,colour', '?expand=articles', '?products_limit=-1']:
+            response = self.client.get(self.detail_url + query)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(CATALOG_RESPONSE_CACHE={'ENABLED': False})
+class TestSnapshots(ShopAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.categories = []
+        # Committed, as the writes the tests make later
+        with self.captureOnCommitCallbacks(execute=True):
+            for name in ['Fruits', 'Légumes']:
+                category = Category.objects.create(name=name, active=True)
+                product = Product.objects.create(name=f'{name} bio', active=True, category=category,
+                                                 ecoscore_grade='a', ecoscore_fetched_at=timezone.now())
+                Article.objects.create(name=f'{name} bio 1kg', price='3.5', active=True, product=product)
+                self.categories.append(category)
+
+    def get(self, category):
+        return self.client.get(reverse('category-detail', kwargs={'pk': category.pk}))
+
+    def snapshot_ids(self):
+        return set(CategorySnapshot.objects.values_list('category_id', flat=True))
+
+    def test_snapshot_is_served_as_is(self):
+        fruits = self.categories[0]
+        with override_settings(CATALOG_SNAPSHOTS={'ENABLED': False}):
+            expected = self.get(fruits)
+        self.get(fruits)
+        self.assertEqual(self.snapshot_ids(), {fruits.pk})
+        with CaptureQueriesContext(connection) as context:
+            response = self.get(fruits)
+        # The table versions, the three conditional GET validators and the snapshot
+        self.assertEqual(len(context.captured_queries), 5)
+        self.assertEqual(response.content, expected.content)
+        self.assertEqual(response['Content-Type'], expected['Content-Type'])
+        self.assertEqual(response['ETag'], expected['ETag'])
+        # Sparse fieldsets are left to the serializers
+        self.assertEqual(self.client.get(reverse('category-detail', kwargs={'pk': fruits.pk}) + '?fields=id').json(),
+                         {'id': fruits.pk})
+
+    def test_writes_only_drop_their_category(self):
+        fruits, vegetables = self.categories
+        for category in self.categories:
+            self.get(category)
+        # Dropped when the write commits
+        with self.captureOnCommitCallbacks(execute=True):
+            Article.objects.filter(product__category=fruits).get().save()
+        self.assertEqual(self.snapshot_ids(), {vegetables.pk})
+        self.get(fruits)
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(category=vegetables).disable()
+        self.assertEqual(self.snapshot_ids(), {fruits.pk})
+        with self.captureOnCommitCallbacks(execute=True):
+            fruits.disable()
+        self.assertEqual(self.snapshot_ids(), set())
+        self.assertEqual(self.get(fruits).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_outdated_snapshot_is_rebuilt(self):
+        fruits = self.categories[0]
+        self.get(fruits)
+        # No signal, the fingerprint tells the snapshot is outdated
+        Article.objects.filter(product__category=fruits).update(price=4, date_updated=timezone.now())
+        self.assertEqual(self.get(fruits).json()['products'][0]['articles'][0]['price'], '4.00')
+
+    def test_rebuild_command(self):
+        self.categories[1].disable()
+        CategorySnapshot.objects.create(category=self.categories[1], content=b'{}', fingerprint='', built_at=timezone.now())
+        out = StringIO()
+        call_command('rebuild_snapshots', workers=1, stdout=out)
+        self.assertIn('Built 1 snapshots, removed 1 inactive ones', out.getvalue())
+        self.assertEqual(self.snapshot_ids(), {self.categories[0].pk})
+
+
+class TestJWTUserResolution(ShopAPITestCase):
+    url = reverse_lazy('admin-external-api-list')
+
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user('staff', 'staff@oc.drf', 'password', is_staff=True)
+
+    def tokens(self):
+        return self.client.post(reverse('token_obtain_pair'), {'username': 'staff', 'password': 'password'}).json()
+
+    def get(self, access):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, HTTP_AUTHORIZATION=f'Bearer {access}')
+        return response.status_code, len(context.captured_queries)
+
+    def test_tokens_carry_the_user_flags(self):
+        access = AccessToken(self.tokens()['access'])
+        self.assertEqual((access['username'], access['is_staff'], access['is_superuser']), ('staff', True, False))
+
+    def test_cached_users_need_no_query(self):
+        access = self.tokens()['access']
+        self.assertEqual(self.get(access), (status.HTTP_200_OK, 1))
+        self.assertEqual(self.get(access), (status.HTTP_200_OK, 0))
+        # Saved through the ORM, applies at once
+        self.user.is_staff = False
+        self.user.save()
+        self.assertEqual(self.get(access)[0], status.HTTP_403_FORBIDDEN)
+
+    def test_revocation_applies_within_the_ttl(self):
+        access = self.tokens()['access']
+        self.get(access)
+        get_user_model().objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.get(access)[0], status.HTTP_200_OK)
+        with override_settings(JWT_USER_RESOLUTION={'TTL': 0}):
+            caches['default'].clear()
+            self.assertEqual(self.get(access)[0], status.HTTP_401_UNAUTHORIZED)
+            self.assertEqual(self.get(access)[0], status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(JWT_USER_RESOLUTION={'MODE': 'claims'})
+    def test_claims_mode_reads_the_flags_again_on_refresh(self):
+        tokens = self.tokens()
+        self.assertEqual(self.get(tokens['access']), (status.HTTP_200_OK, 0))
+        get_user_model().objects.filter(pk=self.user.pk).update(is_staff=False)
+        self.assertEqual(self.get(tokens['access'])[0], status.HTTP_200_OK)
+        access = self.client.post(reverse('token_refresh'), {'refresh': tokens['refresh']}).json()['access']
+        self.assertEqual(self.get(access)[0], status.HTTP_403_FORBIDDEN)
+        get_user_model().objects.filter(pk=self.user.pk).update(is_active=False)
+        response = self.client.post(reverse('token_refresh'), {'refresh': tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class TestAsyncViews(ShopAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name='Fruits', active=True)
+        self.products = [
+            Product.objects.create(name=f'Pomme {index}', barcode=f'{index:013d}', active=True, category=self.category)
+            for index in range(5)
+        ]
+        for product in self.products:
+            Article.objects.create(name=f'{product.name} x6', price=3, active=True, product=product)
+
+    def get(self, url):
+        async def get():
+            return await self.async_client.get(url)
+
+        response = async_to_sync(get)()
+        # The pagination links lead to the async endpoints
+        return response.status_code, json.loads(response.content.decode().replace('/api/async/', '/api/'))
+
+    def test_same_output_as_the_viewsets(self):
+        with OpenFoodFactStubServer() as stub, mock.patch('shop.models.ECOSCORE_URL', stub.url):
+            for name, kwargs, query in [('product-list', {}, '?limit=2&category_id=%d' % self.category.pk),
+                                        ('product-detail', {'pk': self.products[0].pk}, ''),
+                                        ('category-list', {}, ''),
+                                        ('category-detail', {'pk': self.category.pk}, '')]:
+                ecoscore_cache.clear()
+                expected = self.client.get(reverse(name, kwargs=kwargs) + query).json()
+                ecoscore_cache.clear()
+                self.assertEqual(self.get(reverse(f'async-{name}', kwargs=kwargs) + query),
+                                 (status.HTTP_200_OK, expected), name)
+        self.assertEqual(self.get(reverse('async-product-detail', kwargs={'pk': 0})),
+                         (status.HTTP_404_NOT_FOUND, {'detail': 'Not found.'}))
+
+    def test_slow_upstream_calls_overlap(self):
+        async def get_all(urls):
+            return await asyncio.gather(*(self.async_client.get(url) for url in urls))
+
+        urls = [reverse('async-product-detail', kwargs={'pk': product.pk}) for product in self.products]
+        with OpenFoodFactStubServer(delay=0.5) as stub, mock.patch('shop.models.ECOSCORE_URL', stub.url):
+            start = time.perf_counter()
+            responses = async_to_sync(get_all)(urls)
+            elapsed = time.perf_counter() - start
+        self.assertEqual([response.json()['ecoscore'] for response in responses], [ECOSCORE_GRADE] * 5)
+        self.assertEqual(stub.calls, 5)
+        # One after the other they would take 2.5 seconds
+        self.assertLess(elapsed, 1.5)
+
+
+# Two SQLite databases, rows written to only one of them tell where a request read from.
+# Reads inside transactions go to the primary, so no test transaction here
+@override_settings(DATABASE_REPLICAS={'ALIASES': ['replica']}, CATALOG_RESPONSE_CACHE={'ENABLED': False})
+class TestReadReplicas(APITransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        replica_health.reset()
+        self.category = Category.objects.create(name='Fruits', active=True)
+        Category.objects.using('replica').create(pk=self.category.pk, name='Fruits', active=True)
+        Category.objects.using('replica').create(name='Replica only', active=True)
+
+    def names(self):
+        response = self.client.get(reverse('category-list'))
+        return [category['name'] for category in response.json()['results']]
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.names(), ['Fruits', 'Replica only'])
+        with override_settings(DATABASE_REPLICAS={'ALIASES': []}):
+            self.assertEqual(self.names(), ['Fruits'])
+
+    def test_clients_read_their_own_writes(self):
+        response = self.client.post(reverse('category-disable', kwargs={'pk': self.category.pk}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.cookies['primary_pinned']['max-age'], 10)
+        self.assertEqual(self.names(), [])
+        # Once the cookie is gone, the replica which hasn't caught up yet
+        self.client.cookies.clear()
+        self.assertEqual(self.names(), ['Fruits', 'Replica only'])
+
+    def test_requests_stick_to_the_primary_after_writing(self):
+        router = ReplicaRouter()
+        token = current_routing.set(RoutingState())
+        try:
+            self.assertEqual(router.db_for_read(Category), 'replica')
+            self.assertEqual(router.db_for_write(Category), 'default')
+            self.assertEqual(router.db_for_read(Category), 'default')
+        finally:
+            current_routing.reset(token)
+
+    def test_unhealthy_replicas_are_left_out(self):
+        with mock.patch.object(replica_health, 'check', return_value=False) as check:
+            self.assertEqual(self.names(), ['Fruits'])
+            self.assertEqual(self.names(), ['Fruits'])
+        # Checked once per HEALTH_CHECK_INTERVAL
+        self.assertEqual(check.call_count, 1)
+
+
+class TestSearch(ShopAPITestCase):
+    url = reverse_lazy('search-list')
+
+    def setUp(self):
+        super().setUp()
+        self.fruits = Category.objects.create(name='Fruits', active=True)
+        self.vegetables = Category.objects.create(name='Légumes', active=True)
+        self.apple = Product.objects.create(name='Pomme Golden', active=True, category=self.fruits)
+        self.pear = Product.objects.create(name='Poire', active=True, category=self.fruits)
+        self.article = Article.objects.create(name='Pomme Williams x6', price=3, active=True, product=self.pear)
+        self.potato = Product.objects.create(name='Patate', description='La pomme de terre', active=True,
+                                             category=self.vegetables)
+        Product.objects.create(name='Pomme Gala', active=False, category=self.fruits)
+
+    def search(self, query, **params):
+        with mock.patch('shop.models.Product.call_external_api', mock_openfoodfact_success):
+            response = self.client.get(self.url, {'q': query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [product['name'] for product in response.json()['results']]
+
+    def test_ranked_active_products(self):
+        # Names first, then articles, then descriptions
+        self.assertEqual(self.search('pomme'), ['Pomme Golden', 'Poire', 'Patate'])
+        self.assertEqual(self.search('pomme terre'), ['Patate'])
+        # Word prefixes, accents ignored
+        self.assertEqual(self.search('legu'), ['Patate'])
+        # FTS5 syntax is taken as words
+        self.assertEqual(self.search('gold*"('), ['Pomme Golden'])
+
+    def test_paginated(self):
+        response = self.client.get(self.url, {'q': 'pomme', 'limit': 1, 'offset': 1})
+        data = response.json()
+        self.assertEqual(data['count'], 3)
+        self.assertEqual([product['name'] for product in data['results']], ['Poire'])
+
+    def test_query_is_required(self):
+        self.assertEqual(self.client.get(self.url, {'q': ' ?! '}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_index_follows_the_writes(self):
+        self.article.name = 'Poire Williams x6'
+        self.article.save()
+        self.assertEqual(self.search('pomme'), ['Pomme Golden', 'Patate'])
+        self.potato.disable()
+        self.assertEqual(self.search('pomme'), ['Pomme Golden'])
+        # Set-based cascades
+        Category.objects.filter(pk=self.fruits.pk).disable()
+        self.assertEqual(self.search('pomme'), [])
+        Category.objects.filter(pk=self.fruits.pk).enable(cascade=True)
+        self.assertEqual(self.search('gala'), ['Pomme Gala'])
+        self.vegetables.name = 'Tubercules'
+        self.vegetables.save()
+        Product.objects.filter(pk=self.potato.pk).enable()
+        self.assertEqual(self.search('tuber'), ['Patate'])
+        self.potato.delete()
+        self.assertEqual(self.search('tuber'), [])
+
+    def test_queries_dont_depend_on_the_catalog_size(self):
+        generate_catalog(5, 20, 2, seed=0)
+        self.search('pomme')
+        # Count, ranked page, its products, then their cached ecoscores and their prices
+        with self.assertNumQueries(5):
+            self.search('pomme')
+
+    def test_rebuild_command(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM shop_product_search')
+        self.assertEqual(self.search('pomme'), [])
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(self.search('pomme'), ['Pomme Golden', 'Poire', 'Patate'])
+
+
+@override_settings(CATALOG_SNAPSHOTS={'ENABLED': False})
+class TestPriceStats(ShopAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.fruits = Category.objects.create(name='Fruits', active=True)
+        self.legumes = Category.objects.create(name='Légumes', active=True)
+        self.pomme = Product.objects.create(name='Pomme', active=True, category=self.fruits, barcode='')
+        self.poire = Product.objects.create(name='Poire', active=True, category=self.fruits, barcode='')
+        self.carotte = Product.objects.create(name='Carotte', active=True, category=self.legumes, barcode='')
+        Product.objects.create(name='Kiwi', active=False, category=self.fruits, barcode='')
+        self.article = Article.objects.create(name='Pomme Golden', price='1.50', active=True, product=self.pomme)
+        Article.objects.create(name='Pomme Bio', price='2.50', active=True, product=self.pomme)
+        Article.objects.create(name='Pomme Gala', price='9.00', active=False, product=self.pomme)
+        Article.objects.create(name='Poire Williams', price='4.00', active=True, product=self.poire)
+        Article.objects.create(name='Carotte', price='0.80', active=True, product=self.carotte)
+
+    def prices(self, response):
+        return {row['name']: [row[name] for name in PRICE_FIELDS] for row in response.json()['results']}
+
+    def test_aggregates_of_active_articles(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('product-list'))
+        self.assertEqual(self.prices(response), {'Pomme': ['1.50', '2.50', '2.00', 2], 'Poire': ['4.00', '4.00', '4.00', 1],
+                                                 'Carotte': ['0.80', '0.80', '0.80', 1]})
+        # One aggregate for the whole page
+        self.assertEqual(len([query for query in context.captured_queries if 'MIN(' in query['sql']]), 1)
+        # Validated by the version of the article table, without aggregating the articles
+        self.assertFalse([query for query in context.captured_queries
+                          if 'MAX("shop_article"."date_updated")' in query['sql']])
+        self.assertEqual(self.prices(self.client.get(reverse('category-list'))),
+                         {'Fruits': ['1.50', '4.00', '2.67', 3], 'Légumes': ['0.80', '0.80', '0.80', 1]})
+
+        detail = self.client.get(reverse('category-detail', kwargs={'pk': self.fruits.pk})).json()
+        self.assertEqual([detail[name] for name in PRICE_FIELDS], ['1.50', '4.00', '2.67', 3])
+        self.assertEqual([product['min_price'] for product in detail['products']], ['1.50', '4.00'])
+
+    def test_fast_path_matches_the_serializers(self):
+        for url in ['category-list', 'product-list']:
+            expected = self.client.get(reverse(url) + '?fields=id,min_price,avg_price,article_count')
+            # Distinct url, so the fast path isn't read from the response cache
+            with override_settings(CATALOG_FAST_LIST=True):
+                response = self.client.get(reverse(url) + '?fields=id,min_price,avg_price,article_count&fast=True')
+            self.assertEqual(response.content, expected.content)
+
+    def test_price_range_filter(self):
+        response = self.client.get(reverse('product-list'), {'min_price': 2, 'max_price': '5'})
+        self.assertEqual(set(self.prices(response)), {'Pomme', 'Poire'})
+        # Inactive articles are left out of the range
+        response = self.client.get(reverse('product-list'), {'min_price': 5})
+        self.assertEqual(response.json()['count'], 0)
+        response = self.client.get(reverse('category-list'), {'max_price': 1})
+        self.assertEqual(set(self.prices(response)), {'Légumes'})
+        for query in [{'min_price': 'cheap'}, {'max_price': 'NaN'}]:
+            response = self.client.get(reverse('product-list'), query)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_price_change_invalidates_the_lists(self):
+        for url, name in [(reverse('category-list'), 'Fruits'), (reverse('product-list'), 'Pomme')]:
+            etag = self.client.get(url)['ETag']
+            self.article.price = '1.00'
+            with self.captureOnCommitCallbacks(execute=True):
+                self.article.save()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(self.prices(response)[name][0], '1.00')
+            self.article.price = '1.50'
+            self.article.save()
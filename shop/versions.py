@@ -0,0 +1,47 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from shop.models import Category, Product, Article, CatalogVersion
+from shop.signals import catalog_updated, on_commit_batch
+
+# One row per catalog table, moved forward by every write to it: saves, deletes and the set-based
+# writes sending catalog_updated. Unlike the latest date_updated of the rows a response is made of,
+# it also moves when rows are deleted or leave the response, when they are disabled for instance.
+# Shared by the workers, as it lives in the database. Moved when the write commits, once per table
+# whatever the number of rows and statements of the transaction.
+
+
+def bump_versions(models):
+    tables = [model._meta.db_table for model in models]
+    now = timezone.now()
+    if CatalogVersion.objects.filter(table__in=tables).update(date_updated=now) < len(tables):
+        # Missing rows, after a flush of the tables for instance
+        CatalogVersion.objects.bulk_create([CatalogVersion(table=table, date_updated=now) for table in tables],
+                                           ignore_conflicts=True)
+
+
+def read_versions():
+    """ {table: last write} of the catalog tables, in one query. A table without row hasn't been written
+        since the versions were introduced """
+    return dict(CatalogVersion.objects.values_list('table', 'date_updated'))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Article)
+def row_changed(sender, instance, **kwargs):
+    on_commit_batch('versions', bump_versions, [sender])
+
+
+# The cascades of a model also write the tables below it
+CASCADES = {
+    Category: [Category],
+    Product: [Product, Article],
+    Article: [Article],
+}
+
+
+@receiver(catalog_updated)
+def catalog_bulk_updated(sender, **kwargs):
+    on_commit_batch('versions', bump_versions, CASCADES[sender])
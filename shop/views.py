@@ -1,11 +1,41 @@
-from rest_framework.viewsets import ReadOnlyModelViewSet, ModelViewSet
+import hashlib
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.db.models import Prefetch, Max, Count, OuterRef, Subquery
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, quote_etag
+from rest_framework.viewsets import ReadOnlyModelViewSet, ModelViewSet, ViewSet
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.exceptions import ParseError, PermissionDenied, ValidationError
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.parsers import JSONParser
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from shop.permissions import isAdminAuthenticated, isStaffAuthenticated
+from shop.pagination import CatalogPagination
+from shop.cache import CachedResponseMixin, get_cache, get_versions
+from shop.snapshots import SnapshotMixin, tree_querysets
+from shop.profiling import ProfilingMixin
+from shop.fastpath import RowSerializerMixin, CategoryRowSerializer, ProductRowSerializer, ArticleRowSerializer
+from shop.parsers import NDJSONParser
+from shop.search import search_products
+from shop.prices import PRICE_FIELDS
+from shop.versions import read_versions
 
 from shop.models import Category, Product, Article
+from shop.ecoscore import ecoscore_cache
+from shop.clients import get_client
+from shop.export import iter_rows, iter_ndjson, iter_csv
+from shop.changes import changes_page, encode_cursor, decode_cursor
 from shop.serializers import CategoryListSerializer, CategoryDetailSerializer, \
-    ProductListSerializer, ProductDetailSerializer, ArticleSerializer
+    ProductListSerializer, ProductDetailSerializer, ArticleSerializer, CategoryBulkStatusSerializer, \
+    ArticleBulkSerializer, parse_fieldset
 
 # Mixin rewriting get_serializee_class for derived viewsets
 class MultipleSerializerMixin:
@@ -16,12 +46,221 @@ class MultipleSerializerMixin:
             return self.detail_serializer_class
         return super().get_serializer_class()
 
-class CategoryViewSet(MultipleSerializerMixin, ReadOnlyModelViewSet):
+def validator_aggregate(queryset):
+    return queryset.order_by().aggregate(last_modified=Max('date_updated'), count=Count('pk'))
+
+# Mixin answering conditional GETs (If-None-Match / If-Modified-Since) with a 304
+# computed from cheap aggregates, before any serialization or ecoscore work.
+# Last-Modified is the last write to the tables of the response (see shop/versions.py), which also
+# moves when rows are disabled or deleted, unlike the latest date_updated of the rows left
+class ConditionalGetMixin:
+
+    # Querysets whose latest date_updated and row count change whenever the response does
+    def get_validator_querysets(self):
+        return [self.filter_queryset(self.get_queryset())]
+
+    # Models whose writes may change the response
+    def get_validator_models(self, querysets):
+        return {queryset.model for queryset in querysets}
+
+    def get_validators(self, request):
+        parts = [request.get_full_path(), request.accepted_renderer.format]
+        querysets = self.get_validator_querysets()
+        versions = read_versions()
+        tables = sorted(model._meta.db_table for model in self.get_validator_models(querysets))
+        dates = [versions.get(table) for table in tables]
+        parts += dates
+        # Kept for the snapshots, see shop/snapshots.py
+        self.validator_aggregates = []
+        for index, queryset in enumerate(querysets):
+            if index == 0 and self.action == 'list':
+                aggregate = self.get_list_aggregate(queryset, self.get_validator_models(querysets))
+                # Also the count of the paginated list, no need to run it twice
+                self.queryset_count = aggregate['count']
+            else:
+                aggregate = validator_aggregate(queryset)
+            self.validator_aggregates.append(aggregate)
+            parts += [aggregate['last_modified'], aggregate['count']]
+            dates.append(aggregate['last_modified'])
+        etag = quote_etag(hashlib.md5('|'.join(map(str, parts)).encode()).hexdigest())
+        return etag, max(filter(None, dates), default=None)
+
+    # The aggregate of the paginated list is reused, per database as the replicas may lag, while the catalog
+    # cache versions of its tables stay the same (see shop/cache.py), for CATALOG_COUNT_CACHE_TTL seconds at most: writes sending no signal, like a
+    # queryset update(), show up in the count within that delay
+    def get_list_aggregate(self, queryset, models):
+        ttl = getattr(settings, 'CATALOG_COUNT_CACHE_TTL', 60)
+        if not ttl:
+            return validator_aggregate(queryset)
+        try:
+            sql, params = queryset.order_by().query.sql_with_params()
+        except EmptyResultSet:
+            return validator_aggregate(queryset)
+        versions = get_versions(sorted(model._meta.model_name for model in models))
+        key = 'catalog:count:' + hashlib.md5(repr([queryset.db, sql, params, versions]).encode()).hexdigest()
+        cache = get_cache()
+        aggregate = cache.get(key)
+        if aggregate is None:
+            aggregate = validator_aggregate(queryset)
+            cache.set(key, aggregate, ttl)
+        return aggregate
+
+    def conditional(self, handler, request, *args, **kwargs):
+        try:
+            etag, last_modified = self.get_validators(request)
+        except (ValueError, TypeError):
+            # Malformed pk, left to the handler to answer a 404
+            return handler(request, *args, **kwargs)
+        # Whole seconds, as If-Modified-Since carries them
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if timestamp:
+                response['Last-Modified'] = http_date(timestamp)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(super().retrieve, request, *args, **kwargs)
+
+# Mixin reading the sparse fieldsets: ?fields= and ?expand= (dotted paths for the nested fields)
+# and the ?products_limit= / ?articles_limit= of the nested lists, handed to the serializers
+class SparseFieldsetMixin:
+    nested_limits = ('products', 'articles')
+
+    def get_fieldset(self):
+        if not hasattr(self, '_fieldset'):
+            params = self.request.query_params
+            limits = {}
+            for name in self.nested_limits:
+                value = params.get(f'{name}_limit')
+                if value is not None:
+                    if not value.isdigit():
+                        raise ParseError(f'{name}_limit must be a positive integer.')
+                    limits[name] = int(value)
+            self._fieldset = (parse_fieldset(params.get('fields', '')), parse_fieldset(params.get('expand', '')), limits)
+        return self._fieldset
+
+    def get_serializer(self, *args, **kwargs):
+        fields, expand, limits = self.get_fieldset()
+        return super().get_serializer(*args, fields=fields, expand=expand, limits=limits, **kwargs)
+
+    # Whether the response holds the field at path, e.g. ('products', 'articles'), so that nothing is
+    # prefetched or validated for the fields left out
+    def includes(self, *path):
+        serializer_class = self.get_serializer_class()
+        fields, expand, _ = self.get_fieldset()
+        for name in path:
+            if serializer_class is None or not serializer_class.includes(name, fields, expand):
+                return False
+            serializer_class = serializer_class.nested_serializers.get(name)
+            fields, expand = fields.get(name) or {}, expand.get(name) or {}
+        return True
+
+    def includes_prices(self):
+        return any(self.includes(name) for name in PRICE_FIELDS)
+
+# Mixin reading the ?min_price= / ?max_price= range of the lists, which keep the rows having an active
+# article priced within it. The articles are selected from their (price, product) index
+class PriceRangeMixin:
+    price_range_params = ('min_price', 'max_price')
+
+    def get_price_range(self):
+        bounds = []
+        for name in self.price_range_params:
+            value = self.request.query_params.get(name)
+            if value is not None:
+                try:
+                    value = Decimal(value)
+                except InvalidOperation:
+                    value = None
+                if value is None or not value.is_finite():
+                    raise ParseError(f'{name} must be a number.')
+            bounds.append(value)
+        return bounds
+
+    # Active articles within the range, None without range or outside the list
+    def get_priced_articles(self):
+        if self.action != 'list':
+            return None
+        min_price, max_price = self.get_price_range()
+        if min_price is None and max_price is None:
+            return None
+        return Article.objects.price_range(min_price, max_price)
+
+# Prefetching the active rows of the nested tree into to_attr lists read by the detail serializers,
+# so a detail response costs one query per level whatever the number of products and articles
+def limit_per_parent(queryset, parent, limit):
+    # Django 3.2 can't prefetch slices, the first rows of each parent are selected by a correlated subquery
+    if limit is None:
+        return queryset
+    first = queryset.filter(**{parent: OuterRef(parent)}).order_by('pk').values('pk')[:limit]
+    return queryset.filter(pk__in=Subquery(first)).order_by('pk')
+
+def prefetch_active_articles(limit=None):
+    queryset = limit_per_parent(Article.objects.filter(active=True), 'product_id', limit)
+    return Prefetch('articles', queryset=queryset, to_attr='active_articles')
+
+def prefetch_active_products(articles=True, limit=None, articles_limit=None):
+    queryset = limit_per_parent(Product.objects.filter(active=True), 'category_id', limit)
+    if articles:
+        queryset = queryset.prefetch_related(prefetch_active_articles(articles_limit))
+    return Prefetch('products', queryset=queryset, to_attr='active_products')
+
+class CategoryViewSet(ProfilingMixin, CachedResponseMixin, ConditionalGetMixin, SnapshotMixin, SparseFieldsetMixin,
+                      PriceRangeMixin, MultipleSerializerMixin, RowSerializerMixin, ReadOnlyModelViewSet):
     serializer_class = CategoryListSerializer
+    row_serializer_class = CategoryRowSerializer
     detail_serializer_class = CategoryDetailSerializer
+    pagination_class = CatalogPagination
 
     def get_queryset(self): # Either redefine queryset class attribute or get_queryset method
-        return Category.objects.filter(active=True)
+        queryset = Category.objects.filter(active=True)
+        articles = self.get_priced_articles()
+        if articles is not None:
+            products = Product.objects.filter(active=True, pk__in=articles.values('product_id'))
+            queryset = queryset.filter(pk__in=products.values('category_id'))
+        # Detail trees, and lists with ?expand=products
+        if self.includes('products'):
+            _, _, limits = self.get_fieldset()
+            queryset = queryset.prefetch_related(prefetch_active_products(
+                articles=self.includes('products', 'articles'),
+                limit=limits.get('products'), articles_limit=limits.get('articles')))
+        return queryset
+
+    def get_validator_querysets(self):
+        if self.action == 'retrieve':
+            category, products, articles = tree_querysets(self.kwargs['pk'])
+            querysets = [category]
+        else:
+            querysets = super().get_validator_querysets()
+            products = Product.objects.filter(category__in=querysets[0], active=True)
+            articles = Article.objects.filter(product__in=products, active=True)
+        if self.includes('products'):
+            querysets.append(products)
+            if self.includes('products', 'articles'):
+                querysets.append(articles)
+        return querysets
+
+    # The prices move with the articles, and with the products whose writes cascade to them,
+    # the version of the article table validates them without aggregating the articles
+    def get_validator_models(self, querysets):
+        models = super().get_validator_models(querysets)
+        if self.includes_prices():
+            models.add(Article)
+        return models
+
+    def get_cache_dependencies(self):
+        dependencies = super().get_cache_dependencies()
+        if self.action == 'list' and (self.includes('products') or self.includes_prices()):
+            # Replaced by the product and article writes too
+            dependencies.append('product')
+        return dependencies
     
     # Specific action on post method in order to disable categories
     @action(detail=True, methods=['post'])
@@ -31,10 +270,13 @@ class CategoryViewSet(MultipleSerializerMixin, ReadOnlyModelViewSet):
         return Response()
 
 
-class ProductViewSet(MultipleSerializerMixin, ReadOnlyModelViewSet):
+class ProductViewSet(ProfilingMixin, CachedResponseMixin, ConditionalGetMixin, SparseFieldsetMixin, PriceRangeMixin,
+                     MultipleSerializerMixin, RowSerializerMixin, ReadOnlyModelViewSet):
     
     serializer_class = ProductListSerializer
+    row_serializer_class = ProductRowSerializer
     detail_serializer_class = ProductDetailSerializer
+    pagination_class = CatalogPagination
 
     def get_queryset(self):
         # filtering only available products first
@@ -43,37 +285,241 @@ class ProductViewSet(MultipleSerializerMixin, ReadOnlyModelViewSet):
         #geting /product/?**category_id**
         category_id = self.request.GET.get('category_id')
         if category_id is not None:
+            if not category_id.isdigit():
+                raise ParseError('category_id must be an integer.')
             # narrowing down previously filtered selection
             queryset = queryset.filter(category_id = category_id)
+        articles = self.get_priced_articles()
+        if articles is not None:
+            queryset = queryset.filter(pk__in=articles.values('product_id'))
+        # Details, and lists with ?expand=articles
+        if self.includes('articles'):
+            _, _, limits = self.get_fieldset()
+            queryset = queryset.prefetch_related(prefetch_active_articles(limits.get('articles')))
         return queryset
+
+    def get_validator_querysets(self):
+        if self.action == 'retrieve':
+            pk = self.kwargs['pk']
+            querysets = [Product.objects.filter(pk=pk, active=True)]
+            articles = Article.objects.filter(product_id=pk, active=True)
+        else:
+            querysets = super().get_validator_querysets()
+            articles = Article.objects.filter(product__in=querysets[0], active=True)
+        if self.includes('articles'):
+            querysets.append(articles)
+        return querysets
+
+    # The prices are validated by the version of the article table, see CategoryViewSet
+    def get_validator_models(self, querysets):
+        models = super().get_validator_models(querysets)
+        if self.includes_prices():
+            models.add(Article)
+        return models
     
     @action(detail=True, methods=['post'])
     def disable(self, request, pk):
         self.get_object().disable()
         return Response()
     
-class ArticleViewSet(ReadOnlyModelViewSet):
+class ArticleViewSet(ProfilingMixin, CachedResponseMixin, ConditionalGetMixin, SparseFieldsetMixin, RowSerializerMixin,
+                     ReadOnlyModelViewSet):
     
     serializer_class = ArticleSerializer
+    row_serializer_class = ArticleRowSerializer
+    pagination_class = CatalogPagination
+
+    # Articles changed by set-based writes aren't known one by one, details depend on the whole table
+    def get_cache_dependencies(self):
+        return ['article']
 
     def get_queryset(self):
         queryset = Article.objects.filter(active=True)
         product_id = self.request.GET.get('product_id')
         if product_id is not None:
+            if not product_id.isdigit():
+                raise ParseError('product_id must be an integer.')
             queryset = queryset.filter(product_id = product_id)
         return queryset
     
-class AdminCategoryViewSet(MultipleSerializerMixin, ModelViewSet):
+class AdminCategoryViewSet(ProfilingMixin, MultipleSerializerMixin, ModelViewSet):
 
     serializer_class = CategoryListSerializer
     detail_serializer_class = CategoryDetailSerializer
     permission_classes = [isAdminAuthenticated | isStaffAuthenticated]
 
     def get_queryset(self):
-        return Category.objects.all()
+        queryset = Category.objects.all()
+        if self.action == 'retrieve':
+            queryset = queryset.prefetch_related(prefetch_active_products())
+        return queryset
+
+    # Set-based cascades over many categories in one transaction, answering the number of rows touched
+    @action(detail=False, methods=['post'], url_path='bulk-disable')
+    def bulk_disable(self, request):
+        serializer = CategoryBulkStatusSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.get_queryset().disable())
+
+    @action(detail=False, methods=['post'], url_path='bulk-enable')
+    def bulk_enable(self, request):
+        serializer = CategoryBulkStatusSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.get_queryset().enable(cascade=serializer.validated_data['cascade']))
     
-class AdminArticleViewSet(MultipleSerializerMixin, ModelViewSet):
+def coerce_values(field, values):
+    """ The values a serializer field accepts, converted the way it validates them """
+    coerced = set()
+    for value in values:
+        try:
+            coerced.add(field.to_internal_value(value))
+        except ValidationError:
+            pass
+    return coerced
+
+class AdminArticleViewSet(ProfilingMixin, MultipleSerializerMixin, ModelViewSet):
 
     serializer_class = ArticleSerializer
     queryset = Article.objects.filter(active=True)
     permission_classes = [isAdminAuthenticated | isStaffAuthenticated]
+
+    # Creates or updates many articles on their (product, name) natural key.
+    # Takes a JSON array or an NDJSON stream, invalid rows are reported without aborting the others.
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request):
+        rows = request.data
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ParseError('Expected a list of articles.')
+
+        # Keys coerced the way the rows will be validated, so "5" looks up product 5
+        fields = ArticleBulkSerializer().fields
+        product_ids = coerce_values(fields['product'], [row.get('product') for row in rows])
+        names = coerce_values(fields['name'], [row.get('name') for row in rows])
+        context = {
+            'products': Product.objects.in_bulk(product_ids),
+            'existing': set(Article.objects.filter(product_id__in=product_ids, name__in=names)
+                            .values_list('product_id', 'name')),
+        }
+
+        valid, errors = [], []
+        for index, row in enumerate(rows):
+            serializer = ArticleBulkSerializer(data=row, context=context)
+            if serializer.is_valid():
+                valid.append(serializer.validated_data)
+            else:
+                errors.append({'index': index, 'errors': serializer.errors})
+
+        batch_size = request.query_params.get('batch_size', '500')
+        if not batch_size.isdigit() or int(batch_size) < 1:
+            raise ParseError('batch_size must be a positive integer.')
+        counts = Article.objects.upsert(valid, batch_size=int(batch_size))
+        return Response({**counts, 'errors': errors})
+
+class AdminEcoscoreCacheViewSet(ViewSet):
+
+    permission_classes = [isAdminAuthenticated | isStaffAuthenticated]
+
+    # Hit/miss counters showing how much upstream traffic the ecoscore cache saves, those of this worker
+    # unless ECOSCORE_CACHE['STATS_CACHE'] names a shared cache. The entry count covers every worker
+    def list(self, request):
+        return Response(ecoscore_cache.stats())
+
+    @action(detail=False, methods=['post'])
+    def clear(self, request):
+        ecoscore_cache.clear()
+        ecoscore_cache.reset_stats()
+        return Response()
+
+
+class AdminExternalAPIViewSet(ViewSet):
+
+    permission_classes = [isAdminAuthenticated | isStaffAuthenticated]
+
+    # Latency, error and circuit breaker state of the external calls made by this worker
+    def list(self, request):
+        return Response(get_client().stats())
+
+
+class CatalogExportViewSet(ProfilingMixin, ViewSet):
+
+    # ?output= rather than ?format=, which DRF keeps for the renderer selection
+    OUTPUTS = {
+        'ndjson': (iter_ndjson, 'application/x-ndjson'),
+        'csv': (iter_csv, 'text/csv'),
+    }
+    ACTIVE = {'true': True, 'false': False, 'all': None}
+
+    # Streams the whole catalog (categories, then products, then articles) with a flat memory footprint
+    def list(self, request):
+        output = request.GET.get('output', 'ndjson')
+        active = request.GET.get('active', 'true')
+        if output not in self.OUTPUTS:
+            raise ParseError(f"output must be one of {', '.join(self.OUTPUTS)}.")
+        if active not in self.ACTIVE:
+            raise ParseError(f"active must be one of {', '.join(self.ACTIVE)}.")
+        # Like the catalog viewsets, inactive rows are only visible to the staff
+        if active != 'true' and not (isAdminAuthenticated().has_permission(request, self)
+                                     or isStaffAuthenticated().has_permission(request, self)):
+            raise PermissionDenied('Only the staff can export inactive rows.')
+
+        category_id = request.GET.get('category_id')
+        if category_id is not None and not category_id.isdigit():
+            raise ParseError('category_id must be an integer.')
+
+        encode, content_type = self.OUTPUTS[output]
+        response = StreamingHttpResponse(encode(iter_rows(self.ACTIVE[active], category_id)), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="catalog.{output}"'
+        return response
+
+
+class CatalogSearchViewSet(ProfilingMixin, ViewSet):
+
+    # Active products matching ?q=, best ranked first: matches in the product names, then in their articles,
+    # their category and their description. Every term has to match, as a word prefix, accents ignored
+    def list(self, request):
+        results = search_products(request.GET.get('q', ''))
+        if results is None:
+            raise ParseError('q must hold at least one word.')
+        paginator = LimitOffsetPagination()
+        page = paginator.paginate_queryset(results, request, view=self)
+        return paginator.get_paginated_response(ProductListSerializer(page, many=True).data)
+
+
+class CatalogChangesViewSet(ProfilingMixin, ViewSet):
+
+    # Rows created, updated, deactivated or deleted since the ?since= watermark, along with the watermark
+    # to resume from. Without since, every active row is returned as created, which is the initial full sync.
+    # Pages hold at most ?limit= rows of each kind: follow next until it's null, then keep the watermark
+    def list(self, request):
+        max_limit = getattr(settings, 'CATALOG_CHANGES_LIMIT', 1000)
+        limit = request.GET.get('limit', str(max_limit))
+        if not limit.isdigit() or not 1 <= int(limit) <= max_limit:
+            raise ParseError(f'limit must be an integer between 1 and {max_limit}.')
+        limit = int(limit)
+
+        cursor = request.GET.get('cursor')
+        if cursor is not None:
+            cursor = decode_cursor(cursor)
+            if cursor is None:
+                raise ParseError('cursor must be the one of a next link.')
+            since, watermark, positions = cursor
+        else:
+            since = request.GET.get('since')
+            if since is not None:
+                since = parse_datetime(since)
+                if since is None:
+                    raise ParseError('since must be a watermark returned by a previous call.')
+                if timezone.is_naive(since):
+                    since = timezone.make_aware(since, timezone.utc)
+            # Rows written during the last CATALOG_CHANGES_LAG seconds wait for the next call,
+            # so that transactions still running when we read aren't skipped by the watermark
+            watermark = timezone.now() - timedelta(seconds=getattr(settings, 'CATALOG_CHANGES_LAG', 2))
+            positions = {}
+
+        data, positions = changes_page(since, watermark, positions, limit)
+        data['next'] = None
+        if positions is not None:
+            cursor = encode_cursor({'since': data['since'], 'watermark': data['watermark'], 'positions': positions})
+            data['next'] = replace_query_param(remove_query_param(request.build_absolute_uri(), 'since'),
+                                               'cursor', cursor)
+        return Response(data)